@@ -0,0 +1,236 @@
+#
+# Benchmark.py
+# PySpW Benchmarks
+#
+# Runs without hardware: end-to-end benchmarks run against an in-process Emulator.Target.
+#
+#	python Benchmark.py [--json FILE] [--duration SECONDS]
+#
+
+from pyspw import SpaceWire, RMAP, Emulator
+import time
+import threading
+import argparse
+import json
+import platform
+import sys
+
+# Results of the benchmarks run, written as JSON with --json
+results = []
+
+def record(name, parameters, metrics, line):
+	"""
+	Print a result line and keep the result.
+	
+	Parameters
+	----------
+		name:		benchmark name
+		parameters:	dictionary of benchmark parameters
+		metrics:	dictionary of measured values
+		line:		line to print
+	"""
+	results.append({'benchmark': name, 'parameters': parameters, 'metrics': metrics})
+	print line
+
+def measure(function, duration=1.0, repeat=5):
+	"""
+	Call function repeatedly for about duration seconds in total.
+	
+	Returns
+	-------
+		rate:	best calls per second among repeat rounds
+	"""
+	best = 0.0
+	for i in range(repeat):
+		count = 0
+		stime = time.time()
+		etime = stime
+		while etime - stime < duration / repeat:
+			function()
+			count += 1
+			etime = time.time()
+		best = max(best, count / (etime - stime))
+	
+	return best
+
+def percentile(values, percent):
+	"""
+	Return a percentile of sorted values (nearest rank), or 0 if empty.
+	"""
+	if not values:
+		return 0.0
+	
+	return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+def bench_decoder():
+	"""
+	SSDTP2 decoder throughput, fed with 64 kB reads as the Transceiver does.
+	"""
+	for size in (16, 256, 4096, 65536):
+		count = max(1, (4 * 1024**2) / size)
+		stream = SpaceWire.frame(SpaceWire.DataFlag_Complete_EOP, '\xa5' * size) * count
+		chunks = [ buffer(stream, offset, 65536) for offset in xrange(0, len(stream), 65536) ]
+		
+		def decode():
+			decoder = SpaceWire.Decoder()
+			for chunk in chunks:
+				decoder.feed(chunk)
+		
+		rate = measure(decode)
+		record('ssdtp2_decode', {'size': size}, {'mb_per_s': rate * len(stream) / 1e6, 'packets_per_s': rate * count},
+			"SSDTP2 decode %6d B packets: %8.1f MB/s %10.0f packets/s" % (size, rate * len(stream) / 1e6, rate * count))
+
+class Sink(object):
+	"""
+	Socket accepting at most size bytes per send, as a busy link does.
+	"""
+	def __init__(self, size):
+		self.size = size
+	
+	def send(self, data):
+		return min(len(data), self.size)
+
+def bench_encoder():
+	"""
+	SSDTP2 encoder throughput for backlogs of read commands and of 4 kB and 64 kB write commands, sent to
+	a socket accepting 64 kB per send.
+	"""
+	dest = RMAP.Destination(src_address=0xfe, dest_address=0x30, dest_key=0x02, crc=RMAP.CRC_DraftF, word_width=1)
+	sink = Sink(65536)
+	
+	for (size, count) in ((0, 1000), (4096, 256), (65536, 64)):
+		packet = RMAP.packetize(0, dest, 0x1000, 4, '\xa5' * size if size else None)
+		
+		def encode():
+			encoder = SpaceWire.Encoder()
+			for i in xrange(count):
+				encoder.put(packet)
+			while encoder:
+				encoder.send(sink)
+		
+		rate = measure(encode)
+		record('ssdtp2_encode', {'size': len(packet), 'backlog': count}, {'mb_per_s': rate * count * len(packet) / 1e6, 'packets_per_s': rate * count},
+			"SSDTP2 encode backlog of %4d %5d B packets: %8.1f MB/s %10.0f packets/s" % (count, len(packet), rate * count * len(packet) / 1e6, rate * count))
+
+def bench_packetize():
+	"""
+	RMAP command packetizing rate for single word register accesses.
+	"""
+	for word_width in (1, 2, 4):
+		dest = RMAP.Destination(src_address=0xfe, dest_address=0x30, dest_key=0x02, crc=RMAP.CRC_DraftF, word_width=word_width)
+		packetize = RMAP.packetize
+		
+		def read():
+			for tid in xrange(1000):
+				packetize(tid, dest, 0x1000, 1)
+		
+		def write():
+			for tid in xrange(1000):
+				packetize(tid, dest, 0x1000, 1, (0x12, ))
+		
+		(reads, writes) = (measure(read) * 1000, measure(write) * 1000)
+		record('rmap_packetize', {'word_width': word_width}, {'reads_per_s': reads, 'writes_per_s': writes},
+			"RMAP packetize width %d: read %8.0f packets/s, write %8.0f packets/s" % (word_width, reads, writes))
+
+def bench_depacketize():
+	"""
+	RMAP read reply depacketizing rate for 64 kB replies in each read data format.
+	"""
+	dest = RMAP.Destination(src_address=0xfe, dest_address=0x30, dest_key=0x02, crc=RMAP.CRC_DraftF, word_width=4)
+	data = '\xa5' * 65536
+	reply = '\xfe\x01\x0c\x00\x30\x00\x00\x00\x01\x00\x00\x00' + data + '\x00'
+	
+	for format in RMAP.Data_Formats:
+		if format == 'numpy' and not RMAP.numpy:
+			continue
+		rate = measure(lambda: RMAP.depacketize(reply, format=format))
+		record('rmap_depacketize', {'size': len(data), 'format': format}, {'mb_per_s': rate * len(data) / 1e6},
+			"RMAP depacketize 64 kB %-10s: %8.1f MB/s" % (format, rate * len(data) / 1e6))
+
+def bench_crc():
+	"""
+	RMAP CRC calculation throughput.
+	"""
+	for size in (16, 4096, 65536):
+		data = '\xa5' * size
+		RMAP.calc_crc(RMAP.CRC_DraftF, data)
+		rate = measure(lambda: RMAP.calc_crc(RMAP.CRC_DraftF, data))
+		numpy = bool(RMAP.numpy and size >= RMAP.CRC_NumPy_Threshold)
+		record('rmap_crc', {'size': size, 'numpy': numpy}, {'mb_per_s': rate * size / 1e6},
+			"RMAP CRC %6d B: %8.1f MB/s (NumPy %s)" % (size, rate * size / 1e6, "used" if numpy else "not used"))
+
+def bench_socket(target, duration):
+	"""
+	End-to-end Socket.read and Socket.write rates and latencies against an emulated target, across payload
+	sizes, word widths and thread counts. Each thread has its own socket and waits for each reply.
+	"""
+	engine = RMAP.Engine(SpaceWire.Interface(target.host, target.port))
+	engine.start()
+	
+	for word_width in (1, 4):
+		dest = RMAP.Destination(src_address=0xfe, dest_address=0x30 + word_width, dest_key=0x02, crc=RMAP.CRC_DraftF, word_width=word_width)
+		for size in (4, 256, 4096, 65536):
+			for threads in (1, 4):
+				for operation in ('read', 'write'):
+					latencies = [ [] for i in range(threads) ]
+					
+					def worker(index):
+						sock = engine.socket(dest, format='bytes')
+						address = index * 0x20000
+						data = '\xa5' * size
+						stime = time.time()
+						while time.time() - stime < duration:
+							ctime = time.time()
+							if operation == 'read':
+								sock.read(address, size / word_width)
+							else:
+								sock.write(address, data)
+							latencies[index].append(time.time() - ctime)
+					
+					pool = [ threading.Thread(target=worker, args=(index, )) for index in range(threads) ]
+					stime = time.time()
+					map(lambda thread: thread.start(), pool)
+					map(lambda thread: thread.join(), pool)
+					etime = time.time()
+					
+					values = sorted(sum(latencies, []))
+					rate = len(values) / (etime - stime)
+					metrics = {'transactions_per_s': rate, 'mb_per_s': rate * size / 1e6,
+							'latency_p50_us': percentile(values, 50) * 1e6, 'latency_p90_us': percentile(values, 90) * 1e6,
+							'latency_p99_us': percentile(values, 99) * 1e6}
+					record('socket_' + operation, {'size': size, 'word_width': word_width, 'threads': threads}, metrics,
+						"Socket.%-5s %5d B width %d, %d thread(s): %8.0f /s %8.1f MB/s, latency p50 %7.0f us p99 %7.0f us" %
+						(operation, size, word_width, threads, rate, metrics['mb_per_s'], metrics['latency_p50_us'], metrics['latency_p99_us']))
+	
+	engine.stop()
+	engine.spwif.close()
+
+def execute(argv):
+	"""
+	Run Benchmarks
+	"""
+	parser = argparse.ArgumentParser(description='PySpW benchmarks, run against an in-process emulated RMAP target.')
+	parser.add_argument('--json', metavar='FILE', help='write results to FILE as JSON')
+	parser.add_argument('--duration', type=float, default=1.0, help='seconds per end-to-end benchmark (default: 1)')
+	args = parser.parse_args(argv)
+	
+	bench_decoder()
+	bench_encoder()
+	bench_packetize()
+	bench_depacketize()
+	bench_crc()
+	
+	target = Emulator.Target()
+	target.start()
+	bench_socket(target, args.duration)
+	target.stop()
+	
+	if args.json:
+		report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+				'platform': platform.platform(), 'numpy': RMAP.numpy.__version__ if RMAP.numpy else None,
+				'results': results}
+		with open(args.json, 'w') as f:
+			json.dump(report, f, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+	execute(sys.argv[1:])
@@ -33,16 +33,12 @@ def execute():
 
 	# Start Tester
 	stime = time.time()
-	caddr = saddr
-	while caddr < saddr + size:
-		length = min(mlength, saddr + size - caddr)
-		rdata = tuple([ random.randint(0, 255) for i in range(length) ])
-		print "Writing %d byte data to 0x%08X to 0x%08X" % (length, caddr, caddr + length)
-		sock.write(caddr, rdata, verify=1)
-		print "Reading %d byte data from 0x%08X to 0x%08X" % (length, caddr, caddr + length)
-		data = sock.read(caddr, length)
-		assert rdata == data
-		caddr += length
+	rdata = bytearray([ random.randint(0, 255) for i in range(size) ])
+	print "Writing %d byte data to 0x%08X to 0x%08X" % (size, saddr, saddr + size)
+	sock.write_region(saddr, rdata, chunk=mlength, verify=1)
+	print "Reading %d byte data from 0x%08X to 0x%08X" % (size, saddr, saddr + size)
+	data = sock.read_region(saddr, size, chunk=mlength)
+	assert rdata == data
 	etime = time.time()
 	
 	# Closing interfaces
@@ -0,0 +1,374 @@
+#
+# Capture.py
+# SSDTP2 Traffic Capture Module
+#
+# Replay captures with: python -m pyspw.Capture --help
+#
+
+import struct
+import threading
+import collections
+import mmap
+import os
+import select
+import socket
+import time
+import sys
+
+from pyspw import SpaceWire as sw
+from pyspw import RMAP
+
+# Capture file header: magic, version, reserved, and wall clock time of the capture start (Little-Endian)
+Capture_Magic = 'PSWC'
+Capture_Version = 1
+File_Header = struct.Struct('<4sHHd')
+
+# Record header: nanoseconds since the capture start, direction, SSDTP2 flag and payload length (Little-Endian)
+Record_Header = struct.Struct('<QBcI')
+
+# Directions
+Direction_Sent = 0
+Direction_Received = 1
+
+class Writer(threading.Thread):
+	"""
+	Capture Writer
+	Tees SSDTP2 frames to a capture file. Frames are only timestamped and queued by the caller, and written
+	through a large buffer by the writer thread, so that capturing never blocks on the file.
+	
+	Give an instance as capture keyword to SpaceWire.Interface to capture everything it and the RMAP
+	engine using it send and receive.
+	"""
+	def __init__(self, path, buffering=1048576, interval=0.01, max_pending=65536):
+		"""
+		Create Capture Writer. The file is created here, and the thread started.
+		
+		Parameters
+		----------
+			path:			capture file, overwritten if existing
+			buffering:		bytes of the file buffer (Default: 1 MB)
+			interval:		seconds between writes of queued frames (Default: 0.01)
+			max_pending:	batches of frames queued before further frames are dropped (Default: 65536)
+		"""
+		threading.Thread.__init__(self)
+		self.setDaemon(True)
+		
+		self.path = path
+		self.interval = interval
+		self.max_pending = max_pending
+		
+		self.start_time = time.time()
+		self.file = open(path, 'wb', buffering)
+		self.file.write(File_Header.pack(Capture_Magic, Capture_Version, 0, self.start_time))
+		
+		# Batches of (time, direction, frames) queued. deque appends need no lock.
+		self.pending = collections.deque()
+		self.running = True
+		
+		# Frames written and dropped, and timestamp last written
+		self.records = 0
+		self.dropped = 0
+		self.last = 0
+		
+		self.start()
+	
+	def sent(self, frames):
+		"""
+		Capture frames sent.
+		
+		Parameter
+		---------
+			frames:		list of (flag, payload)
+		"""
+		if len(self.pending) < self.max_pending:
+			self.pending.append((time.time(), Direction_Sent, frames))
+		else:
+			self.dropped += len(frames)
+	
+	def received(self, frames):
+		"""
+		Capture frames received.
+		
+		Parameter
+		---------
+			frames:		list of (flag, payload) as returned by SpaceWire.Decoder
+		"""
+		if len(self.pending) < self.max_pending:
+			self.pending.append((time.time(), Direction_Received, frames))
+		else:
+			self.dropped += len(frames)
+	
+	def run(self):
+		pending = self.pending
+		pack = Record_Header.pack
+		write = self.file.write
+		
+		while True:
+			running = self.running
+			while pending:
+				(ctime, direction, frames) = pending.popleft()
+				
+				# Timestamps never go back, even if batches of threads are queued out of order
+				timestamp = max(self.last, int((ctime - self.start_time) * 1e9))
+				self.last = timestamp
+				for (flag, payload) in frames:
+					write(pack(timestamp, direction, flag, len(payload)))
+					write(payload)
+				self.records += len(frames)
+			
+			if not running:
+				break
+			time.sleep(self.interval)
+		
+		self.file.close()
+	
+	def close(self):
+		"""
+		Write frames queued and close the capture file.
+		"""
+		self.running = False
+		self.join()
+
+class Reader(object):
+	"""
+	Capture Reader
+	Iterates records of a capture file, mapped into memory.
+	"""
+	def __init__(self, path):
+		"""
+		Open Capture File
+		
+		Parameter
+		---------
+			path:		capture file
+		"""
+		self.path = path
+		self.file = open(path, 'rb')
+		size = os.path.getsize(path)
+		assert size >= File_Header.size, "%s is not a capture file." % (path)
+		self.memory = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+		
+		(magic, version, reserved, self.start_time) = File_Header.unpack_from(self.memory)
+		assert magic == Capture_Magic, "%s is not a capture file." % (path)
+		assert version == Capture_Version, "capture file version %d is not supported." % (version)
+	
+	def __iter__(self):
+		"""
+		Iterate records as (seconds since the capture start, direction, flag, payload). A record cut short
+		by a capture not closed ends the iteration.
+		"""
+		memory = self.memory
+		size = len(memory)
+		unpack_from = Record_Header.unpack_from
+		
+		offset = File_Header.size
+		while offset + Record_Header.size <= size:
+			(timestamp, direction, flag, length) = unpack_from(memory, offset)
+			offset += Record_Header.size
+			if offset + length > size:
+				break
+			yield (timestamp / 1e9, direction, flag, memory[offset:offset + length])
+			offset += length
+	
+	def close(self):
+		self.memory.close()
+		self.file.close()
+
+def decode(path, format='bytes', chunk=65536, repeat=1):
+	"""
+	Feed the frames received in a capture back through SpaceWire.Decoder and RMAP.depacketize as fast as
+	possible, as the Transceiver does, to benchmark the receive path on recorded traffic.
+	
+	Parameters
+	----------
+		path:		capture file
+		format:		read data format, one of RMAP.Data_Formats (Default: 'bytes')
+		chunk:		bytes fed to the decoder at once (Default: 65536)
+		repeat:		passes over the stream, the best one being reported (Default: 1)
+	
+	Returns
+	-------
+		result:		dictionary of frames, replies, malformed (replies failing to depacketize), bytes,
+					seconds and mb_per_s of the best pass
+	"""
+	reader = Reader(path)
+	stream = ''.join(sw.frame(flag, payload) for (ctime, direction, flag, payload) in reader if direction == Direction_Received)
+	reader.close()
+	chunks = [ buffer(stream, offset, chunk) for offset in xrange(0, len(stream), chunk) ]
+	
+	best = None
+	for i in range(repeat):
+		decoder = sw.Decoder()
+		frames = replies = malformed = 0
+		stime = time.time()
+		for data in chunks:
+			for (flag, payload) in decoder.feed(data):
+				frames += 1
+				if flag != sw.DataFlag_Complete_EOP:
+					continue
+				try:
+					RMAP.depacketize(payload, format=format)
+					replies += 1
+				except (struct.error, AssertionError, IndexError):
+					malformed += 1
+		seconds = time.time() - stime
+		if best is None or seconds < best['seconds']:
+			best = {'frames': frames, 'replies': replies, 'malformed': malformed, 'bytes': len(stream),
+					'seconds': seconds, 'mb_per_s': len(stream) / max(seconds, 1e-9) / 1e6}
+	
+	return best
+
+def replay(path, host='127.0.0.1', port=10030, paced=False, speed=1.0, format='bytes', idle=1.0):
+	"""
+	Send the frames sent in a capture to a target, e.g. an Emulator.Target, and depacketize its replies.
+	
+	Parameters
+	----------
+		path:		capture file
+		host:		target host (Default: '127.0.0.1')
+		port:		target port (Default: 10030)
+		paced:		True to send frames at their recorded times, False as fast as possible (Default: False)
+		speed:		factor speeding up recorded times when paced (Default: 1.0)
+		format:		read data format, one of RMAP.Data_Formats (Default: 'bytes')
+		idle:		seconds to wait for further replies after the last one (Default: 1.0)
+	
+	Returns
+	-------
+		result:		dictionary of frames_sent, bytes_sent, replies, expected (replies in the capture),
+					malformed, bytes_received, seconds (from the first frame sent to the last reply) and
+					mb_per_s (received)
+	
+	Note
+	----
+	* Commands are sent as captured, with their transaction ids.
+	* Replaying ends when as many replies as captured have been received, or after idle seconds without any.
+	"""
+	reader = Reader(path)
+	records = []
+	expected = 0
+	for (ctime, direction, flag, payload) in reader:
+		if direction == Direction_Sent:
+			records.append((ctime, flag, payload))
+		elif flag in (sw.DataFlag_Complete_EOP, sw.DataFlag_Complete_EEP):
+			expected += 1
+	reader.close()
+	origin = records[0][0] if records else 0.0
+	
+	sock = socket.create_connection((host, port))
+	sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+	sock.setblocking(0)
+	encoder = sw.Encoder()
+	decoder = sw.Decoder()
+	
+	result = {'frames_sent': 0, 'bytes_sent': 0, 'replies': 0, 'expected': expected, 'malformed': 0, 'bytes_received': 0}
+	index = 0
+	stime = etime = last = time.time()
+	try:
+		while True:
+			now = time.time()
+			
+			# Queue frames due
+			while index < len(records) and (not paced or stime + (records[index][0] - origin) / speed <= now):
+				(ctime, flag, payload) = records[index]
+				encoder.put(payload, flag)
+				result['frames_sent'] += 1
+				result['bytes_sent'] += len(payload)
+				index += 1
+				if not paced and len(encoder) >= 1048576:
+					break
+			
+			if index == len(records) and not encoder and (result['replies'] >= expected or now - last >= idle):
+				break
+			
+			if index < len(records) and paced:
+				timeout = max(0.0, stime + (records[index][0] - origin) / speed - now)
+			elif index < len(records):
+				timeout = 0.0
+			else:
+				timeout = max(0.0, last + idle - now)
+			
+			r, w, e = select.select([ sock ], [ sock ] if encoder else [], [], timeout)
+			
+			if w:
+				encoder.flush(sock)
+			
+			if r:
+				size = sock.recv_into(decoder.reserve(65536))
+				if not size:
+					break
+				result['bytes_received'] += size
+				for (flag, payload) in decoder.commit(size):
+					if flag not in (sw.DataFlag_Complete_EOP, sw.DataFlag_Complete_EEP):
+						continue
+					try:
+						RMAP.depacketize(payload, format=format)
+						result['replies'] += 1
+					except (struct.error, AssertionError, IndexError):
+						result['malformed'] += 1
+				last = etime = time.time()
+	finally:
+		sock.close()
+	
+	result['seconds'] = etime - stime
+	result['mb_per_s'] = result['bytes_received'] / max(etime - stime, 1e-9) / 1e6
+	
+	return result
+
+def execute(argv):
+	"""
+	Command Line Interface
+	
+	Usage
+	-----
+		python -m pyspw.Capture info FILE
+		python -m pyspw.Capture decode FILE [options]
+		python -m pyspw.Capture replay FILE [options]
+	"""
+	import argparse
+	
+	parser = argparse.ArgumentParser(prog='python -m pyspw.Capture', description='SSDTP2 capture tools.')
+	commands = parser.add_subparsers(dest='command')
+	
+	info_parser = commands.add_parser('info', help='summarize a capture')
+	info_parser.add_argument('path', help='capture file')
+	
+	decode_parser = commands.add_parser('decode', help='decode and depacketize received frames as fast as possible')
+	decode_parser.add_argument('path', help='capture file')
+	decode_parser.add_argument('--format', default='bytes', choices=RMAP.Data_Formats, help='read data format (default: bytes)')
+	decode_parser.add_argument('--repeat', type=int, default=5, help='passes, the best one being reported (default: 5)')
+	
+	replay_parser = commands.add_parser('replay', help='send captured frames to a target and depacketize its replies')
+	replay_parser.add_argument('path', help='capture file')
+	replay_parser.add_argument('--host', default='127.0.0.1', help='target host (default: 127.0.0.1)')
+	replay_parser.add_argument('--port', type=int, default=10030, help='target port (default: 10030)')
+	replay_parser.add_argument('--paced', action='store_true', help='send frames at their recorded times')
+	replay_parser.add_argument('--speed', type=float, default=1.0, help='factor speeding up recorded times (default: 1)')
+	replay_parser.add_argument('--format', default='bytes', choices=RMAP.Data_Formats, help='read data format (default: bytes)')
+	args = parser.parse_args(argv)
+	
+	if args.command == 'info':
+		reader = Reader(args.path)
+		counts = collections.defaultdict(lambda: [ 0, 0 ])
+		duration = 0.0
+		for (ctime, direction, flag, payload) in reader:
+			counts[(direction, flag)][0] += 1
+			counts[(direction, flag)][1] += len(payload)
+			duration = ctime
+		print "Captured %s, %.3f s" % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(reader.start_time)), duration)
+		for ((direction, flag), (frames, size)) in sorted(counts.items()):
+			print "%-8s flag 0x%02x: %8d frames %12d bytes" % (('sent', 'received')[direction], ord(flag), frames, size)
+		reader.close()
+	elif args.command == 'decode':
+		result = decode(args.path, args.format, repeat=args.repeat)
+		print "%d frames, %d replies (%d malformed), %d bytes in %.3f s: %.1f MB/s" % (result['frames'],
+			result['replies'], result['malformed'], result['bytes'], result['seconds'], result['mb_per_s'])
+	else:
+		result = replay(args.path, args.host, args.port, args.paced, args.speed, args.format)
+		print "%d frames sent, %d of %d replies (%d malformed), %d bytes received in %.3f s: %.1f MB/s" % (
+			result['frames_sent'], result['replies'], result['expected'], result['malformed'],
+			result['bytes_received'], result['seconds'], result['mb_per_s'])
+	
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(execute(sys.argv[1:]))
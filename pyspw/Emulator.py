@@ -0,0 +1,495 @@
+#
+# Emulator.py
+# SpaceWire RMAP Target Emulator Module
+#
+# Run as a standalone server with: python -m pyspw.Emulator --help
+#
+
+import socket
+import select
+import struct
+import threading
+import heapq
+import random
+import mmap
+import os
+import time
+import sys
+
+from pyspw import SpaceWire as sw
+from pyspw import RMAP
+
+# RMAP reply status codes (see RMAP.Error_Description)
+(Status_Success, Status_Unused_Command, Status_Invalid_Key, Status_Invalid_Data_CRC, Status_Early_EOP,
+	Status_Cargo_Too_Large, Status_EEP, Status_Not_Authorised) = (0, 2, 3, 4, 5, 6, 7, 10)
+
+# SpaceWire Tx clock divided by (divider + 1) gives the link bit rate
+SpaceWire_Clock = 125e6
+
+class Target(threading.Thread):
+	"""
+	RMAP Target
+	SSDTP2 server answering RMAP read and write commands against an emulated memory, to run RMAP engines
+	without hardware. Runs in-process, or standalone with python -m pyspw.Emulator.
+	
+	Each connection is served by its own thread. Tx clock divider changes are followed when wire speed is
+	emulated, converter register accesses are answered from a register dictionary, and time codes sent are
+	accepted and ignored.
+	
+	Link characteristics can be emulated per connection: wire speed derived from the Tx clock divider,
+	latency, dropped and EEP-terminated packets, and reordered replies. Replies are then sent by a
+	scheduler thread of the connection when due, without a thread per packet. The scheduler also sends
+	periodic time codes if asked to, as a time master does.
+	"""
+	# Sub-class definitions
+	class Scheduler(threading.Thread):
+		"""
+		Reply Scheduler
+		Sends replies of a connection when they are due, and time codes every period seconds if given.
+		"""
+		def __init__(self, conn, period=None):
+			threading.Thread.__init__(self)
+			self.setDaemon(True)
+			self.conn = conn
+			self.period = period
+			self.queue = []
+			self.sequence = 0
+			self.running = True
+			self.lock = threading.Lock()
+			
+			# Wakes the scheduler waiting in select() for the earliest reply, which is precise unlike waiting
+			# on a condition with a timeout
+			self.waker = RMAP.Engine.Waker()
+		
+		def put(self, due, packet, flag):
+			"""
+			Schedule a reply.
+			
+			Parameters
+			----------
+				due:		time to send the reply at
+				packet:		reply packet
+				flag:		SSDTP2 flag of the reply
+			"""
+			self.lock.acquire()
+			heapq.heappush(self.queue, (due, self.sequence, packet, flag))
+			earliest = self.queue[0][1] == self.sequence
+			self.sequence += 1
+			self.lock.release()
+			
+			if earliest:
+				self.waker.wake()
+		
+		def run(self):
+			encoder = sw.Encoder()
+			try:
+				while True:
+					self.lock.acquire()
+					if not self.running:
+						self.lock.release()
+						break
+					
+					# Send all replies due
+					now = time.time()
+					while self.queue and self.queue[0][0] <= now:
+						(due, sequence, packet, flag) = heapq.heappop(self.queue)
+						encoder.put(packet, flag)
+						if flag == sw.ControlFlag_GotTimeCode:
+							# Next time code
+							value = chr((ord(packet[0]) + 1) & sw.TimeCode_Value_Mask)
+							heapq.heappush(self.queue, (due + self.period, self.sequence, value + '\x00', flag))
+							self.sequence += 1
+					timeout = self.queue[0][0] - now if self.queue else None
+					self.lock.release()
+					
+					while encoder:
+						encoder.send(self.conn)
+					
+					select.select([ self.waker ], [], [], timeout)
+					self.waker.clear()
+			except socket.error:
+				pass
+			
+			self.waker.close()
+		
+		def stop(self):
+			self.lock.acquire()
+			self.running = False
+			self.lock.release()
+			self.waker.wake()
+	
+	def __init__(self, host='127.0.0.1', port=0, size=0x1000000, crc=RMAP.CRC_DraftF, dest_key=None, word_width=1, **kwargs):
+		"""
+		Create RMAP Target. The port is bound here, so that connections can be made right after start().
+		
+		Parameters
+		----------
+			host:		address to listen on (Default: '127.0.0.1')
+			port:		port to listen on, 0 for any free port (Default: 0)
+			size:		bytes of emulated memory from address 0 (Default: 16 MB)
+			crc:		CRC revision of replies (Default: RMAP.CRC_DraftF)
+			dest_key:	destination key to accept, None for any (Default: None)
+			word_width:	bytes of the word accessed by non-incremental commands (Default: 1)
+		
+		Keywords (and their default values)
+		-----------------------------------
+			path:		file backing the memory through mmap, extended to size if shorter (default: None, in-memory)
+			wire_speed:	True to take packets the time to cross a link of the bit rate set by the Tx clock
+						divider, 10 bits per byte (default: False)
+			div:		Tx clock divider until changed by the client (default: 11)
+			latency:	seconds added to each reply (default: 0)
+			drop:		probability of losing a command, and of losing a reply (default: 0)
+			eep:		probability of a reply being cut short and terminated with EEP (default: 0)
+			reorder:	probability of a reply being held back, letting later replies overtake it (default: 0)
+			reorder_delay:
+						seconds a held back reply is delayed (default: 0.001)
+			seed:		seed of the random numbers deciding the above (default: None)
+			timecode_period:
+						seconds between time codes sent to each connection, None not to send any (default: None)
+			registers:	dictionary of initial converter register values by address, others reading 0
+						(default: empty)
+		
+		Note
+		----
+		* The bound port is in the port attribute.
+		* Commands out of memory are answered with status 10 (not authorised), and read-modify-write commands
+		  with status 2 (unused command).
+		"""
+		threading.Thread.__init__(self)
+		self.setDaemon(True)
+		
+		self.path = kwargs.get('path')
+		if self.path:
+			self.file = open(self.path, 'r+b' if os.path.exists(self.path) else 'w+b')
+			if os.path.getsize(self.path) < size:
+				self.file.truncate(size)
+			self.memory = mmap.mmap(self.file.fileno(), size)
+		else:
+			self.file = None
+			self.memory = bytearray(size)
+		self.crc = crc
+		self.dest_key = dest_key
+		self.word_width = word_width
+		
+		# Link characteristics
+		self.wire_speed = kwargs.get('wire_speed', False)
+		self.div = kwargs.get('div', 11)
+		self.latency = kwargs.get('latency', 0)
+		self.drop = kwargs.get('drop', 0)
+		self.eep = kwargs.get('eep', 0)
+		self.reorder = kwargs.get('reorder', 0)
+		self.reorder_delay = kwargs.get('reorder_delay', 0.001)
+		self.random = random.Random(kwargs.get('seed'))
+		self.timecode_period = kwargs.get('timecode_period')
+		
+		# Converter registers
+		self.registers = dict(kwargs.get('registers', {}))
+		
+		self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.server.bind((host, port))
+		self.server.listen(8)
+		(self.host, self.port) = self.server.getsockname()
+		
+		self.running = True
+		self.connections = []
+		self.lock = threading.Lock()
+		
+		# Commands executed
+		self.commands = 0
+	
+	def shaped(self):
+		"""
+		Return True if any link characteristic is emulated.
+		"""
+		return bool(self.wire_speed or self.latency or self.drop or self.eep or self.reorder)
+	
+	def run(self):
+		while self.running:
+			r, w, e = select.select([ self.server ], [], [], 0.1)
+			if not r:
+				continue
+			try:
+				(conn, address) = self.server.accept()
+			except socket.error:
+				continue
+			conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			
+			self.lock.acquire()
+			self.connections.append(conn)
+			self.lock.release()
+			
+			thread = threading.Thread(target=self.serve, args=(conn, ))
+			thread.setDaemon(True)
+			thread.start()
+		
+		self.server.close()
+	
+	def stop(self):
+		"""
+		Stop accepting connections and close connections being served.
+		"""
+		self.running = False
+		self.join()
+		
+		self.lock.acquire()
+		for conn in self.connections:
+			try:
+				conn.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+			conn.close()
+		self.connections = []
+		self.lock.release()
+		
+		if self.file:
+			self.memory.flush()
+	
+	def serve(self, conn):
+		"""
+		Answer commands received on a connection until it is closed.
+		"""
+		decoder = sw.Decoder()
+		encoder = sw.Encoder()
+		
+		# Reply scheduler, and link state: Tx clock divider and times the receiving and sending wires are free
+		scheduler = None
+		if self.shaped() or self.timecode_period:
+			scheduler = self.Scheduler(conn, self.timecode_period)
+			scheduler.start()
+			if self.timecode_period:
+				scheduler.put(time.time() + self.timecode_period, '\x00\x00', sw.ControlFlag_GotTimeCode)
+		div = self.div
+		rx_free = tx_free = 0.0
+		
+		try:
+			while True:
+				size = conn.recv_into(decoder.reserve(65536))
+				if not size:
+					break
+				now = time.time()
+				
+				for (flag, payload) in decoder.commit(size):
+					if flag == sw.ControlFlag_ChangeTxSpeed:
+						div = ord(payload[0]) if payload else div
+						continue
+					if flag in (sw.ControlFlag_RegisterAccess_ReadCommand, sw.ControlFlag_RegisterAccess_WriteCommand):
+						(reply_flag, reply) = self.register_access(flag, payload)
+						if scheduler is None:
+							encoder.put(reply, reply_flag)
+						else:
+							scheduler.put(now, reply, reply_flag)
+						continue
+					if flag not in (sw.DataFlag_Complete_EOP, sw.DataFlag_Complete_EEP):
+						# Other control frames
+						continue
+					
+					if scheduler is None:
+						reply = self.execute(payload, flag == sw.DataFlag_Complete_EEP)
+						if reply is not None:
+							encoder.put(reply)
+						continue
+					
+					# Command crossing the wire, possibly lost
+					rate = SpaceWire_Clock / (div + 1)
+					if self.wire_speed:
+						rx_free = max(rx_free, now) + (len(payload) * 10 + 4) / rate
+					else:
+						rx_free = now
+					if self.drop and self.random.random() < self.drop:
+						continue
+					
+					reply = self.execute(payload, flag == sw.DataFlag_Complete_EEP)
+					if reply is None or (self.drop and self.random.random() < self.drop):
+						continue
+					
+					reply_flag = sw.DataFlag_Complete_EOP
+					if self.eep and self.random.random() < self.eep:
+						reply = reply[:self.random.randrange(len(reply))]
+						reply_flag = sw.DataFlag_Complete_EEP
+					
+					# Reply crossing the wire after latency, unless held back
+					wire = (len(reply) * 10 + 4) / rate if self.wire_speed else 0.0
+					ready = rx_free + self.latency
+					if self.reorder and self.random.random() < self.reorder:
+						due = ready + self.reorder_delay + wire
+					else:
+						due = tx_free = max(ready, tx_free) + wire
+					scheduler.put(due, reply, reply_flag)
+				
+				# Replies to all commands received together are sent together
+				while encoder:
+					encoder.send(conn)
+				if decoder.error:
+					raise decoder.error
+				
+				# Commands take the wire time to arrive, so receive no faster, holding the client back
+				delay = rx_free - time.time()
+				if self.wire_speed and delay > 0:
+					time.sleep(delay)
+		
+		except (socket.error, sw.ProtocolError):
+			# Connection lost, or client not talking SSDTP2
+			pass
+		
+		finally:
+			if scheduler:
+				scheduler.stop()
+			self.lock.acquire()
+			if conn in self.connections:
+				self.connections.remove(conn)
+			self.lock.release()
+			conn.close()
+	
+	def register_access(self, flag, payload):
+		"""
+		Execute a converter register access.
+		
+		Parameters
+		----------
+			flag:		ControlFlag_RegisterAccess_ReadCommand or ControlFlag_RegisterAccess_WriteCommand
+			payload:	register address, and value for writes
+		
+		Returns
+		-------
+			flag:		SSDTP2 flag of the reply
+			reply:		register address and value
+		"""
+		if flag == sw.ControlFlag_RegisterAccess_WriteCommand:
+			(address, value) = sw.Register_Access.unpack_from(payload)
+			self.registers[address] = value
+			flag = sw.ControlFlag_RegisterAccess_WriteReply
+		else:
+			(address, ) = sw.Register_Address.unpack_from(payload)
+			flag = sw.ControlFlag_RegisterAccess_ReadReply
+		
+		return (flag, sw.Register_Access.pack(address, self.registers.get(address, 0)))
+	
+	def execute(self, packet, eep=False):
+		"""
+		Execute an RMAP command.
+		
+		Parameters
+		----------
+			packet:		RMAP command packet (starting with the target logical address)
+			eep:		True if the packet ended with EEP
+		
+		Returns
+		-------
+			reply:		RMAP reply packet, or None if no reply is sent
+		"""
+		if len(packet) < 16 or ord(packet[1]) != 0x01:
+			# Not an RMAP command
+			return None
+		
+		dest_address = ord(packet[0])
+		com = ord(packet[2])
+		key = ord(packet[3])
+		
+		# Reply address of 0, 4, 8 or 12 bytes, leading zeros being padding
+		path = packet[4:4 + 4 * (com & 0x03)].lstrip('\x00')
+		header = packet[4 + 4 * (com & 0x03):]
+		if len(header) < 12:
+			return None
+		(src_address, tid, extended_address, address, length_upper, length_lower) = struct.unpack('>BHBLBH', header[:11])
+		length = (length_upper << 16) + length_lower
+		
+		write = bool(com & 0x20)
+		ack = bool(com & 0x08)
+		increment = bool(com & 0x04)
+		extent = length if increment else min(length, self.word_width)
+		
+		status = Status_Success
+		data = ''
+		if not com & 0x40 or not (write or (com & 0x18) == 0x08):
+			# Not a command, or a read-modify-write or other read with verification or without acknowledgement
+			status = Status_Unused_Command
+		elif self.dest_key is not None and key != self.dest_key:
+			status = Status_Invalid_Key
+		elif address + extent > len(self.memory):
+			status = Status_Not_Authorised
+		elif write:
+			data = header[12:12 + length]
+			if eep:
+				status = Status_EEP
+			elif len(header) < 13 + length:
+				status = Status_Early_EOP
+			elif len(header) > 13 + length:
+				status = Status_Cargo_Too_Large
+			elif ord(header[12 + length]) != RMAP.calc_crc(self.crc, data):
+				status = Status_Invalid_Data_CRC
+			else:
+				# Non-incremental writes leave the last word
+				self.memory[address:address + extent] = data[-extent:] if extent else ''
+			data = ''
+		elif increment:
+			data = str(self.memory[address:address + length])
+		else:
+			# Non-incremental reads repeat the word at address
+			data = (str(self.memory[address:address + extent]) * (length / max(1, extent) + 1))[:length]
+		
+		self.commands += 1
+		
+		if write and not ack:
+			return None
+		
+		# Reply: command field with the command bit cleared
+		reply = struct.pack('>BBBBBH', src_address, 0x01, com & 0x3f, status, dest_address, tid)
+		if write:
+			reply += chr(RMAP.calc_crc(self.crc, reply))
+		else:
+			reply += struct.pack('>BBH', 0, len(data) >> 16, len(data) & 0xffff)
+			reply += chr(RMAP.calc_crc(self.crc, reply))
+			reply += data + chr(RMAP.calc_crc(self.crc, data))
+		
+		return path + reply
+
+def execute(argv):
+	"""
+	Command Line Interface
+	
+	Usage
+	-----
+		python -m pyspw.Emulator [options]
+	"""
+	import argparse
+	
+	def number(text):
+		return int(text, 0)
+	
+	parser = argparse.ArgumentParser(prog='python -m pyspw.Emulator', description='SSDTP2 RMAP target emulator.')
+	parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+	parser.add_argument('--port', type=int, default=10030, help='port to listen on (default: 10030)')
+	parser.add_argument('--size', type=number, default=0x1000000, help='bytes of memory (default: 16 MB)')
+	parser.add_argument('--path', help='file backing the memory through mmap (default: in-memory)')
+	parser.add_argument('--crc', choices=('DraftE', 'DraftF'), default='DraftF', help='RMAP CRC revision (default: DraftF)')
+	parser.add_argument('--dest-key', type=number, help='destination key to accept (default: any)')
+	parser.add_argument('--word-width', type=int, default=1, help='word width of non-incremental commands (default: 1)')
+	parser.add_argument('--wire-speed', action='store_true', help='emulate the bit rate set by the Tx clock divider')
+	parser.add_argument('--div', type=int, default=11, help='Tx clock divider until set by the client (default: 11)')
+	parser.add_argument('--latency', type=float, default=0, help='seconds added to each reply (default: 0)')
+	parser.add_argument('--drop', type=float, default=0, help='probability of losing a packet (default: 0)')
+	parser.add_argument('--eep', type=float, default=0, help='probability of a reply cut short with EEP (default: 0)')
+	parser.add_argument('--reorder', type=float, default=0, help='probability of a reply being held back (default: 0)')
+	parser.add_argument('--reorder-delay', type=float, default=0.001, help='seconds a held back reply is delayed (default: 0.001)')
+	parser.add_argument('--seed', type=int, help='random seed')
+	parser.add_argument('--timecode-period', type=float, help='seconds between time codes sent (default: none sent)')
+	args = parser.parse_args(argv)
+	
+	target = Target(args.host, args.port, args.size, RMAP.CRC_DraftE if args.crc == 'DraftE' else RMAP.CRC_DraftF,
+					args.dest_key, args.word_width, path=args.path, wire_speed=args.wire_speed, div=args.div,
+					latency=args.latency, drop=args.drop, eep=args.eep, reorder=args.reorder,
+					reorder_delay=args.reorder_delay, seed=args.seed, timecode_period=args.timecode_period)
+	target.start()
+	print "Listening on %s:%d" % (target.host, target.port)
+	
+	try:
+		while target.is_alive():
+			target.join(1)
+	except KeyboardInterrupt:
+		target.stop()
+	
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(execute(sys.argv[1:]))
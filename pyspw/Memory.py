@@ -0,0 +1,611 @@
+#
+# Memory.py
+# Remote Memory Module
+#
+
+import collections
+import mmap
+import os
+import struct
+import zlib
+import sys
+
+class RemoteMemory(object):
+	"""
+	Remote Memory
+	Sliceable view of target memory accessed through an RMAP socket, with a write-back page cache.
+	
+	Reading fetches missing pages, merging adjacent ones into single RMAP reads. Writing updates cached pages
+	and marks them dirty. Dirty pages are written back, adjacent ones merged into single RMAP writes, by
+	flush() or when evicted from the cache.
+	"""
+	def __init__(self, sock, base, size, page_size=4096, pages=256, burst=65536, window=8, **kwargs):
+		"""
+		Create Remote Memory
+		
+		Parameters
+		----------
+			sock:		RMAP socket (RMAP.Socket instance of RMAP.Engine or RMAP.MultiEngine)
+			base:		target address of offset 0
+			size:		bytes of memory
+			page_size:	bytes per cache page (Default: 4096)
+			pages:		pages to keep in cache, least recently used ones being evicted (Default: 256)
+			burst:		maximum bytes per RMAP transaction when merging pages (Default: 65536)
+			window:		RMAP transactions kept in flight (Default: 8)
+		
+		Keywords
+		--------
+			Passed to RMAP reads and writes, e.g. extended_address or verify.
+		
+		Note
+		----
+		* base, size, page_size and burst must be multiples of the word width of the socket.
+		* Writes are not seen by the target before flush(). Use the instance as a context manager to flush
+		  when leaving the block.
+		"""
+		width = sock.dest.word_width
+		assert base % width == 0 and size % width == 0, "region is not aligned to word width %d." % (width)
+		assert page_size % width == 0 and burst % width == 0, "page size and burst are not multiples of word width %d." % (width)
+		assert page_size <= burst, "page size is larger than burst."
+		
+		self.sock = sock
+		self.base = base
+		self.size = size
+		self.page_size = page_size
+		self.pages = pages
+		self.burst = burst
+		self.window = window
+		self.kwargs = kwargs
+		
+		# Cached pages (bytearray) by page number, in order of use, and dirty page numbers
+		self.cache = collections.OrderedDict()
+		self.dirty = set()
+		
+		# Statistics
+		self.hits = 0
+		self.misses = 0
+	
+	def __len__(self):
+		return self.size
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, type, value, traceback):
+		self.flush()
+	
+	def __getitem__(self, key):
+		"""
+		Read a byte (int) or a slice (bytearray).
+		"""
+		if isinstance(key, slice):
+			(start, stop, step) = key.indices(self.size)
+			if step != 1:
+				raise IndexError("remote memory supports contiguous slices only.")
+			return self.read(start, max(0, stop - start))
+		
+		index = self.index(key)
+		return self.read(index, 1)[0]
+	
+	def __setitem__(self, key, value):
+		"""
+		Write a byte (int) or a slice (bytes of the same length).
+		"""
+		if isinstance(key, slice):
+			(start, stop, step) = key.indices(self.size)
+			if step != 1:
+				raise IndexError("remote memory supports contiguous slices only.")
+			data = bytearray(value)
+			if len(data) != max(0, stop - start):
+				raise ValueError("remote memory cannot be resized.")
+			self.write(start, data)
+		else:
+			self.write(self.index(key), bytearray([ value ]))
+	
+	def index(self, key):
+		"""
+		Return offset of an index, counting negative indices from the end.
+		"""
+		index = key + self.size if key < 0 else key
+		if not 0 <= index < self.size:
+			raise IndexError("remote memory index out of range.")
+		
+		return index
+	
+	def read(self, offset, size):
+		"""
+		Read bytes.
+		
+		Parameters
+		----------
+			offset:		offset to read from
+			size:		bytes to read
+		
+		Returns
+		-------
+			data:		read bytes (bytearray)
+		"""
+		assert 0 <= offset and offset + size <= self.size, "read out of remote memory."
+		data = bytearray(size)
+		if not size:
+			return data
+		
+		page_size = self.page_size
+		numbers = xrange(offset / page_size, (offset + size - 1) / page_size + 1)
+		fetched = self.fetch([ number for number in numbers if number not in self.cache ])
+		
+		for number in numbers:
+			page = fetched.get(number)
+			if page is None:
+				page = self.touch(number)
+			
+			# Copy overlap of page and requested range
+			start = max(offset, number * page_size)
+			end = min(offset + size, (number + 1) * page_size)
+			data[start - offset:end - offset] = page[start - number * page_size:end - number * page_size]
+		
+		self.store(fetched, False)
+		
+		return data
+	
+	def write(self, offset, data):
+		"""
+		Write bytes. Written pages are sent to the target by flush() or when evicted.
+		
+		Parameters
+		----------
+			offset:		offset to write to
+			data:		bytes to write (str, bytearray or sequence of ints)
+		"""
+		data = bytearray(data)
+		size = len(data)
+		assert 0 <= offset and offset + size <= self.size, "write out of remote memory."
+		if not size:
+			return
+		
+		page_size = self.page_size
+		numbers = xrange(offset / page_size, (offset + size - 1) / page_size + 1)
+		
+		# Pages not wholly overwritten need their current contents
+		partial = [ number for number in (numbers[0], numbers[-1])
+					if number not in self.cache and (offset > number * page_size or offset + size < self.page_end(number)) ]
+		fetched = self.fetch(sorted(set(partial)))
+		
+		written = {}
+		for number in numbers:
+			page = fetched.get(number)
+			if page is None:
+				page = self.touch(number)
+			if page is None:
+				page = bytearray(self.page_end(number) - number * page_size)
+			
+			start = max(offset, number * page_size)
+			end = min(offset + size, (number + 1) * page_size)
+			page[start - number * page_size:end - number * page_size] = data[start - offset:end - offset]
+			written[number] = page
+		
+		self.store(written, True)
+	
+	def flush(self):
+		"""
+		Write dirty pages back to the target.
+		"""
+		if self.dirty:
+			self.write_back(dict( (number, self.cache[number]) for number in self.dirty ))
+			self.dirty.clear()
+	
+	def invalidate(self):
+		"""
+		Write dirty pages back and empty the cache, so that the following reads see the target again.
+		"""
+		self.flush()
+		self.cache.clear()
+	
+	def page_end(self, number):
+		"""
+		Return offset of the end of a page.
+		"""
+		return min(self.size, (number + 1) * self.page_size)
+	
+	def touch(self, number):
+		"""
+		Return a cached page and mark it as most recently used, or None if not cached.
+		"""
+		page = self.cache.pop(number, None)
+		if page is not None:
+			self.cache[number] = page
+			self.hits += 1
+		
+		return page
+	
+	def store(self, pages, dirty):
+		"""
+		Put pages into the cache, evicting the least recently used ones. Dirty evicted pages are written back.
+		
+		Parameters
+		----------
+			pages:		dictionary of pages by page number
+			dirty:		True if the pages are modified
+		"""
+		for number in sorted(pages):
+			self.cache.pop(number, None)
+			self.cache[number] = pages[number]
+			if dirty:
+				self.dirty.add(number)
+		
+		evicted = {}
+		while len(self.cache) > self.pages:
+			(number, page) = self.cache.popitem(last=False)
+			if number in self.dirty:
+				self.dirty.remove(number)
+				evicted[number] = page
+		
+		if evicted:
+			self.write_back(evicted)
+	
+	def runs(self, numbers):
+		"""
+		Group sorted page numbers into runs of adjacent pages of at most burst bytes.
+		
+		Returns
+		-------
+			runs:		list of (first page number, number of pages)
+		"""
+		runs = []
+		limit = self.burst / self.page_size
+		for number in numbers:
+			if runs and runs[-1][0] + runs[-1][1] == number and runs[-1][1] < limit:
+				runs[-1][1] += 1
+			else:
+				runs.append([ number, 1 ])
+		
+		return [ tuple(run) for run in runs ]
+	
+	def fetch(self, numbers):
+		"""
+		Read pages from the target, merging adjacent ones.
+		
+		Parameter
+		---------
+			numbers:	sorted page numbers to read
+		
+		Returns
+		-------
+			pages:		dictionary of pages (bytearray) by page number
+		"""
+		pages = {}
+		if not numbers:
+			return pages
+		self.misses += len(numbers)
+		
+		sock = self.sock
+		page_size = self.page_size
+		width = sock.dest.word_width
+		kwargs = dict(self.kwargs, format='bytes')
+		
+		def submit((first, count)):
+			size = self.page_end(first + count - 1) - first * page_size
+			return sock.read_async(self.base + first * page_size, size / width, **kwargs)
+		
+		for ((first, count), data) in sock.pipeline(self.runs(numbers), submit, self.window):
+			for index in xrange(count):
+				pages[first + index] = bytearray(data[index * page_size:(index + 1) * page_size])
+		
+		return pages
+	
+	def write_back(self, pages):
+		"""
+		Write pages to the target, merging adjacent ones.
+		
+		Parameter
+		---------
+			pages:		dictionary of pages by page number
+		"""
+		sock = self.sock
+		
+		def submit((first, count)):
+			data = ''.join(str(pages[first + index]) for index in xrange(count))
+			return sock.write_async(self.base + first * self.page_size, data, **self.kwargs)
+		
+		for result in sock.pipeline(self.runs(sorted(pages)), submit, self.window):
+			pass
+
+class Progress(object):
+	"""
+	Progress
+	Sidecar file recording which chunks of a transfer are done, one bit per chunk, so that an interrupted
+	transfer resumes with the missing chunks only.
+	"""
+	# Header: magic, address, bytes, chunk bytes
+	Header = struct.Struct('<4sQQI')
+	Magic = 'PSPW'
+	
+	def __init__(self, path, address, nbytes, chunk, reset=False):
+		"""
+		Open Progress, resuming the recorded one if it describes the same transfer
+		
+		Parameters
+		----------
+			path:		sidecar file path
+			address:	start address of the transfer
+			nbytes:		bytes of the transfer
+			chunk:		bytes per chunk
+			reset:		True to start over, discarding the recorded one (Default: False)
+		"""
+		self.path = path
+		self.count = -(-nbytes // chunk)
+		header = Progress.Header.pack(Progress.Magic, address, nbytes, chunk)
+		
+		bitmap = None
+		if os.path.exists(path) and not reset:
+			with open(path, 'rb') as f:
+				recorded = f.read()
+			if recorded[:Progress.Header.size] == header and len(recorded) == Progress.Header.size + (self.count + 7) / 8:
+				bitmap = bytearray(recorded[Progress.Header.size:])
+		
+		if bitmap is None:
+			bitmap = bytearray((self.count + 7) / 8)
+			with open(path, 'wb') as f:
+				f.write(header + str(bitmap))
+		
+		self.bitmap = bitmap
+		self.file = open(path, 'r+b')
+	
+	def __contains__(self, index):
+		return bool(self.bitmap[index >> 3] & (1 << (index & 7)))
+	
+	def missing(self):
+		"""
+		Return indices of chunks not done.
+		"""
+		return [ index for index in xrange(self.count) if index not in self ]
+	
+	def mark(self, index, done=True):
+		"""
+		Record a chunk as done, or as not done.
+		"""
+		if done:
+			self.bitmap[index >> 3] |= 1 << (index & 7)
+		else:
+			self.bitmap[index >> 3] &= ~(1 << (index & 7))
+		self.file.seek(Progress.Header.size + (index >> 3))
+		self.file.write(chr(self.bitmap[index >> 3]))
+	
+	def close(self, remove=False):
+		"""
+		Close sidecar file, and remove it if remove.
+		"""
+		self.file.close()
+		if remove:
+			os.remove(self.path)
+
+def transfer_chunks(indices, nbytes, chunk):
+	"""
+	Return (index, offset, length) of chunks by index.
+	"""
+	return [ (index, index * chunk, min(chunk, nbytes - index * chunk)) for index in indices ]
+
+def dump(sock, address, nbytes, path, chunk=65536, window=8, check=False, progress=None, **kwargs):
+	"""
+	Dump target memory into a file
+	Read data are written straight into the memory-mapped file. Done chunks are recorded in a progress file,
+	and calling again after an interruption reads the missing chunks only.
+	
+	Parameters
+	----------
+		sock:		RMAP socket (RMAP.Socket instance of RMAP.Engine or RMAP.MultiEngine)
+		address:	start address to read
+		nbytes:		bytes to read (multiple of word width)
+		path:		output file path
+		chunk:		bytes per RMAP transaction (Default: 65536)
+		window:		RMAP transactions kept in flight (Default: 8)
+		check:		True to read the memory again and compare chunk checksums with the file (Default: False)
+		progress:	progress file path (Default: path + '.progress')
+	
+	Keywords
+	--------
+		Passed to RMAP reads, e.g. extended_address.
+	
+	Returns
+	-------
+		mismatched:	list of (offset, length) of chunks failing the check
+	
+	Note
+	----
+	* The progress file is removed when all chunks are done and checked. Chunks failing the check are
+	  recorded as not done, so that calling again reads them again.
+	* A progress file is only resumed with an output file of nbytes. Otherwise the output file does not
+	  hold the chunks recorded as done, and everything is read again.
+	"""
+	width = sock.dest.word_width
+	assert nbytes % width == 0 and chunk % width == 0, "region is not aligned to word width %d." % (width)
+	
+	# Chunks recorded as done are only in an output file left by the transfer recorded
+	resume = os.path.exists(path) and os.path.getsize(path) == nbytes
+	
+	mode = 'r+b' if os.path.exists(path) else 'w+b'
+	with open(path, mode) as f:
+		f.truncate(nbytes)
+		if not nbytes:
+			return []
+		
+		buf = mmap.mmap(f.fileno(), nbytes)
+		record = Progress(progress or path + '.progress', address, nbytes, chunk, reset=not resume)
+		try:
+			read_kwargs = dict(kwargs, format='bytes')
+			
+			def submit((index, offset, size)):
+				return sock.read_async(address + offset, size / width, **read_kwargs)
+			
+			for ((index, offset, size), data) in sock.pipeline(transfer_chunks(record.missing(), nbytes, chunk), submit, window):
+				buf[offset:offset + size] = data
+				record.mark(index)
+			buf.flush()
+			
+			mismatched = []
+			if check:
+				mismatched = compare(sock, address, buf, chunk, window, record, **kwargs)
+		
+		finally:
+			buf.close()
+			record.close()
+	
+	if not mismatched:
+		os.remove(record.path)
+	
+	return mismatched
+
+def load(sock, address, path, chunk=65536, window=8, check=False, progress=None, **kwargs):
+	"""
+	Load a file into target memory
+	Written data are taken straight from the memory-mapped file. Done chunks are recorded in a progress file,
+	and calling again after an interruption writes the missing chunks only.
+	
+	Parameters
+	----------
+		sock:		RMAP socket (RMAP.Socket instance of RMAP.Engine or RMAP.MultiEngine)
+		address:	start address to write
+		path:		input file path (length multiple of word width)
+		chunk:		bytes per RMAP transaction (Default: 65536)
+		window:		RMAP transactions kept in flight (Default: 8)
+		check:		True to read the memory back and compare chunk checksums with the file (Default: False)
+		progress:	progress file path (Default: path + '.progress')
+	
+	Keywords
+	--------
+		Passed to RMAP writes and reads, e.g. extended_address or verify.
+	
+	Returns
+	-------
+		mismatched:	list of (offset, length) of chunks failing the check
+	
+	Note
+	----
+	* The progress file is removed when all chunks are done and checked. Chunks failing the check are
+	  recorded as not done, so that calling again writes them again.
+	"""
+	width = sock.dest.word_width
+	nbytes = os.path.getsize(path)
+	assert nbytes % width == 0 and chunk % width == 0, "region is not aligned to word width %d." % (width)
+	if not nbytes:
+		return []
+	
+	with open(path, 'rb') as f:
+		buf = mmap.mmap(f.fileno(), nbytes, access=mmap.ACCESS_READ)
+		record = Progress(progress or path + '.progress', address, nbytes, chunk)
+		try:
+			def submit((index, offset, size)):
+				return sock.write_async(address + offset, buf[offset:offset + size], **kwargs)
+			
+			for ((index, offset, size), result) in sock.pipeline(transfer_chunks(record.missing(), nbytes, chunk), submit, window):
+				record.mark(index)
+			
+			mismatched = []
+			if check:
+				mismatched = compare(sock, address, buf, chunk, window, record, **kwargs)
+		
+		finally:
+			buf.close()
+			record.close()
+	
+	if not mismatched:
+		os.remove(record.path)
+	
+	return mismatched
+
+def compare(sock, address, buf, chunk, window, record=None, **kwargs):
+	"""
+	Compare CRC-32 checksums of target memory chunks with a buffer.
+	
+	Parameters
+	----------
+		sock:		RMAP socket
+		address:	target address of buffer offset 0
+		buf:		buffer to compare with (str, bytearray or mmap)
+		chunk:		bytes per chunk
+		window:		RMAP transactions kept in flight
+		record:		Progress on which mismatched chunks are marked as not done (Default: None)
+	
+	Returns
+	-------
+		mismatched:	list of (offset, length) of mismatched chunks
+	"""
+	width = sock.dest.word_width
+	nbytes = len(buf)
+	kwargs['format'] = 'bytes'
+	
+	def submit((index, offset, size)):
+		return sock.read_async(address + offset, size / width, **kwargs)
+	
+	mismatched = []
+	for ((index, offset, size), data) in sock.pipeline(transfer_chunks(xrange(-(-nbytes // chunk)), nbytes, chunk), submit, window):
+		if zlib.crc32(data) != zlib.crc32(buffer(buf, offset, size)):
+			mismatched.append((offset, size))
+			if record is not None:
+				record.mark(index, False)
+	
+	return mismatched
+
+def execute(argv):
+	"""
+	Command Line Interface
+	
+	Usage
+	-----
+		python -m pyspw.Memory dump [options] HOST ADDRESS BYTES FILE
+		python -m pyspw.Memory load [options] HOST ADDRESS FILE
+	"""
+	import argparse
+	from pyspw import SpaceWire, RMAP
+	
+	def number(text):
+		return int(text, 0)
+	
+	parser = argparse.ArgumentParser(prog='python -m pyspw.Memory', description='Dump target memory into a file, or load a file into target memory, over RMAP.')
+	parser.add_argument('--port', type=int, default=10030, help='SpaceWire-to-GigabitEther port (default: 10030)')
+	parser.add_argument('--dest-address', type=number, default=0x30, help='destination logical address (default: 0x30)')
+	parser.add_argument('--src-address', type=number, default=0xfe, help='source logical address (default: 0xfe)')
+	parser.add_argument('--dest-key', type=number, default=0x02, help='destination key (default: 0x02)')
+	parser.add_argument('--crc', choices=('DraftE', 'DraftF'), default='DraftF', help='RMAP CRC revision (default: DraftF)')
+	parser.add_argument('--word-width', type=int, default=1, help='word width in bytes (default: 1)')
+	parser.add_argument('--extended-address', type=number, default=0x00, help='extended address (default: 0x00)')
+	parser.add_argument('--chunk', type=number, default=65536, help='bytes per RMAP transaction (default: 65536)')
+	parser.add_argument('--window', type=int, default=8, help='RMAP transactions kept in flight (default: 8)')
+	parser.add_argument('--check', action='store_true', help='compare chunk checksums after the transfer')
+	commands = parser.add_subparsers(dest='command')
+	command = commands.add_parser('dump', help='dump target memory into FILE')
+	command.add_argument('host')
+	command.add_argument('address', type=number)
+	command.add_argument('nbytes', type=number, metavar='bytes')
+	command.add_argument('file')
+	command = commands.add_parser('load', help='load FILE into target memory')
+	command.add_argument('host')
+	command.add_argument('address', type=number)
+	command.add_argument('file')
+	args = parser.parse_args(argv)
+	if args.command == 'load' and not os.path.isfile(args.file):
+		parser.error("cannot open %s" % (args.file))
+	
+	spwif = SpaceWire.Interface(args.host, args.port)
+	rmap = RMAP.Engine(spwif)
+	rmap.start()
+	try:
+		crc = RMAP.CRC_DraftE if args.crc == 'DraftE' else RMAP.CRC_DraftF
+		dest = RMAP.Destination(dest_address=args.dest_address, src_address=args.src_address, dest_key=args.dest_key, crc=crc, word_width=args.word_width)
+		sock = rmap.socket(dest)
+		
+		if args.command == 'dump':
+			mismatched = dump(sock, args.address, args.nbytes, args.file, args.chunk, args.window, args.check, extended_address=args.extended_address)
+		else:
+			mismatched = load(sock, args.address, args.file, args.chunk, args.window, args.check, extended_address=args.extended_address)
+	finally:
+		rmap.stop()
+		spwif.close()
+	
+	for (offset, size) in mismatched:
+		print "Check failed at 0x%08X (%d bytes)" % (args.address + offset, size)
+	
+	return 1 if mismatched else 0
+
+if __name__ == '__main__':
+	sys.exit(execute(sys.argv[1:]))
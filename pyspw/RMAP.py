@@ -6,200 +6,469 @@
 
 import socket
 import select
+import errno
+import os
 import threading
 import struct
 import Queue
 import time
+import heapq
+import itertools
+import bisect
+import collections
+import array
+import sys
+import math
+import logging
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
 
 import SpaceWire as sw
 
 # Configuration
-Max_SID = 0x0fff
+Max_SID = 0x10000
+
+# Seconds between checks of the engine while waiting for a transaction without timeout
+Wait_Interval = 1
+
+# Errors raised by done-callbacks, and failures of Transceivers
+log = logging.getLogger(__name__)
+
+# Read data formats (see RMAP.unpack_data)
+Data_Formats = ('array', 'bytes', 'memoryview', 'numpy', 'tuple')
+Default_Format = 'array'
+
+# array.array type codes for 1, 2 and 4 byte words
+Array_Typecodes = {1: 'B', 2: 'H', 4: 'I' if array.array('I').itemsize == 4 else 'L'}
+
+# RMAP command header: head (destination address, protocol, command, key and source address),
+# transaction id, extended address, address, upper 8 and lower 16 bits of data length and CRC (Big-Endian)
+Command_Header = struct.Struct('>5sHBLBHB')
+
+# Command header templates keyed by destination, command and extended address. Never evicted, as there
+# are only a few of these per destination.
+Header_Templates = {}
+
+# Contributions of transaction id, address and data length to header CRC, keyed by CRC type
+Header_CRC_Tables = {}
+
+# Upper bounds of transfer size classes in bytes for adaptive timeouts (larger transfers make the last class)
+Size_Classes = (256, 4096, 65536)
+
+# Time-to-live of cached reads of constant registers (never expire) and of volatile registers (not cached)
+(Cache_Static, Cache_Volatile) = (None, 0)
+
+# Link selection policies of RMAP.MultiEngine
+(Policy_RoundRobin, Policy_LeastOutstanding, Policy_Affinity) = (0, 1, 2)
+
+# Buckets of latency histograms, bucket n counting latencies below 2**n microseconds (the last one the rest)
+Histogram_Buckets = 32
 
 class Engine(object):
 	"""
 	RMAP Engine
 	"""
 	# Sub-class definitions
+	class Waker(object):
+		"""
+		Transceiver Waker
+		Wakes up the Transceiver blocking in select() when a request is queued.
+		"""
+		def __init__(self):
+			try:
+				import fcntl
+				
+				# Non-blocking pipe
+				(self.rfd, self.wfd) = os.pipe()
+				for fd in (self.rfd, self.wfd):
+					fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+				self.rsock = self.wsock = None
+			except ImportError:
+				# select() on Windows only accepts sockets, so use a loopback socket pair instead
+				listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+				listener.bind(('127.0.0.1', 0))
+				listener.listen(1)
+				self.wsock = socket.create_connection(listener.getsockname())
+				(self.rsock, addr) = listener.accept()
+				listener.close()
+				for s in (self.rsock, self.wsock):
+					s.setblocking(0)
+				self.rfd = self.rsock.fileno()
+			
+			# Set while a wake-up byte is pending, to avoid writing one per request
+			self.pending = False
+			
+			# Set once closed, after which wake-ups are ignored
+			self.closed = False
+		
+		def fileno(self):
+			return self.rfd
+		
+		def wake(self):
+			"""
+			Wake up the Transceiver.
+			"""
+			if not self.pending and not self.closed:
+				self.pending = True
+				try:
+					if self.wsock:
+						self.wsock.send('\x00')
+					else:
+						os.write(self.wfd, '\x00')
+				except (OSError, socket.error):
+					# Pipe is full, so the Transceiver is going to wake up anyway
+					pass
+		
+		def clear(self):
+			"""
+			Consume pending wake-ups. Called by the Transceiver before it drains the request queue.
+			"""
+			try:
+				while True:
+					if self.rsock:
+						data = self.rsock.recv(4096)
+					else:
+						data = os.read(self.rfd, 4096)
+					if len(data) < 4096:
+						break
+			except (OSError, socket.error):
+				pass
+			
+			# Clear the flag only after consuming, or a byte written in between would be consumed while
+			# the flag stays set, and no later request would wake the Transceiver
+			self.pending = False
+		
+		def close(self):
+			"""
+			Close both ends of the pipe. Called once the Transceiver has stopped.
+			"""
+			self.closed = True
+			if self.rsock:
+				self.rsock.close()
+				self.wsock.close()
+			else:
+				os.close(self.rfd)
+				os.close(self.wfd)
+	
+	class Estimator(object):
+		"""
+		Round-Trip Time Estimator
+		Smoothed round-trip time and its variation as in RFC 6298.
+		"""
+		def __init__(self):
+			self.srtt = None
+			self.rttvar = None
+			self.samples = 0
+		
+		def update(self, rtt):
+			"""
+			Update estimates with a measured round-trip time.
+			
+			Parameter
+			---------
+				rtt:	round-trip time in seconds of a transaction sent only once
+			"""
+			if self.srtt is None:
+				self.srtt = rtt
+				self.rttvar = rtt / 2
+			else:
+				self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+				self.srtt = 0.875 * self.srtt + 0.125 * rtt
+			self.samples += 1
+		
+		def timeout(self, granularity):
+			"""
+			Return retransmission timeout in seconds before backoff and limits.
+			
+			Parameter
+			---------
+				granularity:	lower limit of the variation term in seconds
+			"""
+			return self.srtt + max(granularity, 4 * self.rttvar)
+	
+	class Statistics(object):
+		"""
+		RMAP Engine Statistics
+		Counters and latency histograms updated by a single thread, so that no lock is needed to count.
+		"""
+		Counters = ('requests', 'commands', 'dropped_commands', 'bytes_sent', 'bytes_received', 'frames_received',
+					'eeps', 'control_frames', 'timecodes', 'replies', 'dropped_replies', 'timeouts', 'failures', 'cancels', 'link_errors')
+		
+		def __init__(self):
+			self.counters = dict.fromkeys(self.Counters, 0)
+			
+			# Replies by RMAP error code (index of RMAP.Error_Description)
+			self.errors = collections.defaultdict(int)
+			
+			# Latency histograms by (destination address, source address, 'read' or 'write')
+			self.latencies = {}
+		
+		def latency(self, key, latency):
+			"""
+			Count latency of a completed transaction.
+			"""
+			try:
+				self.latencies[key].add(latency)
+			except KeyError:
+				self.latencies[key] = Histogram()
+				self.latencies[key].add(latency)
+		
+		def merge(self, other, sign=1):
+			"""
+			Add (or subtract, with sign -1) counts of another record.
+			"""
+			for (name, count) in other.counters.items():
+				self.counters[name] += sign * count
+			for (code, count) in other.errors.items():
+				self.errors[code] += sign * count
+			for (key, histogram) in other.latencies.items():
+				if key not in self.latencies:
+					self.latencies[key] = Histogram()
+				self.latencies[key].merge(histogram, sign)
+	
 	class Transceiver(threading.Thread):
 		"""
 		RMAP Transceiver
 		Transmits and recieves RMAP packets.
 		"""
-		def __init__(self, engine):
+		def __init__(self, engine, link=None):
+			"""
+			Create RMAP Transceiver
+			
+			Parameters
+			----------
+				engine:		RMAP Engine
+				link:		object with spwif, requests and waker to serve (Default: engine)
+			"""
 			threading.Thread.__init__(self)
 			self.engine = engine
-			self.running = False
+			self.link = link if link else engine
+			# Set before the thread runs, so that stop() right after start() is not lost
+			self.running = True
+			self.encoder = None
+			self.budgeted = None
 			self.setDaemon(True)
 		
 		def run(self):
-			# Overrides receive of SpaceWire Interface
-			def receive(engine):
-				"""
-				Receive a packet from target.
-				"""
-				# SSDTP2
-				header = ''
-				data = ''
-				
-				while True:
-					# Receive for header at least 12 bytes
-					while len(header) < 12:
-						header += (yield)
-				
-					# Parse header
-					if header[0] in (sw.DataFlag_Complete_EOP, sw.DataFlag_Complete_EEP, sw.DataFlag_Fragmented):
-						# Data
-						tdata = header[12:]
-						fragment_size = reduce(lambda x, y: (x << 8) + y, struct.unpack('B'*len(header[2:12]), header[2:12]))
-						while len(tdata) < fragment_size:
-							tdata += (yield)
-						data += tdata[:fragment_size]
-						
-						if header[0] == sw.DataFlag_Fragmented:
-							header = tdata[fragment_size:]
-							continue
-						
-						header = tdata[fragment_size:]
-					
-					elif header[0] in (sw.ControlFlag_SendTimeCode, sw.ControlFlag_GotTimeCode):
-						tc = header[12:]
-						while len(tc) < 2:
-							tc += (yield)
-					
-						# Do nothing for time code for now
-						pass
-					
-						header = tc[2:]
-						
-						continue
-				
-					else:
-						assert False
-					
-					# Data ready
-					tid, dest, status, data, opt = depacketize(buffer(data))
-					reply = engine.replies[tid]
-					
-					# Check if transaction id is invalidated
-					if reply:
-						reply.put((dest, status, data, opt))
-					
-					# Re-initialize
-					data = ''
-			
+			try:
+				self.transceive()
+			except Exception, exception:
+				# Nothing would send commands or expire transactions anymore
+				log.exception("RMAP Transceiver of %s:%d failed", self.link.spwif.host, self.link.spwif.port)
+				self.release()
+				self.engine.fail(exception, self.link)
+		
+		def transceive(self):
 			# Initialization
-			send_buffer = ''
-			receive_buffer = ''
-			wfds = []
+			engine = self.engine
+			link = self.link
+			spwif = link.spwif
+			waker = link.waker
+			capture = spwif.capture
+			counters = engine.statistics().counters
 			
-			# Prepare Recieve generator
-			receiver = receive(self.engine)
-			receiver.next()
+			# Prepare SSDTP2 encoder and decoder
+			encoder = self.encoder = sw.Encoder(engine.batch_bytes, engine.batch_packets)
+			decoder = sw.Decoder()
 			
-			# Set sockets to non-blocking
-			self.engine.spwif.settimeout(0)
+			# Budgets of commands in the encoder, by position of their ends in the stream sent
+			budgeted = self.budgeted = collections.deque()
 			
-			# Start thread
-			self.running = True
+			# Set sockets to non-blocking
+			spwif.settimeout(0)
 			
 			while self.running:
 				try:
 					while self.running:
+						sock = spwif.sock
+						
 						# Is there anything to send?
-						if send_buffer:
-							wfds = [ self.engine.spwif.sock ]
+						if encoder:
+							wfds = [ sock ]
 						else:
 							wfds = []
 						
-						# Polling
-						r, w, e = select.select([ self.engine.spwif.sock ], wfds, [ self.engine.spwif ], 0.0)
+						# Retry timed-out transactions and find the next deadline
+						timeout = engine.expire()
 						
-						for es in e:
-							if self.engine.reconnect:
-								# Socket Error. Reconnect.
-								es.settimeout(None)
-								es.close()
-								es.open()
-								es.settimeout(0)
-						
-						for rs in r:
-							# Socket ready to read
-							receive_buffer += rs.recv(8192)
+						# Block until the socket is ready, a request is signalled or a transaction times out
+						r, w, e = select.select([ sock, waker ], wfds, [ sock ], timeout)
 						
-						for ws in w:
-							# Socket ready to write
-							sent = ws.send(send_buffer)
-							send_buffer = send_buffer[sent:]
+						if e:
+							if engine.reconnect:
+								# Socket Error. Reconnect.
+								raise socket.error(errno.ECONNRESET, 'Exceptional condition on socket')
 						
-						# When nothing to do
-						if r == w == e == []:
-							# Process received data
-							receiver.send(receive_buffer)
-							receive_buffer = ''
-							
+						if waker in r:
 							# Check request queue
-							while not self.engine.requests.empty():
+							waker.clear()
+							while True:
 								try:
-									packet = self.engine.requests.get_nowait()
-									length = len(packet)
-									header = '\x00\x00' + struct.pack('!HLL', length >> 64 & 0xffff, length >> 32 & 0xffffffff, length & 0xffffffff)
-									send_buffer += header + packet
+									(sid, generation, packet, flag, budget) = link.requests.get_nowait()
 								except Queue.Empty:
 									break
+								if sid is not None:
+									if generation != engine.generations[sid]:
+										# Transaction finished or was resent with another transaction id
+										counters['dropped_commands'] += 1
+										if budget:
+											budget[0].release(budget[1])
+										continue
+									engine.sent[sid] = generation
+								if flag == sw.DataFlag_Complete_EOP:
+									encoder.put(packet)
+									counters['commands'] += 1
+								else:
+									# Control frames (time codes) go ahead of commands queued
+									encoder.put(packet, flag, True)
+								if capture:
+									capture.sent([ (flag, packet) ])
+								if budget:
+									budgeted.append((encoder.total, budget))
+							
+							# Try to send right away rather than waiting for the next select
+							if encoder:
+								w = [ sock ]
+						
+						if sock in r:
+							# Socket ready to read
+							size = sock.recv_into(decoder.reserve(65536))
+							if not size:
+								raise socket.error(errno.ECONNRESET, 'Connection closed by peer')
+							rtime = time.time()
+							counters['bytes_received'] += size
+							frames = decoder.commit(size)
+							if capture:
+								capture.received(frames)
+							engine.process(frames, spwif, rtime)
+							if decoder.error:
+								raise decoder.error
+						
+						if w and encoder:
+							# Socket ready to write
+							counters['bytes_sent'] += encoder.flush(sock)
 							
-							# Sleep for a while
-							time.sleep(0.0001)
+							# Release budgets of commands handed to the socket
+							position = encoder.total - len(encoder)
+							while budgeted and budgeted[0][0] <= position:
+								(end, (budget, nbytes)) = budgeted.popleft()
+								budget.release(nbytes)
 					
-				except socket.error, (errno, string):
-					if self.engine.reconnect:
+				except socket.error, (err, string):
+					if engine.reconnect and self.running:
 						# Socket Error. Reconnect.
-						self.engine.spwif.settimeout(None)
-						self.engine.spwif.close()
-						self.engine.spwif.open()
-						self.engine.spwif.settimeout(0)
+						counters['link_errors'] += 1
+						engine.link_down(link)
+						spwif.settimeout(None)
+						spwif.close()
+						engine.reopen(link, self)
+						spwif.settimeout(0)
+						
+						# Partially transferred frames are lost with the old connection
+						encoder = self.encoder = sw.Encoder(engine.batch_bytes, engine.batch_packets)
+						decoder = sw.Decoder()
+						while budgeted:
+							(end, (budget, nbytes)) = budgeted.popleft()
+							budget.release(nbytes)
 					else:
 						raise
 			
-			# Thread Stopped
-			receiver.close()
-			
-			# Reset sockets to blocking
-			self.engine.spwif.settimeout(None)
+			# Thread Stopped. Reset sockets to blocking
+			spwif.settimeout(None)
+		
+		def release(self):
+			"""
+			Release budgets of commands left unsent. Called once the Transceiver has failed.
+			"""
+			while self.budgeted:
+				(end, (budget, nbytes)) = self.budgeted.popleft()
+				budget.release(nbytes)
 		
 		def stop(self):
 			self.running = False
-			self.join() 
+			self.link.waker.wake()
+			self.join()
+			
+			# Nothing waits on the wake-up pipe anymore
+			self.link.waker.close()
 	
-	def __init__(self, spwif, reconnect=True, timeout=1):
+	def __init__(self, spwif, reconnect=True, timeout=1, adaptive=False, min_timeout=0.001, max_timeout=60, batch_bytes=65536, batch_packets=256):
 		"""
 		Create RMAP Engine
 		
 		Parameter
 		---------
-			spwif:		SpaceWire.Interface instance
-			reconnect:	automatically reconnect if socket error (Default: True)
-			timeout:	timeout in seconds before retry (Default: 1)
+			spwif:			SpaceWire.Interface instance
+			reconnect:		automatically reconnect if socket error (Default: True)
+			timeout:		timeout in seconds before retry, None not to retry (Default: 1)
+			adaptive:		derive timeouts from measured round-trip times (Default: False)
+			min_timeout:	lower limit of adaptive timeouts, and of their margin over round-trip time, in seconds
+							(Default: 0.001)
+			max_timeout:	upper limit of adaptive timeouts in seconds (Default: 60)
+			batch_bytes:	bytes of queued commands to join into one send (Default: 65536)
+			batch_packets:	queued commands to join into one send (Default: 256)
 		
 		Note
 		----
 		* spwif will be opened if closed.
 		* timeout is *not* SpaceWire interface timeout, but is timeout before resending
 		  a request packet when a reply packet does not arrive.
+		* With adaptive, round-trip times are estimated per destination and transfer size class (see
+		  RMAP.Size_Classes), and timeout is used until the first reply is measured. Timeouts are doubled
+		  on each retry of a transaction, and only replies to transactions sent once are measured.
+		* Frames sent and received are teed to the capture of spwif, if given one (see Capture.Writer).
 		"""
 		self.spwif = spwif
 		self.reconnect = reconnect
 		self.timeout = timeout
 		
+		# Adaptive timeouts
+		self.adaptive = adaptive
+		self.min_timeout = min_timeout
+		self.max_timeout = max_timeout
+		self.estimators = {}
+		
+		# Send batches
+		self.batch_bytes = batch_bytes
+		self.batch_packets = batch_packets
+		
+		# Read caches of destinations
+		self.read_caches = {}
+		
 		# Child processor handles
 		self.transceiver = None
+		self.waker = self.Waker()
+		
+		# RMAP.Failed once a Transceiver has failed
+		self.failure = None
 		
 		# Initialize pools
 		self.requests = Queue.Queue()
-		self.replies = [ None for i in range(Max_SID) ]
-		self.timedout_sids = {}
-		self.sids = range(Max_SID)
-		self.sids.reverse()
+		self.replies = [ None ] * Max_SID
+		self.sids = collections.deque(xrange(Max_SID))
+		self.sid_available = threading.Condition(threading.Lock())
+		self.sid_waiting = 0
+		
+		# Generation of each transaction id, counted up when returned, and generation whose command was sent
+		self.generations = [ 0 ] * Max_SID
+		self.sent = [ None ] * Max_SID
+		
+		# Retry deadlines as (deadline, timer, transaction id), and transactions by timer of their live
+		# deadline. Deadlines of transactions done are left in the heap, not holding the transactions.
+		self.deadlines = []
+		self.scheduled = {}
+		self.sequence = itertools.count()
+		
+		# Converter register accesses in flight by SpaceWire interface, in the order sent
+		self.register_accesses = {}
+		
+		# Statistics record of each thread (see statistics), and counts subtracted by stats
+		self.local = threading.local()
+		self.records = []
+		self.baseline = self.Statistics()
 		
 		# Lock
 		self.lock = threading.Lock()
@@ -213,9 +482,15 @@ class Engine(object):
 		if not self.spwif.sock:
 			self.spwif.open()
 		
-		# Start Transceiver
+		# Wake-up pipe is closed when stopped
+		if self.waker.closed:
+			self.waker = self.Waker()
+		self.failure = None
+		
+		# Start Transceiver, waking it up for requests queued before
 		self.transceiver = self.Transceiver(self)
 		self.transceiver.start()
+		self.waker.wake()
 		
 	def stop(self):
 		"""
@@ -238,259 +513,2087 @@ class Engine(object):
 		"""
 		return Socket(self, destination, **kwargs)
 
-	def request(self, packet):
-		self.requests.put(packet)
-
-	def request_sid(self, reply):
+	def request(self, packet, sid=None, generation=None, flag=sw.DataFlag_Complete_EOP, spwif=None, budget=None):
 		"""
-		Retrieve new socket id and register reply queue.
+		Queue a command packet to send.
 		
-		Parameter
-		---------
-			reply:	Socket reply queue
+		Parameters
+		----------
+			packet:		RMAP command packet
+			sid:		transaction id of the command, None if no reply is expected (Default: None)
+			generation:	generation of the transaction id when the command was packetized (Default: None)
+			flag:		SSDTP2 flag, a control flag to send a control frame (Default: DataFlag_Complete_EOP)
+			spwif:		SpaceWire interface to send through, None for any (Default: None)
+			budget:		(RMAP.Budget, bytes) reserved for the command, released once the command is handed to
+						the socket (Default: None)
+		
+		Note
+		----
+		* Commands whose transaction id has been returned before they are sent are dropped.
+		* Control frames are sent ahead of commands queued.
+		
+		Raises
+		------
+			Failed:		if the Transceiver has failed
 		"""
-		# First clean up sid pool
-		self.clean_sid()
+		if self.failure:
+			raise self.failure
 		
-		# Pop transaction id
-		while True:
-			try:
-				sid = self.sids.pop()
-				break
-			except IndexError:
-				# No more sid to pop, sleep now...				
-				time.sleep(1)
-				
-				# Clean up again
-				self.clean_sid()
+		self.requests.put((sid, generation, packet, flag, budget))
+		self.waker.wake()
+	
+	def reserve(self, budget, nbytes, timeout=None):
+		"""
+		Reserve bytes of a budget for a command, blocking while the budget is used up.
 		
-		# Register reply to pool
-		self.replies[sid] = reply
+		Parameters
+		----------
+			budget:		RMAP.Budget instance
+			nbytes:		bytes to reserve
+			timeout:	seconds to wait, None to wait until reserved (Default: None)
 		
-		return sid
+		Returns
+		-------
+			reserved:	True if reserved, False if timed out
+		"""
+		return budget.acquire(nbytes, timeout)
 	
-	def return_sid(self, sid, timedout=False):
+	def send_timecode(self, value):
 		"""
-		Return socket id. Set timedout to True if transaction has timed out and put socket it to temporary socket pool.
+		Send a time code, ahead of commands queued.
 		
 		Parameter
 		---------
-			sid:		Socket id
-			timedout:	True for timed-out transactions (Default: False)
+			value:	time code, 6-bit time value and 2 control flag bits (0 <= value <= 255)
+		
+		Note
+		----
+		* Subscribe to time codes received with the subscribe method of the SpaceWire interface.
 		"""
-		# Delete sid from pool
-		self.replies[sid] = None
+		assert 0 <= value <= 0xff, "time code 0x%x is out of range." % (value)
 		
-		if timedout:
-			self.timedout_sids[sid] = time.time()
-		else:
-			# Append back the sid
-			self.sids.append(sid)
-
-	def clean_sid(self):
+		self.request(chr(value) + '\x00', flag=sw.ControlFlag_SendTimeCode)
+	
+	def read_register_async(self, address, spwif=None):
 		"""
-		Clean up timed-out transactions.
+		Read a converter register without waiting for the reply.
+		
+		Parameters
+		----------
+			address:	register address
+			spwif:		SpaceWire interface of the converter (Default: the interface of the engine, or the
+						first one of a MultiEngine)
+		
+		Returns
+		-------
+			access:		RMAP.RegisterAccess instance, whose result is the register value
+		
+		Raises
+		------
+			ValueError:	if spwif is not a link of a MultiEngine
 		"""
-		if self.timedout_sids:
-			self.lock.acquire()
-			for item in self.timedout_sids.items():
-				if time.time() - item[1] > 10:
-					# 10 second older transactions should be considered free
-					del self.timedout_sids[item[0]]
-					self.sids.append(item[0])
-			self.lock.release()
-			
-
-class Socket(object):
-	"""
-	RMAP Socket
-	"""
-	def __init__(self, engine, destination, **kwargs):
+		return RegisterAccess(self, address, None, spwif).submit()
+	
+	def write_register_async(self, address, value, spwif=None):
 		"""
-		Create RMAP Socket
+		Write a converter register without waiting for the reply.
 		
 		Parameters
 		----------
-			engine:			RMAP Engine (RMAP.Engine instance)
-			destination:	RMAP Destination (RMAP.Destination instance)
+			address:	register address
+			value:		register value
+			spwif:		SpaceWire interface of the converter (Default: as read_register_async)
 		
-		Keywords (and their default values)
-		-----------------------------------
-			retry:			allowed retry counts. None for infinite retry, or integers for number of retries (default: None)
+		Returns
+		-------
+			access:		RMAP.RegisterAccess instance
+		"""
+		return RegisterAccess(self, address, value, spwif).submit()
+	
+	def read_registers(self, addresses, spwif=None, timeout=None):
+		"""
+		Read converter registers. All read commands are queued together, ahead of RMAP commands queued, so
+		they take a single round trip.
+		
+		Parameters
+		----------
+			addresses:	list of register addresses
+			spwif:		SpaceWire interface of the converter (Default: as read_register_async)
+			timeout:	seconds to wait for each reply, None to wait until answered or timed out by the
+						engine (Default: None)
+		
+		Returns
+		-------
+			values:		list of register values
 		
 		Note
 		----
-		* This should not be directly instantiated. Use RMAP.socket to create a socket instead.
+		* With RMAP.AsyncEngine, use read_register_async and run_until_complete instead.
 		"""
-		self.engine = engine
-		self.dest = destination
-
-		# Allowed retry count (default: forever)
-		self.retry = kwargs.get('retry', None)
+		accesses = [ self.read_register_async(address, spwif) for address in addresses ]
 		
-		# Generate reply queue and register it
-		self.reply = Queue.Queue()
-		self.sid = self.engine.request_sid(self.reply)
+		return [ access.result(timeout) for access in accesses ]
+	
+	def write_registers(self, values, spwif=None, timeout=None):
+		"""
+		Write converter registers, all write commands being queued together.
 		
-		# Reset accumulated retry counter
-		self.retries = 0
-
-	def __del__(self):
-		# Unregister reply queue
-		self.engine.return_sid(self.sid)
+		Parameters
+		----------
+			values:		list of (register address, value)
+			spwif:		SpaceWire interface of the converter (Default: as read_register_async)
+			timeout:	seconds to wait for each reply (Default: None)
+		"""
+		accesses = [ self.write_register_async(address, value, spwif) for (address, value) in values ]
+		for access in accesses:
+			access.result(timeout)
 	
-	def read(self, address, length, **kwargs):
+	def register_reply(self, spwif, flag, payload):
 		"""
-		RMAP Read
+		Complete the oldest register access in flight on an interface matching a reply.
 		
 		Parameters
 		----------
-			address:	address to read
-			length:		words to read
+			spwif:		SpaceWire interface the reply was received from
+			flag:		ControlFlag_RegisterAccess_ReadReply or ControlFlag_RegisterAccess_WriteReply
+			payload:	reply payload
+		"""
+		counters = self.statistics().counters
+		try:
+			(address, value) = sw.unpack_register(payload)
+		except struct.error:
+			counters['dropped_replies'] += 1
+			return
+		write = flag == sw.ControlFlag_RegisterAccess_WriteReply
 		
-		Keywords (and their default values)
-		-----------------------------------
-			increment:	0 for non-incremental read, 1 for incremental read (default)
-			extended_address:
-						extended read address (default: 0x00)
+		self.lock.acquire()
+		access = None
+		for pending in self.register_accesses.get(spwif, ()):
+			if pending.write == write and pending.address == address:
+				access = pending
+				self.register_accesses[spwif].remove(pending)
+				break
+		self.lock.release()
+		
+		if access:
+			access.put(value)
+		else:
+			counters['dropped_replies'] += 1
+	
+	def read_cache(self, destination, **kwargs):
+		"""
+		Return the read cache of a destination, creating it on first use.
+		
+		Parameters
+		----------
+			destination:	RMAP.Destination instance
+		
+		Keywords
+		--------
+			Passed to RMAP.ReadCache when created.
+		"""
+		key = (destination.dest_address, destination.src_address)
+		self.lock.acquire()
+		if key not in self.read_caches:
+			self.read_caches[key] = ReadCache(**kwargs)
+		cache = self.read_caches[key]
+		self.lock.release()
+		
+		return cache
+	
+	def fail(self, exception, link):
+		"""
+		Called by a Transceiver which stopped with an exception. Marks the engine as failed, so that
+		requests raise RMAP.Failed, and fails transactions in flight and commands left unsent.
+		
+		Parameters
+		----------
+			exception:	exception the Transceiver stopped with
+			link:		link of the Transceiver (the engine itself)
+		"""
+		self.lock.acquire()
+		if self.failure is None:
+			self.failure = Failed(exception)
+		failure = self.failure
+		self.lock.release()
+		
+		# Release budgets of commands not handed to the socket
+		while True:
+			try:
+				(sid, generation, packet, flag, budget) = link.requests.get_nowait()
+			except Queue.Empty:
+				break
+			if budget:
+				budget[0].release(budget[1])
+		
+		# Transactions registered from now on see the failure when submitted
+		self.lock.acquire()
+		accesses = [ access for pending in self.register_accesses.values() for access in pending ]
+		self.lock.release()
+		for transaction in set( reply for reply in self.replies if reply ) | set(accesses):
+			transaction.fail(failure)
+	
+	def link_down(self, link):
+		"""
+		Called by the Transceiver when its link failed, before reconnecting. Transactions in flight are
+		resent by their retry deadlines.
+		
+		Parameter
+		---------
+			link:		failed link (the engine itself)
+		"""
+		pass
+	
+	def reopen(self, link, transceiver):
+		"""
+		Called by the Transceiver to reconnect its link. Socket errors are raised to the Transceiver.
+		
+		Parameters
+		----------
+			link:			link to reconnect (the engine itself)
+			transceiver:	Transceiver serving the link
+		"""
+		link.spwif.open()
+	
+	def process(self, frames, spwif=None, rtime=None):
+		"""
+		Dispatch received SSDTP2 frames.
+		
+		Parameters
+		----------
+			frames:		list of (flag, payload) as returned by SpaceWire.Decoder
+			spwif:		SpaceWire interface the frames were received from, to deliver time codes to its
+						subscriptions (Default: None)
+			rtime:		host time the frames were received at (Default: when a time code is delivered)
+		"""
+		counters = self.statistics().counters
+		counters['frames_received'] += len(frames)
+		
+		for (flag, payload) in frames:
+			if flag == sw.DataFlag_Complete_EOP:
+				self.dispatch(payload)
+			elif flag == sw.DataFlag_Complete_EEP:
+				# Reply cut short by a link error: leave the transaction to time out and be resent
+				counters['eeps'] += 1
+			else:
+				counters['control_frames'] += 1
+				if flag == sw.ControlFlag_GotTimeCode:
+					counters['timecodes'] += 1
+					if spwif is not None:
+						spwif.timecode(ord(payload[0]), rtime)
+				elif flag in (sw.ControlFlag_RegisterAccess_ReadReply, sw.ControlFlag_RegisterAccess_WriteReply):
+					self.register_reply(spwif or self.spwif, flag, payload)
+	
+	def dispatch(self, packet):
+		"""
+		Depacketize a reply packet and hand it to the transaction registered for its transaction id.
+		"""
+		try:
+			tid, dest, status, data, opt = depacketize(packet, format='bytes')
+			reply = self.replies[tid]
+		except (struct.error, AssertionError, IndexError):
+			# Malformed packet, not an RMAP reply
+			self.statistics().counters['dropped_replies'] += 1
+			return
+		
+		# Check if transaction id is invalidated, or its current command is not sent yet (late reply to
+		# a recycled transaction id). Generations do not go on the wire: once the current command is
+		# sent, a late reply to an earlier one passes, and only Transaction.put checks it further.
+		if reply and self.sent[tid] == self.generations[tid]:
+			reply.put((dest, status, data, opt))
+		else:
+			self.statistics().counters['dropped_replies'] += 1
 
-		Returns
-		-------
-			data:		read data
+	def request_sid(self, reply, previous=None):
+		"""
+		Retrieve new socket id and register reply queue. Blocks while all transaction ids are in use.
 		
-		Raises
-		------
-			Timeout:	if retry count exceeded the allowed retry count
-			Error:		if RMAP Error
+		Parameter
+		---------
+			reply:		Socket reply queue
+			previous:	timed-out socket id to return at the same time (Default: None)
 		
 		Note
 		----
-		* This function is not thread-safe. Simultaneous call to this function of the *same* instance is not supported.
-		  Generate new socket per thread instead.
+		* Giving previous never blocks, so the Transceiver can resend timed-out transactions.
+		"""
+		self.sid_available.acquire()
+		if previous is not None:
+			# Return previous socket id first, so that one is always available
+			self.replies[previous] = None
+			self.generations[previous] += 1
+			self.sids.append(previous)
+		while not self.sids:
+			self.sid_waiting += 1
+			self.sid_available.wait()
+			self.sid_waiting -= 1
+		
+		# Pop the least recently returned transaction id
+		sid = self.sids.popleft()
+		
+		# Register reply to pool
+		self.replies[sid] = reply
+		self.sid_available.release()
+		
+		return sid
+	
+	def return_sid(self, sid, timedout=False):
+		"""
+		Return socket id. Replies arriving later for it are dropped.
+		
+		Parameter
+		---------
+			sid:		Socket id
+			timedout:	True for timed-out transactions (Default: False)
+		
+		Note
+		----
+		* Returned ids are reused in the order they were returned, so a timed-out id is reused only after
+		  all other ids. Late replies are also told apart by the generation of the id.
+		* The generation is not sent to the target. A late reply arriving after the command of the reused id
+		  has been sent cannot be told from the awaited reply by id, and is only dropped if its destination
+		  address, read/write flag or data length do not match the new command (see Transaction.put).
+		"""
+		self.sid_available.acquire()
+		
+		# Delete sid from pool and invalidate its generation
+		self.replies[sid] = None
+		self.generations[sid] += 1
+		
+		# Append back the sid
+		self.sids.append(sid)
+		if self.sid_waiting:
+			self.sid_available.notify()
+		self.sid_available.release()
+	
+	def retry_timeout(self, key, retry):
+		"""
+		Return timeout of a transaction in seconds.
+		
+		Parameters
+		----------
+			key:		tuple of destination address, source address and size class of transaction
+			retry:		retry count of transaction
+		
+		Returns
+		-------
+			timeout:	timeout in seconds, or None not to time out
+		"""
+		if self.timeout is None or not self.adaptive:
+			return self.timeout
+		
+		estimator = self.estimators.get(key)
+		if estimator is None:
+			timeout = self.timeout
+		else:
+			timeout = max(self.min_timeout, estimator.timeout(self.min_timeout))
+		
+		# Exponential backoff
+		return min(self.max_timeout, timeout * (2 ** retry))
+	
+	def measure(self, key, rtt):
+		"""
+		Update round-trip time estimates with a reply.
+		
+		Parameters
+		----------
+			key:		tuple of destination address, source address and size class of transaction
+			rtt:		round-trip time in seconds of a transaction sent only once
+		"""
+		self.lock.acquire()
+		try:
+			self.estimators[key].update(rtt)
+		except KeyError:
+			self.estimators[key] = self.Estimator()
+			self.estimators[key].update(rtt)
+		self.lock.release()
+	
+	def estimates(self):
+		"""
+		Return current round-trip time estimates.
+		
+		Returns
+		-------
+			estimates:	dictionary of {(destination address, source address, size class): (smoothed round-trip
+						time, round-trip time variation, timeout before backoff)} in seconds
+		"""
+		self.lock.acquire()
+		estimates = dict( (key, (estimator.srtt, estimator.rttvar, max(self.min_timeout, min(self.max_timeout, estimator.timeout(self.min_timeout)))))
+						for (key, estimator) in self.estimators.items() )
+		self.lock.release()
+		
+		return estimates
+	
+	def statistics(self):
+		"""
+		Return the statistics record of the calling thread, creating it on first use.
+		"""
+		try:
+			return self.local.statistics
+		except AttributeError:
+			record = self.Statistics()
+			self.local.statistics = record
+			self.lock.acquire()
+			self.records.append(record)
+			self.lock.release()
+			return record
+	
+	def depths(self):
+		"""
+		Return queue depths.
+		
+		Returns
+		-------
+			depths:		tuple of commands queued to the Transceiver and bytes waiting to be sent
+		"""
+		transceiver = self.transceiver
+		encoder = transceiver.encoder if transceiver else None
+		
+		return (self.requests.qsize(), len(encoder) if encoder else 0)
+	
+	def stats(self, reset=False):
+		"""
+		Return statistics.
+		
+		Parameter
+		---------
+			reset:		True to count from zero again after this call (Default: False)
+		
+		Returns
+		-------
+			stats:		dictionary of
+							requests:			commands submitted, including resends
+							commands:			commands handed to the SpaceWire interface
+							dropped_commands:	commands dropped as their transaction finished before being sent
+							bytes_sent:			bytes sent to the SpaceWire interface
+							bytes_received:		bytes received from the SpaceWire interface
+							frames_received:	SSDTP2 frames received
+							eeps:				packets received terminated with EEP
+							control_frames:		SSDTP2 control frames (time codes) received
+							timecodes:			time codes received, delivered to subscriptions of the interface
+							replies:			replies completing transactions
+							dropped_replies:	replies to finished, resent or unknown transactions
+							timeouts:			transaction time-outs, each retried or failed
+							failures:			transactions failed by exceeding their retry count, or by a failed
+												Transceiver
+							cancels:			transactions cancelled
+							link_errors:		socket errors followed by reconnection
+							errors:				dictionary of replies by RMAP error code (see RMAP.Error_Description)
+							latency:			dictionary of RMAP.Histogram of latencies in seconds, from first
+												submission to completion, by (destination address, source
+												address, 'read' or 'write')
+							tids_in_use:		transaction ids in use
+							tids_waiting:		threads waiting for a transaction id
+							queued:				commands queued to the Transceiver
+							unsent_bytes:		bytes waiting to be sent
+							deadlines:			retry deadlines of transactions in flight
+		
+		Note
+		----
+		* Each thread counts into its own record, and records are added up here without stopping them, so
+		  counts may be off by the updates in progress.
+		"""
+		self.lock.acquire()
+		records = list(self.records)
+		self.lock.release()
+		
+		total = self.Statistics()
+		for record in records:
+			total.merge(record)
+		
+		current = self.Statistics()
+		current.merge(total)
+		current.merge(self.baseline, -1)
+		if reset:
+			self.baseline = total
+		
+		stats = dict(current.counters)
+		stats['errors'] = dict( (code, count) for (code, count) in current.errors.items() if count )
+		stats['latency'] = dict( (key, histogram) for (key, histogram) in current.latencies.items() if histogram.count )
+		stats['tids_in_use'] = Max_SID - len(self.sids)
+		stats['tids_waiting'] = self.sid_waiting
+		(stats['queued'], stats['unsent_bytes']) = self.depths()
+		stats['deadlines'] = len(self.scheduled)
+		
+		return stats
+	
+	def schedule(self, transaction):
+		"""
+		Register retry deadline of a transaction, replacing the one registered before. The Transceiver calls
+		transaction.expire when the deadline passes.
+		
+		Parameter
+		---------
+			transaction:	RMAP.Transaction instance
+		"""
+		self.lock.acquire()
+		self.scheduled.pop(transaction.timer, None)
+		timer = transaction.timer = self.sequence.next()
+		heapq.heappush(self.deadlines, (transaction.deadline, timer, transaction.sid))
+		self.scheduled[timer] = transaction
+		
+		# Drop deadlines of transactions done once they outnumber live ones
+		if len(self.deadlines) > 2 * len(self.scheduled) + 64:
+			self.deadlines = [ entry for entry in self.deadlines if entry[1] in self.scheduled ]
+			heapq.heapify(self.deadlines)
+		self.lock.release()
+	
+	def unschedule(self, transaction):
+		"""
+		Forget retry deadline of a transaction done, so that the engine no longer holds it.
+		
+		Parameter
+		---------
+			transaction:	RMAP.Transaction instance
+		"""
+		self.lock.acquire()
+		self.scheduled.pop(transaction.timer, None)
+		transaction.timer = None
+		self.lock.release()
+	
+	def expire(self):
+		"""
+		Expire transactions whose deadlines have passed.
+		
+		Returns
+		-------
+			timeout:	seconds until the next deadline, or None if no deadline is registered
+		"""
+		scheduled = self.scheduled
+		
+		while True:
+			now = time.time()
+			expired = []
+			
+			self.lock.acquire()
+			deadlines = self.deadlines
+			while deadlines and (deadlines[0][0] <= now or deadlines[0][1] not in scheduled):
+				(deadline, timer, sid) = heapq.heappop(deadlines)
+				transaction = scheduled.pop(timer, None)
+				if transaction is not None:
+					transaction.timer = None
+					expired.append((sid, transaction))
+			timeout = deadlines[0][0] - now if deadlines else None
+			self.lock.release()
+			
+			if not expired:
+				return timeout
+			
+			# Expiring may resubmit transactions with new deadlines, so look again afterwards
+			for (sid, transaction) in expired:
+				transaction.expire(sid)
+
+class AsyncEngine(Engine):
+	"""
+	RMAP Asynchronous Engine
+	Single-threaded RMAP engine driven by an event loop instead of the Transceiver thread.
+	
+	Replies are parsed as soon as data is received and complete their transactions in the thread running
+	the loop, without a thread hop.
+	"""
+	def __init__(self, spwif, reconnect=True, timeout=1, adaptive=False, min_timeout=0.001, max_timeout=60, batch_bytes=65536, batch_packets=256):
+		"""
+		Create RMAP Asynchronous Engine
+		
+		Takes the same parameters as RMAP.Engine.
+		
+		Note
+		----
+		* Either call poll() (or run_until_complete()) repeatedly, or register fileno() to an external event
+		  loop and call handle_read() when readable, handle_write() when writable() and writable, and
+		  expire() at the latest when the timeout it returned has passed.
+		"""
+		Engine.__init__(self, spwif, reconnect, timeout, adaptive, min_timeout, max_timeout, batch_bytes, batch_packets)
+		
+		# No Transceiver to wake up
+		self.waker.close()
+		
+		self.encoder = sw.Encoder(batch_bytes, batch_packets)
+		self.decoder = None
+		
+		# Budgets of commands in the encoder, by position of their ends in the stream sent
+		self.budgeted = collections.deque()
+	
+	def start(self):
+		"""
+		Start RMAP engine. No thread is started.
+		"""
+		# Start SpW I/F if not started
+		if not self.spwif.sock:
+			self.spwif.open()
+		
+		# Set sockets to non-blocking
+		self.spwif.settimeout(0)
+		
+		# Prepare SSDTP2 decoder
+		self.decoder = sw.Decoder()
+	
+	def stop(self):
+		"""
+		Stop RMAP engine.
+		"""
+		self.decoder = None
+		
+		# Reset sockets to blocking
+		self.spwif.settimeout(None)
+	
+	def socket(self, destination, **kwargs):
+		"""
+		Return new asynchronous socket.
+		
+		Parameter
+		---------
+			destination:	RMAP.Destination instance
+			
+		Keywords (and their default values)
+		-----------------------------------
+			retry:			None for infinite retry, or integers for number of retries (default: None)
+		"""
+		return AsyncSocket(self, destination, **kwargs)
+	
+	def request_sid(self, reply, previous=None):
+		# No other thread returns transaction ids. Process replies and time-outs while all are in use.
+		while previous is None and not self.sids:
+			self.poll()
+		
+		return Engine.request_sid(self, reply, previous)
+	
+	def request(self, packet, sid=None, generation=None, flag=sw.DataFlag_Complete_EOP, spwif=None, budget=None):
+		if sid is not None:
+			if generation != self.generations[sid]:
+				self.statistics().counters['dropped_commands'] += 1
+				if budget:
+					budget[0].release(budget[1])
+				return
+			self.sent[sid] = generation
+		
+		if flag == sw.DataFlag_Complete_EOP:
+			self.encoder.put(packet)
+			self.statistics().counters['commands'] += 1
+		else:
+			self.encoder.put(packet, flag, True)
+		if self.spwif.capture:
+			self.spwif.capture.sent([ (flag, packet) ])
+		if budget:
+			self.budgeted.append((self.encoder.total, budget))
+		
+		# Send right away as much as the socket accepts
+		self.handle_write()
+	
+	def reserve(self, budget, nbytes, timeout=None):
+		# No other thread sends commands. Process socket events while the budget is used up.
+		if budget.acquire(nbytes, 0):
+			return True
+		
+		budget.waits += 1
+		deadline = time.time() + timeout if timeout is not None else None
+		while not budget.acquire(nbytes, 0):
+			if deadline is not None and time.time() >= deadline:
+				return False
+			self.poll(None if deadline is None else max(0, deadline - time.time()))
+		
+		return True
+	
+	def fileno(self):
+		"""
+		Return socket file number.
+		"""
+		return self.spwif.fileno()
+	
+	def writable(self):
+		"""
+		Return True if there is data waiting to be sent.
+		"""
+		return bool(self.encoder)
+	
+	def data_received(self, data):
+		"""
+		Parse received SSDTP2 stream and complete transactions.
+		
+		Parameter
+		---------
+			data:		bytes received from SpaceWire interface
+		"""
+		rtime = time.time()
+		frames = self.decoder.feed(data)
+		if self.spwif.capture:
+			self.spwif.capture.received(frames)
+		self.process(frames, self.spwif, rtime)
+		if self.decoder.error:
+			raise self.decoder.error
+	
+	def handle_read(self):
+		"""
+		Receive from socket. Call when the socket is readable.
+		"""
+		try:
+			size = self.spwif.sock.recv_into(self.decoder.reserve(65536))
+			if not size:
+				raise socket.error(errno.ECONNRESET, 'Connection closed by peer')
+		except socket.error, (err, string):
+			if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+				return
+			self.handle_error()
+			return
+		
+		rtime = time.time()
+		self.statistics().counters['bytes_received'] += size
+		frames = self.decoder.commit(size)
+		if self.spwif.capture:
+			self.spwif.capture.received(frames)
+		self.process(frames, self.spwif, rtime)
+		if self.decoder.error:
+			raise self.decoder.error
+	
+	def handle_write(self):
+		"""
+		Send pending data to socket. Call when the socket is writable.
+		"""
+		if not self.encoder or not self.spwif.sock:
+			return
+		
+		try:
+			self.statistics().counters['bytes_sent'] += self.encoder.flush(self.spwif.sock)
+		except socket.error:
+			self.handle_error()
+			return
+		
+		# Release budgets of commands handed to the socket
+		position = self.encoder.total - len(self.encoder)
+		while self.budgeted and self.budgeted[0][0] <= position:
+			(end, (budget, nbytes)) = self.budgeted.popleft()
+			budget.release(nbytes)
+	
+	def handle_error(self):
+		"""
+		Reconnect after socket error, or re-raise it if reconnect is disabled. Transactions in flight are
+		resent by their retry deadlines.
+		
+		Note
+		----
+		* Call this from within the exception handler.
+		"""
+		if not self.reconnect:
+			raise
+		
+		# Socket Error. Reconnect.
+		self.statistics().counters['link_errors'] += 1
+		self.spwif.settimeout(None)
+		self.spwif.close()
+		self.spwif.open()
+		self.spwif.settimeout(0)
+		
+		# Partially transferred frames are lost with the old connection
+		self.encoder = sw.Encoder(self.batch_bytes, self.batch_packets)
+		self.decoder = sw.Decoder()
+		while self.budgeted:
+			(end, (budget, nbytes)) = self.budgeted.popleft()
+			budget.release(nbytes)
+	
+	def poll(self, timeout=None):
+		"""
+		Wait for socket events at most timeout seconds, and process them and timed-out transactions.
+		
+		Parameter
+		---------
+			timeout:	seconds to wait, None to wait until the next event or transaction deadline (Default: None)
+		"""
+		deadline = self.expire()
+		if deadline is not None and (timeout is None or deadline < timeout):
+			timeout = deadline
+		
+		sock = self.spwif.sock
+		r, w, e = select.select([ sock ], [ sock ] if self.encoder else [], [ sock ], timeout)
+		
+		if r or e:
+			# Socket errors surface from recv
+			self.handle_read()
+		if w:
+			self.handle_write()
+		
+		self.expire()
+	
+	def depths(self):
+		return (0, len(self.encoder))
+	
+	def run_until_complete(self, transaction):
+		"""
+		Poll until a transaction is done, and return its result.
+		
+		Parameter
+		---------
+			transaction:	RMAP.Transaction instance
+		"""
+		while not transaction.done():
+			self.poll()
+		
+		return transaction.result()
+
+class MultiEngine(Engine):
+	"""
+	RMAP Multi-Link Engine
+	RMAP engine spreading transactions over several SpaceWire interfaces reaching the same targets.
+	
+	Each link is served by its own Transceiver. Transaction ids, retry deadlines and replies are shared, so
+	replies are accepted on any link.
+	"""
+	# Sub-class definitions
+	class Link(object):
+		"""
+		RMAP Link
+		A SpaceWire interface with its request queue and bytes in flight.
+		"""
+		def __init__(self, spwif):
+			self.spwif = spwif
+			self.requests = Queue.Queue()
+			self.waker = Engine.Waker()
+			self.transceiver = None
+			
+			# True while connected
+			self.up = False
+			
+			# Bytes of commands and expected replies in flight
+			self.outstanding = 0
+	
+	def __init__(self, spwifs, policy=Policy_RoundRobin, reconnect=True, timeout=1, adaptive=False, min_timeout=0.001, max_timeout=60, batch_bytes=65536, batch_packets=256, interval=1):
+		"""
+		Create RMAP Multi-Link Engine
+		
+		Parameters
+		----------
+			spwifs:		list of SpaceWire.Interface instances
+			policy:		link selection policy (Default: Policy_RoundRobin)
+							Policy_RoundRobin:			links in turn
+							Policy_LeastOutstanding:	link with the least bytes in flight
+							Policy_Affinity:			link chosen by destination logical address
+			interval:	seconds between reconnection attempts of a failed link (Default: 1)
+		
+		Takes the other parameters of RMAP.Engine.
+		
+		Note
+		----
+		* When a link fails, transactions in flight on it are resent on the other links right away, without
+		  counting a retry. The link is reconnected every interval seconds until it succeeds.
+		* Commands are placed only on connected links, unless all links are down.
+		"""
+		Engine.__init__(self, spwifs[0], reconnect, timeout, adaptive, min_timeout, max_timeout, batch_bytes, batch_packets)
+		
+		# Links have wake-up pipes of their own
+		self.waker.close()
+		
+		self.links = [ self.Link(spwif) for spwif in spwifs ]
+		self.policy = policy
+		self.interval = interval
+		self.turn = itertools.count()
+		
+		# Link and bytes of each transaction id in flight
+		self.placements = {}
+	
+	def start(self):
+		"""
+		Start RMAP engine with a Transceiver for each link.
+		"""
+		self.failure = None
+		for link in self.links:
+			# Start SpW I/F if not started
+			if not link.spwif.sock:
+				link.spwif.open()
+			link.up = True
+			
+			# Wake-up pipe is closed when stopped
+			if link.waker.closed:
+				link.waker = Engine.Waker()
+			
+			# Start Transceiver, waking it up for requests queued before
+			link.transceiver = self.Transceiver(self, link)
+			link.transceiver.start()
+			link.waker.wake()
+	
+	def stop(self):
+		"""
+		Stop RMAP engine.
+		"""
+		for link in self.links:
+			link.transceiver.stop()
+	
+	def depths(self):
+		queued = 0
+		unsent = 0
+		for link in self.links:
+			queued += link.requests.qsize()
+			encoder = link.transceiver.encoder if link.transceiver else None
+			unsent += len(encoder) if encoder else 0
+		
+		return (queued, unsent)
+	
+	def select(self, packet):
+		"""
+		Choose a link for a command.
+		
+		Parameter
+		---------
+			packet:		RMAP command packet
+		
+		Returns
+		-------
+			link:		RMAP.MultiEngine.Link instance
+		"""
+		links = [ link for link in self.links if link.up ] or self.links
+		
+		if self.policy == Policy_LeastOutstanding:
+			return min(links, key=lambda link: link.outstanding)
+		elif self.policy == Policy_Affinity:
+			return links[ord(packet[0]) % len(links)]
+		else:
+			return links[self.turn.next() % len(links)]
+	
+	def request(self, packet, sid=None, generation=None, flag=sw.DataFlag_Complete_EOP, spwif=None, budget=None):
+		if self.failure:
+			raise self.failure
+		
+		if spwif is None:
+			link = self.select(packet)
+		else:
+			links = [ link for link in self.links if link.spwif is spwif ]
+			if not links:
+				raise ValueError("SpaceWire interface %s:%d is not a link of the engine." % (spwif.host, spwif.port))
+			link = links[0]
+		
+		if sid is not None:
+			# Command and expected reply (data length of read commands)
+			size = len(packet)
+			if not ord(packet[2]) & 0x20:
+				size += (ord(packet[12]) << 16) + (ord(packet[13]) << 8) + ord(packet[14])
+			
+			self.lock.acquire()
+			self.placements[sid] = (link, size)
+			link.outstanding += size
+			self.lock.release()
+		
+		link.requests.put((sid, generation, packet, flag, budget))
+		link.waker.wake()
+	
+	def release(self, sid):
+		"""
+		Forget the link of a transaction id.
+		"""
+		self.lock.acquire()
+		placement = self.placements.pop(sid, None)
+		if placement:
+			placement[0].outstanding -= placement[1]
+		self.lock.release()
+	
+	def request_sid(self, reply, previous=None):
+		if previous is not None:
+			self.release(previous)
+		
+		return Engine.request_sid(self, reply, previous)
+	
+	def return_sid(self, sid, timedout=False):
+		self.release(sid)
+		Engine.return_sid(self, sid, timedout)
+	
+	def link_down(self, link):
+		"""
+		Resend transactions in flight on a failed link on the other links.
+		"""
+		link.up = False
+		
+		self.lock.acquire()
+		sids = [ sid for (sid, placement) in self.placements.items() if placement[0] is link ]
+		self.lock.release()
+		
+		for sid in sids:
+			transaction = self.replies[sid]
+			if transaction:
+				transaction.expire(sid, timedout=False)
+	
+	def reopen(self, link, transceiver):
+		"""
+		Reconnect a failed link, retrying every interval seconds while the Transceiver is running.
+		"""
+		while transceiver.running:
+			try:
+				link.spwif.open()
+				link.up = True
+				return
+			except socket.error:
+				link.spwif.close()
+				time.sleep(self.interval)
+
+class Socket(object):
+	"""
+	RMAP Socket
+	"""
+	def __init__(self, engine, destination, **kwargs):
+		"""
+		Create RMAP Socket
+		
+		Parameters
+		----------
+			engine:			RMAP Engine (RMAP.Engine instance)
+			destination:	RMAP Destination (RMAP.Destination instance)
+		
+		Keywords (and their default values)
+		-----------------------------------
+			retry:			allowed retry counts. None for infinite retry, or integers for number of retries (default: None)
+			format:			format of read data, one of RMAP.Data_Formats (default: RMAP.Default_Format)
+			cache:			RMAP.ReadCache instance, or True for the read cache of the destination kept by the
+							engine (see Engine.read_cache), None not to cache reads (default: None)
+		
+		Note
+		----
+		* This should not be directly instantiated. Use RMAP.socket to create a socket instead.
+		* With a cache, read returns cached data of the same address, length and extended address while
+		  fresh. Only incremental reads are cached, and read_async is never. Writes through sockets sharing
+		  the cache invalidate overlapping cached reads.
+		"""
+		self.engine = engine
+		self.dest = destination
+		
+		# Read data format
+		self.format = kwargs.get('format', Default_Format)
+		assert self.format in Data_Formats, "given format %s is not supported." % (self.format)
+
+		# Read cache
+		self.cache = kwargs.get('cache', None)
+		if self.cache is True:
+			self.cache = engine.read_cache(destination)
+		
+		# Allowed retry count (default: forever)
+		self.retry = kwargs.get('retry', None)
+		
+		# Reset accumulated retry counter
+		self.retries = 0
+	
+	def read(self, address, length, **kwargs):
+		"""
+		RMAP Read
+		
+		Parameters
+		----------
+			address:	address to read
+			length:		words to read
+		
+		Keywords (and their default values)
+		-----------------------------------
+			increment:	0 for non-incremental read, 1 for incremental read (default)
+			extended_address:
+						extended read address (default: 0x00)
+			format:		format of read data, one of RMAP.Data_Formats (default: format of the socket)
+
+		Returns
+		-------
+			data:		read data (see RMAP.unpack_data)
+		
+		Raises
+		------
+			Timeout:	if retry count exceeded the allowed retry count
+			Error:		if RMAP Error
+		"""
+		if self.cache is None or not kwargs.get('increment', 1):
+			return self.read_async(address, length, **kwargs).result()
+		
+		# Cached read
+		width = self.dest.word_width
+		extended_address = kwargs.get('extended_address', 0x00)
+		data = self.cache.get(address, length * width, extended_address)
+		if data is None:
+			version = self.cache.version
+			data = self.read_async(address, length, **dict(kwargs, format='bytes')).result()
+			self.cache.put(address, length * width, extended_address, data, version)
+		
+		return unpack_data(width, data, kwargs.get('format', self.format))
+	
+	def read_async(self, address, length, **kwargs):
+		"""
+		RMAP Read without waiting for the reply
+		
+		Takes the same parameters and keywords as read.
+		
+		Returns
+		-------
+			transaction:	RMAP.Transaction instance. Its result() returns the read data.
+		
+		Note
+		----
+		* Each transaction has its own transaction id, so any number of transactions can be kept in flight
+		  from a single thread.
+		"""
+		return Transaction(self, address, length, None, kwargs).submit()
+	
+	def write(self, address, data, **kwargs):
+		"""
+		RMAP Write
+		
+		Parameters
+		----------
+			address:	address to write
+			data:		words to write, or bytes in Little-Endian order (see RMAP.pack_data)
+		
+		Allowed keywords (and theier default values)
+		--------------------------------------------
+			verify:		0 for not verifying CRCs before write, 1 for verifying CRCs before write (default)
+			ack:		0 for non-acknowledged write, 1 for acknowledged write (default)
+			increment:	0 for non-incremental write, 1 for incremental write (default)
+			extended_address:
+						extended read address (default: 0x00)
+		
+		Raises
+		------
+			Timeout:	if retry count exceeded the allowed retry count
+			Error:		if RMAP Error
+		"""
+		self.write_async(address, data, **kwargs).result()
+	
+	def write_async(self, address, data, **kwargs):
+		"""
+		RMAP Write without waiting for the reply
+		
+		Takes the same parameters and keywords as write.
+		
+		Returns
+		-------
+			transaction:	RMAP.Transaction instance. Non-acknowledged writes are done as soon as they are queued.
+		"""
+		if self.cache is None:
+			return Transaction(self, address, len(data), data, kwargs).submit()
+		
+		# Invalidate cached reads of the written range, again when done for reads in flight meanwhile
+		cache = self.cache
+		width = self.dest.word_width
+		extended_address = kwargs.get('extended_address', 0x00)
+		if not kwargs.get('increment', 1):
+			nbytes = width
+		elif isinstance(data, (str, bytearray, buffer, memoryview)):
+			nbytes = len(data)
+		else:
+			nbytes = len(data) * width
+		
+		cache.invalidate(address, nbytes, extended_address)
+		transaction = Transaction(self, address, len(data), data, kwargs).submit()
+		transaction.add_done_callback(lambda transaction: cache.invalidate(address, nbytes, extended_address))
+		
+		return transaction
+	
+	def read_region(self, address, nbytes, chunk=4096, window=8, **kwargs):
+		"""
+		RMAP Read of a memory region
+		Splits the region into chunks and keeps up to window of them in flight.
+		
+		Parameters
+		----------
+			address:	start address to read
+			nbytes:		bytes to read (multiple of word width)
+		
+		Keywords (and their default values)
+		-----------------------------------
+			chunk:		bytes per transaction (default: 4096)
+			window:		transactions kept in flight (default: 8)
+			increment:	0 for non-incremental read, 1 for incremental read (default)
+			extended_address:
+						extended read address (default: 0x00)
+		
+		Returns
+		-------
+			data:		read data (bytearray)
+		
+		Raises
+		------
+			Timeout:	if retry count exceeded the allowed retry count
+			Error:		if RMAP Error
+		"""
+		width = self.dest.word_width
+		assert nbytes % width == 0, "region length %d is not a multiple of word width %d." % (nbytes, width)
+		chunk -= chunk % width
+		assert 0 < chunk <= 0xffffff, "given chunk size is out of RMAP data length."
+		
+		increment = kwargs.get('increment', 1)
+		kwargs['format'] = 'bytes'
+		buf = bytearray(nbytes)
+		
+		def submit((offset, size)):
+			return self.read_async(address + offset if increment else address, size / width, **kwargs)
+		
+		for ((offset, size), data) in self.pipeline(region_chunks(nbytes, chunk), submit, window):
+			buf[offset:offset + size] = data
+		
+		return buf
+	
+	def iter_read(self, address, nbytes, chunk=4096, prefetch=4, **kwargs):
+		"""
+		RMAP Read of a memory region, chunk by chunk
+		Yields each chunk as soon as it arrives while up to prefetch following chunks are in flight, so that
+		processing of a chunk overlaps with the transfer of the next ones.
+		
+		Parameters
+		----------
+			address:	start address to read
+			nbytes:		bytes to read (multiple of word width)
+		
+		Keywords (and their default values)
+		-----------------------------------
+			chunk:		bytes per transaction (default: 4096)
+			prefetch:	following chunks kept in flight (default: 4)
+			increment:	0 for non-incremental read, 1 for incremental read (default)
+			extended_address:
+						extended read address (default: 0x00)
+			format:		format of chunks (see RMAP.Data_Formats, default: 'bytes')
+		
+		Returns
+		-------
+			iterator:	generator of read chunks in address order
+		
+		Raises
+		------
+			Timeout:	if retry count exceeded the allowed retry count
+			Error:		if RMAP Error
+		
+		Note
+		----
+		* At most prefetch + 1 chunks are held at a time whatever the region length.
+		* Closing the generator, or leaving a loop over it early, cancels the chunks in flight and releases
+		  their transaction IDs.
+		"""
+		width = self.dest.word_width
+		assert nbytes % width == 0, "region length %d is not a multiple of word width %d." % (nbytes, width)
+		chunk -= chunk % width
+		assert 0 < chunk <= 0xffffff, "given chunk size is out of RMAP data length."
+		assert prefetch >= 0, "given prefetch %d is negative." % (prefetch)
+		
+		increment = kwargs.get('increment', 1)
+		kwargs.setdefault('format', 'bytes')
+		
+		def submit((offset, size)):
+			return self.read_async(address + offset if increment else address, size / width, **kwargs)
+		
+		for (region, data) in self.pipeline(region_chunks(nbytes, chunk), submit, prefetch + 1):
+			yield data
+	
+	def write_region(self, address, data, chunk=4096, window=8, **kwargs):
+		"""
+		RMAP Write of a memory region
+		Splits the region into chunks and keeps up to window of them in flight.
+		
+		Parameters
+		----------
+			address:	start address to write
+			data:		bytes to write (str, bytearray, array or memoryview, length multiple of word width)
+		
+		Keywords (and their default values)
+		-----------------------------------
+			chunk:		bytes per transaction (default: 4096)
+			window:		transactions kept in flight (default: 8)
+			verify:		0 for not verifying CRCs before write, 1 for verifying CRCs before write (default)
+			ack:		0 for non-acknowledged write, 1 for acknowledged write (default)
+			increment:	0 for non-incremental write, 1 for incremental write (default)
+			extended_address:
+						extended read address (default: 0x00)
+		
+		Raises
+		------
+			Timeout:	if retry count exceeded the allowed retry count
+			Error:		if RMAP Error
+		"""
+		width = self.dest.word_width
+		nbytes = len(data)
+		assert nbytes % width == 0, "region length %d is not a multiple of word width %d." % (nbytes, width)
+		chunk -= chunk % width
+		assert 0 < chunk <= 0xffffff, "given chunk size is out of RMAP data length."
+		
+		increment = kwargs.get('increment', 1)
+		if isinstance(data, memoryview):
+			data = data.tobytes()
+		
+		def submit((offset, size)):
+			return self.write_async(address + offset if increment else address, buffer(data, offset, size), **kwargs)
+		
+		for result in self.pipeline(region_chunks(nbytes, chunk), submit, window):
+			pass
+	
+	def pipeline(self, chunks, submit, window):
+		"""
+		Run transactions for a sequence of chunks, keeping up to window of them in flight.
+		
+		Parameters
+		----------
+			chunks:		iterable of chunks
+			submit:		function submitting a chunk and returning its RMAP.Transaction
+			window:		maximum number of transactions in flight
+		
+		Returns
+		-------
+			iterator:	generator of (chunk, result) in chunk order
+		
+		Note
+		----
+		* Each chunk is retried on its own: time-outs by its transaction, and transient RMAP errors (see
+		  RMAP.Transient_Errors) by resubmitting only that chunk, both up to the retry count of the socket.
+		* Transactions still in flight are cancelled when the generator is closed or an error is raised.
+		"""
+		chunks = iter(chunks)
+		pending = collections.deque()
+		
+		try:
+			while True:
+				# Fill window
+				while len(pending) < window:
+					try:
+						chunk = chunks.next()
+					except StopIteration:
+						break
+					pending.append([ chunk, submit(chunk), 0 ])
+				
+				if not pending:
+					return
+				
+				# Wait for the oldest chunk
+				entry = pending[0]
+				try:
+					result = entry[1].result()
+				except Error, error:
+					if error.code not in Transient_Errors or (self.retry is not None and entry[2] >= self.retry):
+						raise
+					
+					# Resubmit only this chunk
+					entry[2] += 1
+					self.retries += 1
+					entry[1] = submit(entry[0])
+					continue
+				
+				pending.popleft()
+				yield (entry[0], result)
+		
+		finally:
+			for entry in pending:
+				entry[1].cancel()
+	
+	def stream(self, max_bytes=1048576, max_packets=1024, fence_bytes=4194304, **kwargs):
+		"""
+		Return a write stream of non-acknowledged writes with bounded memory use.
+		
+		Parameters
+		----------
+			max_bytes:		bytes of write data queued and not yet handed to the socket (Default: 1 MB)
+			max_packets:	writes queued and not yet handed to the socket (Default: 1024)
+			fence_bytes:	bytes written between acknowledged writes, None for none (Default: 4 MB)
+		
+		Keywords
+		--------
+			Passed to each write, e.g. increment or extended_address.
+		
+		Returns
+		-------
+			stream:		RMAP.Stream instance
+		"""
+		return Stream(self, max_bytes, max_packets, fence_bytes, **kwargs)
+
+class AsyncSocket(Socket):
+	"""
+	RMAP Asynchronous Socket
+	Socket of RMAP.AsyncEngine. read and write return RMAP.Transaction instances instead of waiting for replies.
+	"""
+	def read(self, address, length, **kwargs):
+		"""
+		RMAP Read
+		
+		Takes the same parameters and keywords as Socket.read.
+		
+		Returns
+		-------
+			transaction:	RMAP.Transaction instance completed by the engine loop with the read data.
+		"""
+		return self.read_async(address, length, **kwargs)
+	
+	def write(self, address, data, **kwargs):
+		"""
+		RMAP Write
+		
+		Takes the same parameters and keywords as Socket.write.
+		
+		Returns
+		-------
+			transaction:	RMAP.Transaction instance completed by the engine loop.
+		"""
+		return self.write_async(address, data, **kwargs)
+
+class Budget(object):
+	"""
+	Write Budget
+	Bytes and writes allowed between being queued and being handed to the socket by the Transceiver.
+	"""
+	def __init__(self, max_bytes=1048576, max_packets=1024):
+		"""
+		Create Write Budget
+		
+		Parameters
+		----------
+			max_bytes:		bytes allowed (Default: 1 MB)
+			max_packets:	writes allowed (Default: 1024)
+		"""
+		self.max_bytes = max_bytes
+		self.max_packets = max_packets
+		
+		# Bytes and writes reserved, and threads waiting
+		self.bytes = 0
+		self.packets = 0
+		self.waiting = 0
+		self.condition = threading.Condition(threading.Lock())
+		
+		# Reservations that had to wait
+		self.waits = 0
+	
+	def full(self, nbytes):
+		"""
+		Return True if nbytes cannot be reserved now. A write larger than max_bytes passes alone.
+		"""
+		return self.packets and (self.bytes + nbytes > self.max_bytes or self.packets >= self.max_packets)
+	
+	def acquire(self, nbytes, timeout=None):
+		"""
+		Reserve bytes for a write, blocking while the budget is used up.
+		
+		Parameters
+		----------
+			nbytes:		bytes to reserve
+			timeout:	seconds to wait, None to wait until reserved (Default: None)
+		
+		Returns
+		-------
+			reserved:	True if reserved, False if timed out
+		"""
+		self.condition.acquire()
+		if self.full(nbytes):
+			if timeout is not None and timeout <= 0:
+				self.condition.release()
+				return False
+			
+			self.waits += 1
+			self.waiting += 1
+			deadline = time.time() + timeout if timeout is not None else None
+			while self.full(nbytes):
+				if deadline is None:
+					self.condition.wait()
+				elif time.time() < deadline:
+					self.condition.wait(deadline - time.time())
+				else:
+					break
+			self.waiting -= 1
+			if self.full(nbytes):
+				self.condition.release()
+				return False
+		
+		self.bytes += nbytes
+		self.packets += 1
+		self.condition.release()
+		
+		return True
+	
+	def release(self, nbytes):
+		"""
+		Release bytes of a write handed to the socket. Called by the Transceiver.
+		"""
+		self.condition.acquire()
+		self.bytes -= nbytes
+		self.packets -= 1
+		if self.waiting:
+			self.condition.notify_all()
+		self.condition.release()
+	
+	def wait(self, timeout=None):
+		"""
+		Wait until every write reserved has been handed to the socket.
+		
+		Returns
+		-------
+			empty:		True if empty, False if timed out
+		"""
+		deadline = time.time() + timeout if timeout is not None else None
+		self.condition.acquire()
+		self.waiting += 1
+		while self.packets and (deadline is None or time.time() < deadline):
+			self.condition.wait(None if deadline is None else deadline - time.time())
+		self.waiting -= 1
+		empty = not self.packets
+		self.condition.release()
+		
+		return empty
+
+class Stream(object):
+	"""
+	RMAP Write Stream
+	Non-acknowledged writes within a budget of bytes and writes not yet handed to the socket, so that a
+	producer faster than the link is held back instead of queuing without bound.
+	
+	Every fence_bytes, a write is sent acknowledged instead, confirming that the target has processed the
+	writes before it. A fence failing means writes before it may have been lost, and is raised by the
+	next write or flush.
+	"""
+	def __init__(self, sock, max_bytes=1048576, max_packets=1024, fence_bytes=4194304, **kwargs):
+		"""
+		Create RMAP Write Stream
+		
+		Note
+		----
+		* This should not be directly instantiated. Use Socket.stream instead.
+		"""
+		self.sock = sock
+		self.engine = sock.engine
+		self.budget = Budget(max_bytes, max_packets)
+		self.fence_bytes = fence_bytes
+		self.kwargs = kwargs
+		
+		# Bytes written since the last fence, and fences in flight
+		self.unfenced = 0
+		self.fences = collections.deque()
+		
+		# Bytes and writes streamed, and fences sent
+		self.bytes = 0
+		self.writes = 0
+		self.fenced = 0
+	
+	def write(self, address, data, timeout=None, fence=False, **kwargs):
+		"""
+		Queue a write, blocking while the budget is used up.
+		
+		Parameters
+		----------
+			address:	address to write
+			data:		words to write, or bytes in Little-Endian order (see RMAP.pack_data)
+			timeout:	seconds to wait for the budget, None to wait until queued, 0 not to wait (Default: None)
+			fence:		True to send this write acknowledged (Default: False)
+		
+		Keywords
+		--------
+			Override the keywords of the stream for this write.
+		
+		Returns
+		-------
+			queued:		True if queued, False if the budget stayed used up for timeout seconds
+		
+		Raises
+		------
+			Timeout:	if a fence sent before failed
+			Error:		if a fence sent before failed with an RMAP error
+		"""
+		self.check()
+		
+		if isinstance(data, (str, bytearray, buffer, memoryview)):
+			nbytes = len(data)
+		else:
+			nbytes = len(data) * self.sock.dest.word_width
+		if not self.engine.reserve(self.budget, nbytes, timeout):
+			return False
+		
+		kwargs = dict(self.kwargs, budget=(self.budget, nbytes), **kwargs)
+		fence = fence or (self.fence_bytes is not None and self.unfenced + nbytes >= self.fence_bytes)
+		kwargs['ack'] = 1 if fence else 0
+		try:
+			transaction = self.sock.write_async(address, data, **kwargs)
+		except Exception:
+			# Not queued, so the Transceiver never releases the reservation
+			self.budget.release(nbytes)
+			raise
+		
+		if fence:
+			self.fences.append(transaction)
+			self.unfenced = 0
+			self.fenced += 1
+		else:
+			self.unfenced += nbytes
+		
+		self.bytes += nbytes
+		self.writes += 1
+		
+		return True
+	
+	def check(self):
+		"""
+		Forget fences done, raising the error of a failed one.
+		"""
+		while self.fences and self.fences[0].done():
+			self.fences.popleft().result()
+	
+	def flush(self, timeout=None):
+		"""
+		Wait until every write has been handed to the socket, and every fence acknowledged.
+		
+		Parameter
+		---------
+			timeout:	seconds to wait for each, None to wait until done (Default: None)
+		
+		Raises
+		------
+			Timeout:	if a fence failed or timeout passed
+			Error:		if a fence failed with an RMAP error
+		
+		Note
+		----
+		* Writes after the last fence are not confirmed. Write the last chunk with fence=True to confirm all.
+		"""
+		if not self.budget.wait(timeout):
+			raise Timeout
+		while self.fences:
+			self.fences.popleft().result(timeout)
+	
+	def stats(self):
+		"""
+		Return statistics.
+		
+		Returns
+		-------
+			stats:		dictionary of
+							bytes:			bytes written
+							writes:			writes queued
+							fences:			acknowledged writes sent
+							waits:			writes that waited for the budget
+							queued_bytes:	bytes not yet handed to the socket
+							queued_writes:	writes not yet handed to the socket
+		"""
+		return {'bytes': self.bytes, 'writes': self.writes, 'fences': self.fenced, 'waits': self.budget.waits,
+				'queued_bytes': self.budget.bytes, 'queued_writes': self.budget.packets}
+
+class Transaction(object):
+	"""
+	RMAP Transaction
+	Handle to an RMAP read or write in flight, returned by Socket.read_async and Socket.write_async.
+	
+	The RMAP engine resends the command with a new transaction id when no reply arrives within its timeout,
+	up to the retry count allowed by the socket.
+	"""
+	# Transaction states
+	(Pending, Done, Cancelled) = range(3)
+	
+	def __init__(self, sock, address, length, data, kwargs):
+		"""
+		Create RMAP Transaction
+		
+		Note
+		----
+		* This should not be directly instantiated. Use Socket.read_async or Socket.write_async instead.
+		"""
+		self.sock = sock
+		self.engine = sock.engine
+		self.address = address
+		self.length = length
+		self.data = data
+		self.kwargs = kwargs
+		self.ack = data is None or kwargs.get('ack', 1) != 0
+		self.format = kwargs.get('format', sock.format)
+		assert self.format in Data_Formats, "given format %s is not supported." % (self.format)
+		
+		self.sid = None
+		self.generation = None
+		self.key = None
+		self.qtime = None
+		self.stime = None
+		self.deadline = None
+		self.timer = None
+		self.retry = 0
+		self.state = Transaction.Pending
+		self.value = None
+		self.exception = None
+		self.callbacks = []
+		
+		self.lock = threading.Lock()
+		self.event = threading.Event()
+	
+	def submit(self, previous=None):
+		"""
+		Send command with a new transaction id.
+		
+		Parameter
+		---------
+			previous:	timed-out transaction id to return (Default: None)
+		
+		Raises
+		------
+			Failed:		if the Transceiver has failed
+		"""
+		self.sid = self.engine.request_sid(self, previous)
+		self.generation = self.engine.generations[self.sid]
+		if self.engine.failure:
+			# Registered too late to be failed by the engine
+			self.engine.return_sid(self.sid, timedout=True)
+			self.sid = None
+			raise self.engine.failure
+		
+		# Budget reserved by a stream is released once, by the first submission
+		budget = self.kwargs.pop('budget', None)
+		packet = packetize(self.sid, self.sock.dest, self.address, self.length, self.data, **self.kwargs)
+		self.engine.statistics().counters['requests'] += 1
+		
+		if not self.ack:
+			# No acknowledgement required. Done once queued.
+			self.engine.return_sid(self.sid)
+			self.sid = None
+			self.engine.request(packet, budget=budget)
+			self.lock.acquire()
+			self.finish(Transaction.Done, None, None)
+			return self
+		
+		if self.key is None:
+			# Size class of reply for reads, of command for writes
+			size = len(packet) if self.data is not None else self.length * self.sock.dest.word_width
+			self.key = (self.sock.dest.dest_address, self.sock.dest.src_address, bisect.bisect_left(Size_Classes, size))
+		
+		self.stime = time.time()
+		if self.qtime is None:
+			self.qtime = self.stime
+		timeout = self.engine.retry_timeout(self.key, self.retry)
+		if timeout is not None:
+			self.deadline = self.stime + timeout
+			self.engine.schedule(self)
+		self.engine.request(packet, self.sid, self.generation, budget=budget)
+		
+		return self
+	
+	def put(self, reply):
+		"""
+		Complete transaction with a reply. Called by the Transceiver.
+		
+		Parameter
+		---------
+			reply:		tuple of destination, status, data (bytes) and options as depacketized
+		"""
+		(dest, status, data, opt) = reply
+		statistics = self.engine.statistics()
+		
+		# Drop replies not matching the command
+		if dest.dest_address != self.sock.dest.dest_address or opt['rw'] != (self.data is not None) or \
+				(self.data is None and not status and len(data) != self.length * self.sock.dest.word_width):
+			statistics.counters['dropped_replies'] += 1
+			return
+		
+		self.lock.acquire()
+		if self.state != Transaction.Pending:
+			self.lock.release()
+			statistics.counters['dropped_replies'] += 1
+			return
+		self.engine.return_sid(self.sid)
+		self.sid = None
+		
+		now = time.time()
+		if self.retry == 0 and self.engine.adaptive:
+			# Measure round-trip time only for transactions sent once (Karn's algorithm)
+			self.engine.measure(self.key, now - self.stime)
+		
+		statistics.counters['replies'] += 1
+		statistics.latency((self.key[0], self.key[1], 'read' if self.data is None else 'write'), now - self.qtime)
+		
+		if status:
+			# RMAP error
+			statistics.errors[status] += 1
+			self.finish(Transaction.Done, None, Error(status))
+		elif data is None:
+			self.finish(Transaction.Done, None, None)
+		else:
+			self.finish(Transaction.Done, unpack_data(self.sock.dest.word_width, data, self.format), None)
+	
+	def expire(self, sid, timedout=True):
+		"""
+		Retry or give up transaction after time-out. Called by the Transceiver.
+		
+		Parameters
+		----------
+			sid:		transaction id the deadline was registered with
+			timedout:	False to resend without counting a retry, e.g. when its link failed (Default: True)
+		"""
+		self.lock.acquire()
+		if self.state != Transaction.Pending or sid != self.sid:
+			# Stale deadline
+			self.lock.release()
+			return
+		
+		# Count-up counters
+		counters = self.engine.statistics().counters
+		if timedout:
+			self.retry += 1
+			self.sock.retries += 1
+			counters['timeouts'] += 1
+		
+		# Do we retry?
+		if self.sock.retry is not None and self.retry > self.sock.retry:
+			# Exceeded allowed retry count. Return transaction id with timed-out flag set
+			counters['failures'] += 1
+			self.engine.return_sid(self.sid, timedout=True)
+			self.sid = None
+			self.finish(Transaction.Done, None, Timeout())
+		else:
+			# Resend with a new transaction id. Other errors of submit are raised with the lock released.
+			finished = False
+			try:
+				self.submit(self.sid)
+			except Failed, failure:
+				if self.sid is not None:
+					self.engine.return_sid(self.sid, timedout=True)
+					self.sid = None
+				finished = True
+				self.finish(Transaction.Done, None, failure)
+			finally:
+				if not finished:
+					self.lock.release()
+	
+	def fail(self, failure):
+		"""
+		Give up transaction as its engine failed. Called by the Transceiver.
+		
+		Parameter
+		---------
+			failure:	RMAP.Failed instance
+		"""
+		self.lock.acquire()
+		if self.state != Transaction.Pending:
+			self.lock.release()
+			return
+		
+		if self.sid is not None:
+			self.engine.return_sid(self.sid, timedout=True)
+			self.sid = None
+		self.engine.statistics().counters['failures'] += 1
+		self.finish(Transaction.Done, None, failure)
+	
+	def finish(self, state, value, exception):
+		"""
+		Set outcome, release lock and notify waiters. Must be called with lock held.
+		"""
+		self.state = state
+		self.value = value
+		self.exception = exception
+		self.lock.release()
+		
+		if self.timer is not None:
+			self.engine.unschedule(self)
+		
+		self.event.set()
+		for callback in self.callbacks:
+			try:
+				callback(self)
+			except Exception:
+				# Raising into the Transceiver would stop it
+				log.exception("Error in done-callback %r of RMAP transaction", callback)
+	
+	def cancel(self):
+		"""
+		Cancel transaction. A reply arriving afterwards is dropped.
+		
+		Returns
+		-------
+			cancelled:	True if cancelled, False if already done
+		"""
+		self.lock.acquire()
+		if self.state != Transaction.Pending:
+			self.lock.release()
+			return self.state == Transaction.Cancelled
+		
+		if self.sid is not None:
+			self.engine.return_sid(self.sid, timedout=True)
+			self.sid = None
+		self.engine.statistics().counters['cancels'] += 1
+		self.finish(Transaction.Cancelled, None, Cancelled())
+		
+		return True
+	
+	def done(self):
+		"""
+		Return True if transaction is done or cancelled.
+		"""
+		return self.state != Transaction.Pending
+	
+	def cancelled(self):
+		"""
+		Return True if transaction is cancelled.
+		"""
+		return self.state == Transaction.Cancelled
+	
+	def add_done_callback(self, callback):
+		"""
+		Register function called with this transaction when done. The function is called by the Transceiver
+		thread, or immediately if the transaction is already done.
+		"""
+		self.lock.acquire()
+		if self.state == Transaction.Pending:
+			self.callbacks.append(callback)
+			self.lock.release()
+		else:
+			self.lock.release()
+			callback(self)
+	
+	def result(self, timeout=None):
+		"""
+		Wait for transaction to complete.
+		
+		Parameter
+		---------
+			timeout:	seconds to wait, None to wait until done (Default: None)
+		
+		Returns
+		-------
+			data:		read data, or None for writes
+		
+		Raises
+		------
+			Timeout:	if retry count exceeded the allowed retry count, or not done within timeout
+			Error:		if RMAP Error
+			Cancelled:	if transaction is cancelled
+			Failed:		if the Transceiver failed
+		
+		Note
+		----
+		* Waits in steps of Wait_Interval seconds, checking that the engine has not failed.
+		"""
+		deadline = time.time() + timeout if timeout is not None else None
+		while not self.event.wait(Wait_Interval if deadline is None else max(0, min(Wait_Interval, deadline - time.time()))):
+			if self.engine.failure:
+				raise self.engine.failure
+			if deadline is not None and time.time() >= deadline:
+				raise Timeout
+		
+		if self.exception:
+			raise self.exception
+		
+		return self.value
+
+class RegisterAccess(Transaction):
+	"""
+	Converter Register Access
+	Handle to a read or write of a register of the SpaceWire-to-GigabitEther converter in flight, returned
+	by Engine.read_register_async and Engine.write_register_async.
+	
+	Register access frames carry no transaction id, so replies complete the oldest access in flight on the
+	same interface with the same operation and address. Accesses are not resent: one not answered within
+	the engine timeout fails with Timeout.
+	"""
+	def __init__(self, engine, address, value=None, spwif=None):
+		"""
+		Create Converter Register Access
+		
+		Note
+		----
+		* This should not be directly instantiated. Use Engine.read_register_async or
+		  Engine.write_register_async instead.
+		"""
+		self.engine = engine
+		self.spwif = spwif if spwif else engine.spwif
+		self.address = address
+		self.data = value
+		self.write = value is not None
+		
+		self.sid = None
+		self.deadline = None
+		self.timer = None
+		self.state = Transaction.Pending
+		self.value = None
+		self.exception = None
+		self.callbacks = []
+		
+		self.lock = threading.Lock()
+		self.event = threading.Event()
+	
+	def submit(self):
+		"""
+		Send command.
+		"""
+		if self.write:
+			(flag, payload) = (sw.ControlFlag_RegisterAccess_WriteCommand, sw.Register_Access.pack(self.address, self.data))
+		else:
+			(flag, payload) = (sw.ControlFlag_RegisterAccess_ReadCommand, sw.Register_Address.pack(self.address))
+		
+		engine = self.engine
+		engine.statistics().counters['requests'] += 1
+		engine.lock.acquire()
+		engine.register_accesses.setdefault(self.spwif, collections.deque()).append(self)
+		engine.lock.release()
+		if engine.failure:
+			# Registered too late to be failed by the engine
+			self.forget()
+			raise engine.failure
+		
+		if engine.timeout is not None:
+			self.deadline = time.time() + engine.timeout
+			engine.schedule(self)
+		try:
+			engine.request(payload, flag=flag, spwif=self.spwif)
+		except Exception, exception:
+			# Not sent, so no reply or time-out is to complete it
+			self.forget()
+			self.lock.acquire()
+			self.finish(Transaction.Done, None, exception)
+			raise
+		
+		return self
+	
+	def put(self, value):
+		"""
+		Complete access with the register value replied. Called by the Transceiver.
 		"""
+		self.lock.acquire()
+		if self.state != Transaction.Pending:
+			self.lock.release()
+			self.engine.statistics().counters['dropped_replies'] += 1
+			return
 		
-		# Local retry counter
-		retry = 0
-		
-		while True:
-			# Packetize read command
-			packet = packetize(self.sid, self.dest, address, length, **kwargs)
-			
-			# Request command
-			self.engine.request(packet)
-			
-			# Wait for reply
-			try:
-				(dest, status, data, opt) = self.reply.get(timeout=self.engine.timeout)
-				
-				# Return received data
-				if status:
-					# RMAP error
-					raise Error(status)
-				else:
-					# Return data
-					return data
-			
-			except Queue.Empty:
-				# Timed out
-				
-				# Return socket id with timed-out flag set
-				self.engine.return_sid(self.sid, timedout=True)
-				
-				# Force to empty reply queue, just to make it sure
-				try:
-					self.reply.get_nowait()
-				except Queue.Empty:
-					pass
-				
-				# Renew socket id
-				self.sid = self.engine.request_sid(self.reply)
-				
-				# Count-up counters
-				retry += 1
-				self.retries += 1
-				
-				# Do we retry?
-				if self.retry is not None and retry > self.retry:
-					# Exceeded allowed retry count
-					raise Timeout
+		self.engine.statistics().counters['replies'] += 1
+		self.finish(Transaction.Done, None if self.write else value, None)
 	
-	def write(self, address, data, **kwargs):
+	def forget(self):
 		"""
-		RMAP Write
+		Remove access from those in flight.
+		"""
+		engine = self.engine
+		engine.lock.acquire()
+		try:
+			engine.register_accesses[self.spwif].remove(self)
+		except (KeyError, ValueError):
+			pass
+		engine.lock.release()
+	
+	def expire(self, sid, timedout=True):
+		"""
+		Give up access after time-out. Called by the Transceiver.
+		"""
+		self.lock.acquire()
+		if self.state != Transaction.Pending:
+			self.lock.release()
+			return
+		self.forget()
 		
-		Parameters
-		----------
-			address:	address to write
-			length:		words to write
+		counters = self.engine.statistics().counters
+		counters['timeouts'] += 1
+		counters['failures'] += 1
+		self.finish(Transaction.Done, None, Timeout())
+	
+	def fail(self, failure):
+		"""
+		Give up access as its engine failed. Called by the Transceiver.
+		"""
+		self.lock.acquire()
+		if self.state != Transaction.Pending:
+			self.lock.release()
+			return
+		self.forget()
 		
-		Allowed keywords (and theier default values)
-		--------------------------------------------
-			verify:		0 for not verifying CRCs before write, 1 for verifying CRCs before write (default)
-			ack:		0 for non-acknowledged write, 1 for acknowledged write (default)
-			increment:	0 for non-incremental write, 1 for incremental write (default)
-			extended_address:
-						extended read address (default: 0x00)
+		self.engine.statistics().counters['failures'] += 1
+		self.finish(Transaction.Done, None, failure)
+	
+	def cancel(self):
+		"""
+		Cancel access. A reply arriving afterwards is dropped.
 		
-		Raises
-		------
-			Timeout:	if retry count exceeded the allowed retry count
-			Error:		if RMAP Error
-			
-		Note
-		----
-		* This function is not thread-safe. Simultaneous call to this function of the *same* instance is not supported.
-		  Generate new socket per thread instead.
+		Returns
+		-------
+			cancelled:	True if cancelled, False if already done
 		"""
+		self.lock.acquire()
+		if self.state != Transaction.Pending:
+			self.lock.release()
+			return self.state == Transaction.Cancelled
+		self.forget()
 		
-		# Local retry counter
-		retry = 0
+		self.engine.statistics().counters['cancels'] += 1
+		self.finish(Transaction.Cancelled, None, Cancelled())
 		
-		while True:
-			# packetize write command
-			packet = packetize(self.sid, self.dest, address, len(data), data, **kwargs)
-						
-			# Request command
-			self.engine.request(packet)
-			
-			# Acknowledgement required?
-			if kwargs.get('ack', 1) == 0:
-				# No acknowledgement required. Quit.
-				return
-			
-			# Wait for reply
-			try:
-				(dest, status, data, opt) = self.reply.get(timeout=self.engine.timeout)
-				
-				if status:
-					# RMAP error
-					raise Error(status)
-				else:
-					return
-			
-			except Queue.Empty:
-				# Timed out
-				
-				# Return socket id with timed-out flag set
-				self.engine.return_sid(self.sid, timedout=True)
-				
-				# Force to empty reply queue, just to make it sure
-				try:
-					self.reply.get_nowait()
-				except Queue.Empty:
-					pass
-				
-				# Renew socket id
-				self.sid = self.engine.request_sid(self.reply)
-				
-				# Count-up counters
-				retry += 1
-				self.retries += 1
-				
-				# Do we retry?
-				if self.retry is not None and retry > self.retry:
-					# Exceeded allowed retry count
-					raise Timeout
+		return True
 
 class Destination(object):
 	"""
@@ -546,6 +2649,300 @@ class Destination(object):
 			# Store to dictionary
 			Destination.dictionary[(dest_address, src_address)] = (self.dest_key, self.crc, self.word_width)
 
+class ReadCache(object):
+	"""
+	RMAP Read Cache
+	Cache of data read from a destination, keyed by address, length and extended address.
+	
+	Entries expire after the time-to-live of the range they were read from, and the least recently used
+	ones are evicted beyond capacity. Writes through sockets using the cache invalidate overlapping entries.
+	"""
+	# Granularity of the index of entries by address, in bytes
+	Page_Size = 4096
+	
+	def __init__(self, ttl=Cache_Volatile, capacity=1024):
+		"""
+		Create RMAP Read Cache
+		
+		Parameters
+		----------
+			ttl:		seconds to keep data read from ranges not marked, Cache_Static to keep it until invalidated,
+						or Cache_Volatile not to cache it (Default: Cache_Volatile)
+			capacity:	maximum number of entries (Default: 1024)
+		"""
+		self.ttl = ttl
+		self.capacity = capacity
+		
+		# Ranges marked with their time-to-live as (extended address, start, end, ttl)
+		self.ranges = []
+		
+		# Entries as (expiry, data, start, end) in order of use, and their keys by extended address and page
+		self.entries = collections.OrderedDict()
+		self.pages = {}
+		
+		# Counted up on each invalidation, to drop reads which were in flight meanwhile
+		self.version = 0
+		
+		# Statistics
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+		self.evictions = 0
+		
+		self.lock = threading.Lock()
+	
+	def mark(self, address, nbytes, ttl, extended_address=0x00):
+		"""
+		Set time-to-live of a range.
+		
+		Parameters
+		----------
+			address:			start address
+			nbytes:				bytes of range
+			ttl:				seconds to keep data, Cache_Static to keep it until invalidated, or Cache_Volatile
+								not to cache it
+			extended_address:	extended address (Default: 0x00)
+		
+		Note
+		----
+		* Data read across several ranges is kept for the shortest of their time-to-lives, including the
+		  default one for parts not marked.
+		"""
+		self.lock.acquire()
+		self.ranges.append((extended_address, address, address + nbytes, ttl))
+		self.lock.release()
+		
+		self.invalidate(address, nbytes, extended_address)
+	
+	def lifetime(self, address, nbytes, extended_address):
+		"""
+		Return time-to-live of data read from a range.
+		"""
+		end = address + nbytes
+		marks = sorted( (start, stop, ttl) for (marked_extended_address, start, stop, ttl) in self.ranges
+						if marked_extended_address == extended_address and start < end and address < stop )
+		
+		ttl = Cache_Static
+		position = address
+		for (start, stop, marked_ttl) in marks:
+			if start > position:
+				# Gap not marked
+				ttl = min_ttl(ttl, self.ttl)
+			ttl = min_ttl(ttl, marked_ttl)
+			position = max(position, stop)
+		if position < end:
+			ttl = min_ttl(ttl, self.ttl)
+		
+		return ttl
+	
+	def get(self, address, nbytes, extended_address=0x00):
+		"""
+		Return cached data, or None if not cached or expired.
+		"""
+		key = (extended_address, address, nbytes)
+		
+		self.lock.acquire()
+		entry = self.entries.pop(key, None)
+		if entry is not None and entry[0] is not None and entry[0] <= time.time():
+			# Expired
+			self.unindex(key)
+			entry = None
+		
+		if entry is None:
+			self.misses += 1
+			self.lock.release()
+			return None
+		
+		self.entries[key] = entry
+		self.hits += 1
+		self.lock.release()
+		
+		return entry[1]
+	
+	def put(self, address, nbytes, extended_address, data, version):
+		"""
+		Store read data.
+		
+		Parameters
+		----------
+			address:			address read
+			nbytes:				bytes read
+			extended_address:	extended address read
+			data:				read data (bytes)
+			version:			version of the cache when the read was sent. Data is not stored if the cache
+								has been invalidated since.
+		"""
+		key = (extended_address, address, nbytes)
+		
+		self.lock.acquire()
+		ttl = self.lifetime(address, nbytes, extended_address)
+		if ttl == Cache_Volatile or version != self.version:
+			self.lock.release()
+			return
+		
+		if key in self.entries:
+			del self.entries[key]
+		else:
+			for page in xrange(address / ReadCache.Page_Size, (address + nbytes - 1) / ReadCache.Page_Size + 1):
+				self.pages.setdefault((extended_address, page), set()).add(key)
+		self.entries[key] = (None if ttl is Cache_Static else time.time() + ttl, data, address, address + nbytes)
+		
+		while len(self.entries) > self.capacity:
+			(evicted, entry) = self.entries.popitem(last=False)
+			self.unindex(evicted)
+			self.evictions += 1
+		self.lock.release()
+	
+	def invalidate(self, address, nbytes, extended_address=0x00):
+		"""
+		Drop cached data overlapping a range.
+		"""
+		end = address + nbytes
+		
+		self.lock.acquire()
+		self.version += 1
+		for page in xrange(address / ReadCache.Page_Size, (end - 1) / ReadCache.Page_Size + 1):
+			for key in list(self.pages.get((extended_address, page), ())):
+				entry = self.entries.get(key)
+				if entry is not None and entry[2] < end and address < entry[3]:
+					del self.entries[key]
+					self.unindex(key)
+					self.invalidations += 1
+		self.lock.release()
+	
+	def clear(self):
+		"""
+		Drop all cached data.
+		"""
+		self.lock.acquire()
+		self.version += 1
+		self.invalidations += len(self.entries)
+		self.entries.clear()
+		self.pages.clear()
+		self.lock.release()
+	
+	def unindex(self, key):
+		"""
+		Remove key of an entry from the index by page. Must be called with lock held.
+		"""
+		(extended_address, address, nbytes) = key
+		for page in xrange(address / ReadCache.Page_Size, (address + nbytes - 1) / ReadCache.Page_Size + 1):
+			keys = self.pages.get((extended_address, page))
+			if keys is not None:
+				keys.discard(key)
+				if not keys:
+					del self.pages[(extended_address, page)]
+	
+	def statistics(self):
+		"""
+		Return statistics.
+		
+		Returns
+		-------
+			statistics:	dictionary of hits, misses, invalidations, evictions and entries
+		"""
+		return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations,
+				'evictions': self.evictions, 'entries': len(self.entries)}
+
+def min_ttl(a, b):
+	"""
+	Return the shorter of two time-to-lives, Cache_Static being the longest.
+	"""
+	if a is Cache_Static:
+		return b
+	if b is Cache_Static:
+		return a
+	
+	return min(a, b)
+
+class Histogram(object):
+	"""
+	Histogram
+	Log-bucketed histogram of latencies, bucket n counting latencies below 2**n microseconds.
+	"""
+	def __init__(self):
+		self.buckets = [ 0 ] * Histogram_Buckets
+		self.count = 0
+		self.total = 0.0
+	
+	def __repr__(self):
+		return "<Histogram count=%d mean=%.6f p50<%.6f p99<%.6f>" % (self.count, self.mean(), self.percentile(50), self.percentile(99))
+	
+	def add(self, latency):
+		"""
+		Count a latency in seconds.
+		"""
+		index = math.frexp(latency * 1e6)[1] if latency > 0 else 0
+		self.buckets[min(index, Histogram_Buckets - 1)] += 1
+		self.count += 1
+		self.total += latency
+	
+	def merge(self, other, sign=1):
+		"""
+		Add (or subtract, with sign -1) counts of another histogram.
+		"""
+		for (index, count) in enumerate(list(other.buckets)):
+			self.buckets[index] += sign * count
+		self.count += sign * other.count
+		self.total += sign * other.total
+	
+	def mean(self):
+		"""
+		Return mean latency in seconds, or 0 if empty.
+		"""
+		return self.total / self.count if self.count else 0.0
+	
+	def percentile(self, percent):
+		"""
+		Return upper bound in seconds of the bucket holding a percentile, or 0 if empty.
+		"""
+		rank = self.count * percent / 100.0
+		seen = 0
+		for (index, count) in enumerate(self.buckets):
+			seen += count
+			if count and seen >= rank:
+				return 2 ** index / 1e6
+		
+		return 0.0
+	
+	def bounds(self):
+		"""
+		Return list of (upper bound in seconds, count) of non-empty buckets.
+		"""
+		return [ (2 ** index / 1e6, count) for (index, count) in enumerate(self.buckets) if count ]
+
+class Words(array.array):
+	"""
+	Read Words
+	array.array of words read, comparing equal to tuples and lists of the same words as read data of
+	older versions did.
+	"""
+	__slots__ = []
+	
+	def __eq__(self, other):
+		if isinstance(other, (tuple, list)):
+			return len(self) == len(other) and tuple(self) == tuple(other)
+		return array.array.__eq__(self, other)
+	
+	def __ne__(self, other):
+		return not self == other
+
+def region_chunks(nbytes, chunk):
+	"""
+	Split a region into chunks.
+	
+	Parameters
+	----------
+		nbytes:		region length in bytes
+		chunk:		maximum chunk length in bytes
+	
+	Returns
+	-------
+		iterator:	generator of (offset, length) in bytes
+	"""
+	for offset in xrange(0, nbytes, chunk):
+		yield (offset, min(chunk, nbytes - offset))
+
 def packetize(tid, dest, address, length, data=None, **kwargs):
 	"""
 	RMAP Packetizer
@@ -558,8 +2955,8 @@ def packetize(tid, dest, address, length, data=None, **kwargs):
 		tid:		transaction ID
 		dest:		destination
 		address:	accessing address
-		length:		accessing length
-		data:		data to write, None to read
+		length:		accessing length in words (for write, taken from data)
+		data:		data to write (see pack_data), None to read
 	
 	Keywords (and their default values)
 	-----------------------------------
@@ -574,44 +2971,81 @@ def packetize(tid, dest, address, length, data=None, **kwargs):
 		packet:		generated RMAP packet
 	"""
 	
-	# Initialize
-	pack = struct.pack
-	blength = length * dest.word_width
+	increment = kwargs.get('increment', 1)
 	
-	# Packet Header (Big-Endian)
-	packet = pack('BB', dest.dest_address, 0x01)
 	if data is None:
 		# Read command
-		com = (0x1 << 6) + ((0x2 + kwargs.get('increment', 1)) << 2) + 0x0
+		com = (0x1 << 6) + ((0x2 + increment) << 2) + 0x0
+		blength = length * dest.word_width
 	else:
 		# Write command
-		com = (0x1 << 6) + (0x8 + (kwargs.get('verify', 1) << 2) + (kwargs.get('ack', 1) << 1) + (kwargs.get('increment', 1)) << 2) + 0x0
-	packet += pack('B', com)
-	packet += pack('BB', dest.dest_key, dest.src_address)
-	#packet += pack('BB', (tid >> 8) & 0xff, tid & 0xff)
-	packet += pack('>H', tid)
-	packet += pack('B', kwargs.get('extended_address', 0x00))
-	packet += pack('>L', address)
-	packet += pack('>BH', (blength >> 16) & 0xff, blength & 0xffff)
-	packet += pack('B', calc_crc(dest.crc, packet))
+		com = (0x1 << 6) + ((0x8 + (kwargs.get('verify', 1) << 2) + (kwargs.get('ack', 1) << 1) + increment) << 2) + 0x0
+		payload = pack_data(dest.word_width, data)
+		blength = len(payload)
+	
+	extended_address = kwargs.get('extended_address', 0x00)
+	
+	# Header template. Threads racing to create one store the same template.
+	key = (dest.dest_address, dest.dest_key, dest.src_address, dest.crc, com, extended_address)
+	try:
+		(head, crc, (tid_crc, address_crc_upper, address_crc_lower, blength_crc_upper, blength_crc_lower)) = Header_Templates[key]
+	except KeyError:
+		head = struct.pack('BBBBB', dest.dest_address, 0x01, com, dest.dest_key, dest.src_address)
+		crc = calc_crc(dest.crc, Command_Header.pack(head, 0, extended_address, 0, 0, 0, 0)[:15])
+		Header_Templates[key] = (head, crc, header_crc_tables(dest.crc))
+		(tid_crc, address_crc_upper, address_crc_lower, blength_crc_upper, blength_crc_lower) = Header_Templates[key][2]
+	
+	# Patch transaction id, address and data length into the template, as well as their contributions to the header CRC
+	(blength_upper, blength_lower) = ((blength >> 16) & 0xff, blength & 0xffff)
+	crc ^= tid_crc[tid] ^ address_crc_upper[address >> 16] ^ address_crc_lower[address & 0xffff] ^ \
+		blength_crc_upper[blength_upper] ^ blength_crc_lower[blength_lower]
+	
+	# Packet Header (Big-Endian)
+	packet = Command_Header.pack(head, tid, extended_address, address, blength_upper, blength_lower, crc)
 	
 	# Packet Data (Little-Endian)
 	if data is not None:
-		if dest.word_width == 1:
-			packet += pack('B'*len(data), *data)
-			packet += pack('B', calc_crc(dest.crc, pack('B'*len(data), *data)))
-		elif dest.word_width == 2:
-			packet += pack('<'+'H'*len(data), *data)
-			packet += pack('B', calc_crc(dest.crc, pack('<'+'H'*len(data), *data)))
-		elif dest.word_width == 4:
-			packet += pack('<'+'L'*len(data), *data)
-			packet += pack('B', calc_crc(dest.crc, pack('<'+'L'*len(data), *data)))
-		else:
-			assert False, "given word_width %d is not supported." % (dest.word_width)
-			
+		packet += payload + chr(calc_crc(dest.crc, payload))
+	
 	return packet
 
-def depacketize(packet, check_crc=False):
+def pack_data(word_width, data):
+	"""
+	Pack data to write into Little-Endian bytes.
+	
+	Parameters
+	----------
+		word_width:	word width 1, 2 or 4
+		data:		sequence of words, or a byte buffer (str, bytearray, buffer, memoryview) already in
+					Little-Endian order, or an array.array of words
+	
+	Returns
+	-------
+		payload:	packed data
+	"""
+	if not isinstance(data, (tuple, list)):
+		if isinstance(data, str):
+			return data
+		elif isinstance(data, (bytearray, buffer)):
+			return str(data)
+		elif isinstance(data, memoryview):
+			return data.tobytes()
+		elif isinstance(data, array.array) and data.itemsize == word_width:
+			if sys.byteorder == 'big' and word_width > 1:
+				data = array.array(data.typecode, data)
+				data.byteswap()
+			return data.tostring()
+	
+	if word_width == 1:
+		return struct.pack('%dB' % len(data), *data)
+	elif word_width == 2:
+		return struct.pack('<%dH' % len(data), *data)
+	elif word_width == 4:
+		return struct.pack('<%dL' % len(data), *data)
+	else:
+		assert False, "given word_width %d is not supported." % (word_width)
+
+def depacketize(packet, check_crc=False, format=None):
 	"""
 	RMAP Depacketizer
 	Depacketize RMAP protocol packets.
@@ -620,13 +3054,14 @@ def depacketize(packet, check_crc=False):
 	----------
 		packet:		RMAP packet to depacketize
 		check_crc:	True to check CRC, False not to.
+		format:		format of read data, one of RMAP.Data_Formats (default: RMAP.Default_Format)
 	
 	Returns
 	-------
 		tid:		transaction ID
 		dest:		destination
 		status:		transaction status
-		data:		data
+		data:		data (see RMAP.unpack_data)
 		keywords:	rw, verify, ack, and increment flags
 	"""
 	# Initialize
@@ -653,39 +3088,119 @@ def depacketize(packet, check_crc=False):
 	else:
 		# Read reply
 		blength = (lambda (ms, b, ls, ): (ms << 16) + (b << 8) + ls)(unpack('BBB', packet[8:11]))
-		length = blength / dest.word_width
 		(crc, ) = unpack('B', packet[11:12])
 		if check_crc:
 			assert crc == calc_crc(dest.crc, packet[0:11])
 		
 		# Data (Little-Endian)
-		if dest.word_width == 1:
-			data = unpack('B'*length, packet[12:12+blength])
-		elif dest.word_width == 2:
-			data = unpack('<'+'H'*length, packet[12:12+blength])
-		elif dest.word_width == 4:
-			data = unpack('<'+'L'*length, packet[12:12+blength])
-		else:
-			assert False, "given word_width %d is not supported." % (dest.word_width)
+		data = packet[12:12+blength]
 
 		(crc, ) = unpack('B', packet[12+blength:12+blength+1])
 		if check_crc:
-			assert crc == calc_crc(dest.crc, packet[12:12+blength])
+			assert crc == calc_crc(dest.crc, data)
+		
+		data = unpack_data(dest.word_width, data, format or Default_Format)
 	
 	return tid, dest, status, data, {'rw': rw, 'verify': verify, 'ack': ack, 'increment': increment}
 
-def calc_crc(crc, data):
+def unpack_data(word_width, data, format):
+	"""
+	Convert read data from Little-Endian bytes.
+	
+	Parameters
+	----------
+		word_width:	word width 1, 2 or 4
+		data:		read data bytes
+		format:		one of RMAP.Data_Formats
+	
+	Returns
+	-------
+		data:		read data as
+					'array':		RMAP.Words (array.array) of words in native byte order, equal to the tuple
+									of the same words
+					'bytes':		str of Little-Endian bytes
+					'memoryview':	memoryview of Little-Endian bytes
+					'numpy':		read-only NumPy array of Little-Endian words (requires NumPy)
+					'tuple':		tuple of words (compatibility with older versions)
+	"""
+	assert word_width in Array_Typecodes, "given word_width %d is not supported." % (word_width)
+	data = str(data)
+	
+	if format == 'array':
+		words = Words(Array_Typecodes[word_width])
+		words.fromstring(data)
+		if sys.byteorder == 'big' and word_width > 1:
+			words.byteswap()
+		return words
+	elif format == 'bytes':
+		return data
+	elif format == 'memoryview':
+		return memoryview(data)
+	elif format == 'numpy':
+		assert numpy, "NumPy is not installed."
+		return numpy.frombuffer(data, dtype='<u%d' % (word_width))
+	elif format == 'tuple':
+		return struct.unpack('<%d%s' % (len(data) / word_width, {1: 'B', 2: 'H', 4: 'L'}[word_width]), data)
+	else:
+		assert False, "given format %s is not supported." % (format)
+
+def header_crc_tables(crc):
+	"""
+	Return tables of contributions of transaction id, upper and lower 16 bits of address, and upper 8 and
+	lower 16 bits of data length to the command header CRC.
+	
+	The RMAP CRC is linear, so the header CRC is the CRC of the template header with zero transaction id,
+	address and data length, XORed with the contributions of these fields.
+	
+	Parameters
+	----------
+		crc:	CRC type
+	
+	Returns
+	-------
+		tables:	tuple of 65536-entry tables for transaction id, upper address and lower address, 256-entry
+				table for upper data length and 65536-entry table for lower data length
+	"""
+	try:
+		return Header_CRC_Tables[crc]
+	except KeyError:
+		pass
+	
+	# Contribution of each of 15 header bytes followed by the rest of the header
+	position = [ [ 0x00 ] * 256 for i in range(15) ]
+	for value in range(256):
+		contribution = value
+		for i in reversed(range(15)):
+			contribution = calc_crc(crc, '\x00', contribution)
+			position[i][value] = contribution
+	
+	def combine(upper, lower):
+		return [ upper[word >> 8] ^ lower[word & 0xff] for word in xrange(65536) ]
+	
+	tables = (combine(position[5], position[6]), combine(position[8], position[9]), combine(position[10], position[11]),
+			position[12], combine(position[13], position[14]))
+	Header_CRC_Tables[crc] = tables
+	
+	return tables
+
+def calc_crc(crc, data, init=0x00):
 	"""
 	Calculate RMAP packet CRC
 	
 	Parameters
 	----------
 		crc:	CRC type
-		data:	data to calculate CRC
+		data:	data to calculate CRC (str, bytearray, buffer, memoryview, array or NumPy array)
+		init:	CRC of preceding data, to continue calculation from (default: 0x00)
 	
 	Returns
 	-------
 		crc:	Calculated CRC	
+	
+	Note
+	----
+	* The CRC can be calculated piecewise, passing the CRC of the preceding pieces as init.
+	* Data of CRC_NumPy_Threshold bytes or more is processed in blocks with NumPy, if installed.
 	"""
 	
 	# This is ugly, but fast
@@ -698,7 +3213,89 @@ def calc_crc(crc, data):
 	else:
 		return 0x00
 	
-	return reduce(lambda x, y: table[(x ^ y) & 0xff], struct.unpack('B'*len(data), data), 0x00)
+	# Bytes to process
+	if isinstance(data, memoryview):
+		data = data.tobytes()
+	elif not isinstance(data, str):
+		data = str(buffer(data))
+	length = len(data)
+	
+	if length < 16:
+		for byte in bytearray(data):
+			init = table[init ^ byte]
+		return init
+	
+	tables = crc_tables(table)
+	
+	if numpy and length >= CRC_NumPy_Threshold:
+		# Block-wise: CRC of the leading bytes, then of each block XORed onto the preceding CRC shifted over the block
+		(block_table, shift_table) = tables[1]
+		block = CRC_Block_Size
+		head = length % block
+		init = calc_crc(crc, data[:head], init)
+		
+		blocks = numpy.frombuffer(data, dtype=numpy.uint8, offset=head).reshape(-1, block)
+		offsets = numpy.arange(block, dtype=numpy.intp) * 256
+		for start in xrange(0, len(blocks), 64):
+			for value in numpy.bitwise_xor.reduce(block_table[offsets + blocks[start:start + 64]], axis=1).tolist():
+				init = shift_table[init] ^ value
+		return init
+	
+	# 2 bytes at a time, with a table indexed by a Little-Endian word XORed with the CRC
+	word_table = tables[0]
+	words = array.array('H')
+	words.fromstring(data[:length & ~1])
+	if sys.byteorder == 'big':
+		words.byteswap()
+	for word in words:
+		init = word_table[word ^ init]
+	if length & 1:
+		init = table[init ^ ord(data[-1])]
+	
+	return init
+
+def crc_tables(table):
+	"""
+	Return derived tables of a CRC table for calc_crc.
+	
+	Parameters
+	----------
+		table:	256-entry CRC table
+	
+	Returns
+	-------
+		tables:	65536-entry table for 2 bytes at a time, and, if NumPy is installed, a tuple of flattened
+				position table of CRC_Block_Size x 256 entries and 256-entry table shifting a CRC over a block
+	"""
+	try:
+		(base, tables) = CRC_Tables[id(table)]
+		if base is table:
+			return tables
+	except KeyError:
+		pass
+	
+	word_table = [ table[table[word & 0xff] ^ (word >> 8)] for word in xrange(65536) ]
+	
+	if numpy:
+		# Contribution of a byte followed by k bytes in a block, in reverse order of k
+		base = numpy.array(table, dtype=numpy.uint8)
+		position = numpy.empty((CRC_Block_Size, 256), dtype=numpy.uint8)
+		position[0] = base
+		for k in xrange(1, CRC_Block_Size):
+			position[k] = base[position[k - 1]]
+		
+		shift = numpy.arange(256, dtype=numpy.uint8)
+		for k in xrange(CRC_Block_Size):
+			shift = base[shift]
+		
+		block_tables = (position[::-1].ravel(), shift.tolist())
+	else:
+		block_tables = None
+	
+	tables = (word_table, block_tables)
+	CRC_Tables[id(table)] = (table, tables)
+	
+	return tables
 
 class Timeout(Exception):
 	"""
@@ -706,6 +3303,24 @@ class Timeout(Exception):
 	"""
 	pass
 
+class Cancelled(Exception):
+	"""
+	RMAP Transaction Cancelled
+	"""
+	pass
+
+class Failed(Exception):
+	"""
+	RMAP Engine Failed
+	Raised by transactions in flight and requests made after a Transceiver stopped with an exception.
+	"""
+	def __init__(self, cause):
+		Exception.__init__(self, cause)
+		self.cause = cause
+	
+	def __str__(self):
+		return 'RMAP engine failed: %s' % (self.cause, )
+
 class Error(Exception):
 	"""
 	RMAP Error
@@ -735,6 +3350,16 @@ Error_Description = (
 	('Reserved', 'Reserved')
 )
 
+# Error codes caused by link corruption, worth retrying
+Transient_Errors = (4, 5, 6, 7)
+
+# CRC Configuration
+CRC_Block_Size = 1024
+CRC_NumPy_Threshold = 4096
+
+# Tables derived from CRC tables, keyed by id of CRC table
+CRC_Tables = {}
+
 # CRC Mode Constants
 (CRC_DraftE, CRC_DraftF, CRC_52C, CRC_Custom) = (0, 1, 2, -1)
 
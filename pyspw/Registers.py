@@ -0,0 +1,294 @@
+#
+# Registers.py
+# Register Map Module
+#
+
+import struct
+import collections
+
+# struct format characters of registers by width in bytes (Little-Endian)
+Register_Formats = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+class Register(object):
+	"""
+	Register
+	Named register with named bit fields.
+	"""
+	__slots__ = ["name", "address", "width", "fields"]
+	
+	def __init__(self, name, address, width=4, fields=None):
+		"""
+		Create Register
+		
+		Parameters
+		----------
+			name:		register name
+			address:	register address
+			width:		register width in bytes, 1, 2, 4 or 8 (Default: 4)
+			fields:		dictionary of bit fields as {name: (least significant bit, bits)} (Default: None)
+		"""
+		assert width in Register_Formats, "given register width %d is not supported." % (width)
+		for (field, (lsb, bits)) in (fields or {}).items():
+			assert 0 <= lsb and 0 < bits and lsb + bits <= 8 * width, "field %s does not fit into register %s." % (field, name)
+		
+		self.name = name
+		self.address = address
+		self.width = width
+		self.fields = dict(fields or {})
+	
+	def decode(self, value):
+		"""
+		Return dictionary of field values of a register value.
+		"""
+		return dict( (field, (value >> lsb) & ((1 << bits) - 1)) for (field, (lsb, bits)) in self.fields.items() )
+	
+	def encode(self, value, fields):
+		"""
+		Return register value with fields replaced.
+		
+		Parameters
+		----------
+			value:		register value
+			fields:		dictionary of field values as {name: value}
+		"""
+		for (field, field_value) in fields.items():
+			(lsb, bits) = self.fields[field]
+			mask = ((1 << bits) - 1) << lsb
+			value = (value & ~mask) | ((field_value << lsb) & mask)
+		
+		return value
+
+class RegisterMap(object):
+	"""
+	Register Map
+	Registers of a destination, read and written by name in as few RMAP transactions as possible.
+	
+	Registers requested together are planned into runs of contiguous addresses, merging neighbours separated
+	by at most gap bytes, and the runs are kept in flight together. Each run is decoded with a single
+	struct format.
+	"""
+	# Read plans kept, the least recently used ones being dropped beyond
+	Max_Plans = 256
+	
+	def __init__(self, sock, registers=(), gap=16, burst=65536, window=8, **kwargs):
+		"""
+		Create Register Map
+		
+		Parameters
+		----------
+			sock:		RMAP socket of the destination (RMAP.Socket instance of RMAP.Engine or RMAP.MultiEngine)
+			registers:	sequence of Register instances or of (name, address, width, fields) (Default: none)
+			gap:		maximum bytes between registers read in the same transaction (Default: 16)
+			burst:		maximum bytes per RMAP transaction (Default: 65536)
+			window:		RMAP transactions kept in flight (Default: 8)
+		
+		Keywords
+		--------
+			Passed to RMAP reads and writes, e.g. extended_address or verify.
+		"""
+		self.sock = sock
+		self.gap = gap
+		self.burst = burst
+		self.window = window
+		self.kwargs = kwargs
+		
+		self.registers = {}
+		
+		# Read plans by set of requested register names, in order of use
+		self.plans = collections.OrderedDict()
+		
+		for register in registers:
+			if isinstance(register, Register):
+				self.add(register.name, register.address, register.width, register.fields)
+			else:
+				self.add(*register)
+	
+	def add(self, name, address, width=4, fields=None):
+		"""
+		Add a register. Takes the same parameters as Register.
+		
+		Returns
+		-------
+			register:	Register instance
+		"""
+		register = Register(name, address, width, fields)
+		self.registers[name] = register
+		self.plans.clear()
+		
+		return register
+	
+	def __getitem__(self, name):
+		return self.registers[name]
+	
+	def __contains__(self, name):
+		return name in self.registers
+	
+	def __iter__(self):
+		return iter(sorted(self.registers.values(), key=lambda register: register.address))
+	
+	def plan(self, names, gap=None):
+		"""
+		Plan reads of registers.
+		
+		Parameters
+		----------
+			names:		register names
+			gap:		maximum bytes between registers read in the same transaction (Default: gap of the map)
+		
+		Returns
+		-------
+			runs:		list of (address, bytes, struct format, registers) of each read, in address order
+		"""
+		gap = self.gap if gap is None else gap
+		width = self.sock.dest.word_width
+		registers = sorted(set(self.registers[name] for name in names), key=lambda register: register.address)
+		
+		# Group registers into word aligned runs
+		groups = []
+		for register in registers:
+			start = register.address - register.address % width
+			end = -(-(register.address + register.width) // width) * width
+			if groups and start - groups[-1][1] <= gap and end - groups[-1][0] <= self.burst:
+				groups[-1][1] = max(groups[-1][1], end)
+				groups[-1][2].append(register)
+			else:
+				groups.append([ start, end, [ register ] ])
+		
+		# Format of each run, skipping bytes between registers
+		runs = []
+		for (start, end, members) in groups:
+			fmt = '<'
+			position = start
+			for register in members:
+				if register.address < position:
+					# Overlapping registers are decoded separately
+					continue
+				if register.address > position:
+					fmt += '%dx' % (register.address - position)
+				fmt += Register_Formats[register.width]
+				position = register.address + register.width
+			runs.append((start, end - start, struct.Struct(fmt), [ register for register in members ]))
+		
+		return runs
+	
+	def snapshot(self, names=None, fields=True):
+		"""
+		Read registers.
+		
+		Parameters
+		----------
+			names:		register names (Default: all registers)
+			fields:		True to include field values (Default: True)
+		
+		Returns
+		-------
+			values:		dictionary of register values by name, and of field values by "register.field" if fields
+		"""
+		names = frozenset(names if names is not None else self.registers)
+		runs = self.plans.pop(names, None)
+		if runs is None:
+			runs = self.plan(names)
+			if len(self.plans) >= RegisterMap.Max_Plans:
+				self.plans.popitem(last=False)
+		self.plans[names] = runs
+		
+		sock = self.sock
+		width = sock.dest.word_width
+		kwargs = dict(self.kwargs, format='bytes')
+		
+		def submit((address, size, fmt, registers)):
+			return sock.read_async(address, size / width, **kwargs)
+		
+		values = {}
+		for ((address, size, fmt, registers), data) in sock.pipeline(runs, submit, self.window):
+			decoded = iter(fmt.unpack_from(data))
+			position = address
+			for register in registers:
+				if register.address < position:
+					value = struct.unpack_from('<' + Register_Formats[register.width], data, register.address - address)[0]
+				else:
+					value = decoded.next()
+					position = register.address + register.width
+				values[register.name] = value
+				
+				if fields:
+					for (field, field_value) in register.decode(value).items():
+						values[register.name + '.' + field] = field_value
+		
+		return values
+	
+	def read(self, name):
+		"""
+		Read a register.
+		
+		Returns
+		-------
+			value:		register value
+		"""
+		return self.snapshot([ name ], fields=False)[name]
+	
+	def write(self, values):
+		"""
+		Write registers and fields.
+		
+		Parameters
+		----------
+			values:		dictionary of register values by name, and of field values by "register.field"
+		
+		Note
+		----
+		* Registers written only partly, by fields or by sharing words with registers not written, are read
+		  first. Adjacent registers are written in the same transaction.
+		"""
+		# Register values and field values
+		registers = {}
+		fields = {}
+		for (key, value) in values.items():
+			if key in self.registers:
+				registers[key] = value
+			else:
+				(name, dot, field) = key.rpartition('.')
+				if name not in self.registers:
+					raise KeyError("register %s is not in the map." % (name or key))
+				assert field in self.registers[name].fields, "register %s has no field %s." % (name, field)
+				fields.setdefault(name, {})[field] = value
+		
+		names = set(registers) | set(fields)
+		runs = self.plan(names, gap=0)
+		
+		# Current contents of runs not covered entirely by registers written whole
+		sock = self.sock
+		width = sock.dest.word_width
+		partial = []
+		for run in runs:
+			(address, size, fmt, members) = run
+			covered = sum(register.width for register in members if register.name in registers)
+			if covered != size or fmt.size != size:
+				partial.append(run)
+		
+		contents = {}
+		if partial:
+			kwargs = dict(self.kwargs, format='bytes')
+			
+			def submit((address, size, fmt, members)):
+				return sock.read_async(address, size / width, **kwargs)
+			
+			for ((address, size, fmt, members), data) in sock.pipeline(partial, submit, self.window):
+				contents[address] = data
+		
+		def submit((address, size, fmt, members)):
+			data = bytearray(contents.get(address, '\x00' * size))
+			for register in members:
+				offset = register.address - address
+				register_format = '<' + Register_Formats[register.width]
+				if register.name in registers:
+					value = registers[register.name]
+				else:
+					value = struct.unpack_from(register_format, data, offset)[0]
+				if register.name in fields:
+					value = register.encode(value, fields[register.name])
+				struct.pack_into(register_format, data, offset, value & ((1 << (8 * register.width)) - 1))
+			return sock.write_async(address, str(data), **self.kwargs)
+		
+		for result in sock.pipeline(runs, submit, self.window):
+			pass
@@ -6,7 +6,15 @@
 
 import socket
 import struct
+import errno
 import sys
+import time
+import math
+import collections
+import logging
+
+# Errors raised by time code callbacks
+log = logging.getLogger(__name__)
 
 # SSDTP2 Control Flags
 DataFlag_Complete_EOP = '\x00'
@@ -20,6 +28,23 @@ ControlFlag_RegisterAccess_ReadReply = '\x41'
 ControlFlag_RegisterAccess_WriteCommand = '\x50'
 ControlFlag_RegisterAccess_WriteReply = '\x51'
 
+# SSDTP2 flags known to the decoder
+Flags = frozenset([ DataFlag_Complete_EOP, DataFlag_Complete_EEP, DataFlag_Fragmented, ControlFlag_SendTimeCode,
+					ControlFlag_GotTimeCode, ControlFlag_ChangeTxSpeed, ControlFlag_RegisterAccess_ReadCommand,
+					ControlFlag_RegisterAccess_ReadReply, ControlFlag_RegisterAccess_WriteCommand,
+					ControlFlag_RegisterAccess_WriteReply ])
+
+# SSDTP2 Header: flag, reserved, and 80-bit length split into upper 16 bits and lower 64 bits (Big-Endian)
+Header = struct.Struct('!cxHQ')
+
+# Time code: 6-bit time value and 2 control flag bits
+TimeCode_Value_Mask = 0x3f
+
+# Converter register access: 32-bit register address, followed by the 32-bit value in write commands and
+# in replies (Big-Endian)
+Register_Address = struct.Struct('>L')
+Register_Access = struct.Struct('>LL')
+
 class Interface(object):
 	"""
 	SpaceWire Interface
@@ -43,6 +68,8 @@ class Interface(object):
 			keepidle:	idle seconds before sending a keepalive packet (Default: 120)
 			keepintvl:	interval seconds sending keepalive packets after the first packet (Default: 2)
 			keepcnt:	maximum counts before closing socket when no reply (Default: 4)
+			bufsize:	initial size of receive buffer in bytes, grown on demand (Default: 65536)
+			capture:	Capture.Writer teeing frames sent and received, also by RMAP engines (Default: None)
 		
 		Note
 		----
@@ -70,6 +97,17 @@ class Interface(object):
 		
 		self.sock = None
 		
+		# Receive decoder and packets decoded but not yet returned
+		self.bufsize = kwargs.get('bufsize', 65536)
+		self.decoder = Decoder(self.bufsize)
+		self.frames = collections.deque()
+		
+		# Capture of frames sent and received
+		self.capture = kwargs.get('capture')
+		
+		# Time code subscriptions, replaced rather than modified so that receiving threads need no lock
+		self.subscriptions = ()
+		
 	def open(self):
 		"""
 		Connect to target. Exceptions are not handled within this function.
@@ -81,6 +119,10 @@ class Interface(object):
 		# Set time-out
 		self.sock.settimeout(self.timeout)
 		
+		# Send packets right away. Otherwise a packet following one the target has not replied to waits
+		# for the delayed acknowledgement.
+		self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		
 		# Set keepalive
 		if self.keepalive:
 			self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
@@ -97,6 +139,10 @@ class Interface(object):
 		# Connect to target
 		self.sock.connect((self.host, self.port))
 		
+		# Drop anything left from a previous connection
+		self.decoder = Decoder(self.bufsize)
+		self.frames.clear()
+		
 		# Set Tx clock divider
 		self.settxdiv(self.div)
 	
@@ -114,49 +160,86 @@ class Interface(object):
 			packet:		packet to send
 		"""
 		# SSDTP2
-		header = '\x00\x00'
-		length = len(packet)
-		header += struct.pack('!HLL', length >> 64 & 0xffff, length >> 32 & 0xffffffff, length & 0xffffffff)
-		self.sock.sendall(header + packet)
+		self.sock.sendall(frame(DataFlag_Complete_EOP, packet))
+		if self.capture:
+			self.capture.sent([ (DataFlag_Complete_EOP, packet) ])
 		
 	def receive(self):
 		"""
 		Receive a packet from target.
 		
+		Returns
+		-------
+			packet:		received packet
+		
 		Note
 		----
 		* This function will block if time-out is not set and there's nothing to receive.
+		* Only packets are returned. Time codes are delivered to subscriptions when received (see subscribe),
+		  and other control frames, e.g. register access replies nobody waits for any more, are dropped.
 		"""
-		# SSDTP2
-		header = '\xff'
-		data = ''
-		
-		while header[0] not in (DataFlag_Complete_EOP, DataFlag_Complete_EEP):
-			header = self.sock.recv(12)
-			while len(header) < 12:
-				header += self.sock.recv(12 - len(header))
-	
-			# Parse header	
-			if header[0] in (DataFlag_Complete_EOP, DataFlag_Complete_EEP, DataFlag_Fragmented):
-				# Data
-				fragment_size = reduce(lambda x, y: (x << 8) + y, struct.unpack('B'*len(header[2:]), header[2:]))
-				tdata = ''
-				while len(tdata) < fragment_size:
-					tdata += self.sock.recv(fragment_size - len(tdata))
-				data += tdata
-				
-			elif header[0] in (ControlFlag_SendTimeCode, ControlFlag_GotTimeCode):
-				tc = self.sock.recv(2)
-				while len(tc) < 2:
-					tc += self.sock.recv(2 - len(tc))
-		
-				# Do nothing for time code for now
-				break
+		while True:
+			while not self.frames:
+				self.fill()
+			
+			(flag, payload) = self.frames.popleft()
+			
+			if flag in (DataFlag_Complete_EOP, DataFlag_Complete_EEP):
+				return payload
 	
-			else:
-				assert False
+	def fill(self):
+		"""
+		Receive once from target, and queue the frames completed.
+		"""
+		if self.decoder.error:
+			# Rather than blocking on a stream that cannot be parsed any further
+			raise self.decoder.error
+		view = self.decoder.reserve(self.bufsize)
+		size = self.sock.recv_into(view)
+		if not size:
+			raise socket.error(errno.ECONNRESET, 'Connection closed by peer')
+		frames = self.decoder.commit(size)
+		if self.capture:
+			self.capture.received(frames)
+		if self.subscriptions:
+			# Deliver time codes when received rather than when returned
+			rtime = time.time()
+			for (flag, payload) in frames:
+				if flag == ControlFlag_GotTimeCode:
+					self.timecode(ord(payload[0]), rtime)
+		self.frames.extend(frames)
+	
+	def receive_into(self, buf):
+		"""
+		Receive a packet from target into a buffer.
+		
+		Parameter
+		---------
+			buf:		writable byte buffer (bytearray, ...) to receive into
+		
+		Returns
+		-------
+			length:		length of received packet in bytes
+		
+		Raises
+		------
+			ValueError:	if the packet does not fit into buf. The packet is discarded.
+		
+		Note
+		----
+		* This function will block if time-out is not set and there's nothing to receive.
+		* The packet is not received straight into buf. It is received into the buffer of the decoder with
+		  other frames, copied out of it as receive returns it, and copied again into buf. This saves
+		  allocating the caller's buffer, not copies.
+		"""
+		packet = self.receive()
+		length = len(packet)
+		view = memoryview(buf)
+		if length > len(view):
+			raise ValueError("received packet does not fit into %d byte buffer." % len(view))
+		view[:length] = packet
 		
-		return data
+		return length
 	
 	def settxdiv(self, div):
 		"""
@@ -178,7 +261,160 @@ class Interface(object):
 		
 		# Set it if online
 		if self.sock:
-			self.sock.sendall('\x38\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x02' + struct.pack('B', div) + '\x00')
+			self.send_control(ControlFlag_ChangeTxSpeed, [ struct.pack('B', div) + '\x00' ])
+	
+	def send_timecode(self, value):
+		"""
+		Send a time code.
+		
+		Parameter
+		---------
+			value:	time code, 6-bit time value and 2 control flag bits (0 <= value <= 255)
+		
+		Note
+		----
+		* While an RMAP engine runs on this interface, use its send_timecode instead, which keeps the
+		  SSDTP2 stream in order.
+		"""
+		assert 0 <= value <= 0xff, "time code 0x%x is out of range." % (value)
+		
+		self.send_control(ControlFlag_SendTimeCode, [ struct.pack('B', value) + '\x00' ])
+	
+	def send_control(self, flag, payloads):
+		"""
+		Send control frames in one go.
+		
+		Parameters
+		----------
+			flag:		SSDTP2 control flag
+			payloads:	list of payloads of the frames
+		"""
+		self.sock.sendall(''.join( frame(flag, payload) for payload in payloads ))
+		if self.capture:
+			self.capture.sent([ (flag, payload) for payload in payloads ])
+	
+	def read_registers(self, addresses):
+		"""
+		Read converter registers. All read commands are sent before waiting for the replies.
+		
+		Parameter
+		---------
+			addresses:	list of register addresses
+		
+		Returns
+		-------
+			values:		list of register values
+		
+		Note
+		----
+		* While an RMAP engine runs on this interface, use its read_registers instead.
+		* Frames other than register replies received meanwhile are kept for receive.
+		"""
+		self.send_control(ControlFlag_RegisterAccess_ReadCommand, [ Register_Address.pack(address) for address in addresses ])
+		
+		return self.register_replies(ControlFlag_RegisterAccess_ReadReply, addresses)
+	
+	def write_registers(self, values):
+		"""
+		Write converter registers. All write commands are sent before waiting for the replies.
+		
+		Parameter
+		---------
+			values:		list of (register address, value)
+		
+		Note
+		----
+		* While an RMAP engine runs on this interface, use its write_registers instead.
+		"""
+		self.send_control(ControlFlag_RegisterAccess_WriteCommand, [ Register_Access.pack(address, value) for (address, value) in values ])
+		self.register_replies(ControlFlag_RegisterAccess_WriteReply, [ address for (address, value) in values ])
+	
+	def read_register(self, address):
+		"""
+		Read a converter register.
+		"""
+		return self.read_registers([ address ])[0]
+	
+	def write_register(self, address, value):
+		"""
+		Write a converter register.
+		"""
+		self.write_registers([ (address, value) ])
+	
+	def register_replies(self, flag, addresses):
+		"""
+		Wait for register access replies, taking them out of the frames received.
+		
+		Parameters
+		----------
+			flag:		ControlFlag_RegisterAccess_ReadReply or ControlFlag_RegisterAccess_WriteReply
+			addresses:	register addresses of the commands sent
+		
+		Returns
+		-------
+			values:		list of register values replied, in the order of addresses
+		"""
+		# Indices waiting for a reply by address, answered in order
+		waiting = collections.defaultdict(collections.deque)
+		for (index, address) in enumerate(addresses):
+			waiting[address].append(index)
+		values = [ None ] * len(addresses)
+		remaining = len(addresses)
+		
+		while True:
+			others = collections.deque()
+			for (frame_flag, payload) in self.frames:
+				if frame_flag == flag:
+					(address, value) = unpack_register(payload)
+					if waiting.get(address):
+						values[waiting[address].popleft()] = value
+						remaining -= 1
+						continue
+				others.append((frame_flag, payload))
+			self.frames = others
+			
+			if not remaining:
+				return values
+			self.fill()
+	
+	def subscribe(self, size=1024, callback=None):
+		"""
+		Subscribe to time codes received.
+		
+		Parameters
+		----------
+			size:		time codes kept until read (Default: 1024)
+			callback:	function called with (time code, receive time) of each time code, in the receiving
+						thread (Default: None)
+		
+		Returns
+		-------
+			subscription:	SpaceWire.TimeCodes instance
+		"""
+		subscription = TimeCodes(size, callback)
+		self.subscriptions = self.subscriptions + (subscription, )
+		
+		return subscription
+	
+	def unsubscribe(self, subscription):
+		"""
+		Stop delivering time codes to a subscription.
+		"""
+		self.subscriptions = tuple( other for other in self.subscriptions if other is not subscription )
+	
+	def timecode(self, value, rtime=None):
+		"""
+		Deliver a time code received to subscriptions. Called by whoever parses the received stream.
+		
+		Parameters
+		----------
+			value:		time code
+			rtime:		host time the time code was received at (Default: now)
+		"""
+		if rtime is None:
+			rtime = time.time()
+		for subscription in self.subscriptions:
+			subscription.put(value, rtime)
 	
 	def settimeout(self, timeout):
 		"""
@@ -196,4 +432,433 @@ class Interface(object):
 		Return socket file number.
 		"""
 		if self.sock:
-			return self.sock.fileno()
\ No newline at end of file
+			return self.sock.fileno()
+
+class TimeCodes(object):
+	"""
+	Time Code Subscription
+	Ring buffer of time codes received, with their host receive times, and statistics of their intervals.
+	
+	A single thread puts time codes, and readers take them without a lock: a slot is written before the
+	count is advanced, and slots overwritten while being read are counted as lost.
+	"""
+	def __init__(self, size=1024, callback=None):
+		"""
+		Create Time Code Subscription
+		
+		Parameters
+		----------
+			size:		time codes kept until read (Default: 1024)
+			callback:	function called with (time code, receive time) of each time code (Default: None)
+		"""
+		self.size = size
+		self.callback = callback
+		self.ring = [ None ] * size
+		
+		# Time codes put, and read
+		self.count = 0
+		self.index = 0
+		self.lost = 0
+		
+		self.reset()
+	
+	def reset(self):
+		"""
+		Restart statistics.
+		"""
+		self.received = 0
+		self.last = None
+		self.discontinuities = 0
+		
+		# Intervals: count, mean and sum of squared deviations (Welford), minimum and maximum
+		self.intervals = 0
+		self.mean = 0.0
+		self.m2 = 0.0
+		self.minimum = None
+		self.maximum = None
+	
+	def put(self, value, rtime):
+		"""
+		Put a time code received.
+		
+		Parameters
+		----------
+			value:		time code
+			rtime:		host receive time
+		"""
+		self.ring[self.count % self.size] = (value, rtime)
+		self.count += 1
+		
+		last = self.last
+		if last is not None:
+			if value & TimeCode_Value_Mask != (last[0] + 1) & TimeCode_Value_Mask:
+				self.discontinuities += 1
+			interval = rtime - last[1]
+			self.intervals += 1
+			delta = interval - self.mean
+			self.mean += delta / self.intervals
+			self.m2 += delta * (interval - self.mean)
+			if self.minimum is None or interval < self.minimum:
+				self.minimum = interval
+			if self.maximum is None or interval > self.maximum:
+				self.maximum = interval
+		self.last = (value, rtime)
+		self.received += 1
+		
+		if self.callback:
+			try:
+				self.callback(value, rtime)
+			except Exception:
+				# Raising into the receiving thread would stop it
+				log.exception("Error in time code callback %r", self.callback)
+	
+	def get(self):
+		"""
+		Return time codes received since the last call.
+		
+		Returns
+		-------
+			timecodes:	list of (time code, host receive time), oldest first
+		"""
+		count = self.count
+		index = max(self.index, count - self.size)
+		timecodes = [ self.ring[i % self.size] for i in xrange(index, count) ]
+		
+		# Drop slots the writer may have overwritten meanwhile
+		overwritten = self.count - self.size - index
+		if overwritten > 0:
+			timecodes = timecodes[overwritten:]
+			index += overwritten
+		
+		self.lost += index - self.index
+		self.index = count
+		
+		return timecodes
+	
+	def latest(self):
+		"""
+		Return the last time code received as (time code, host receive time), or None.
+		"""
+		return self.last
+	
+	def stats(self, reset=False):
+		"""
+		Return statistics of time codes received.
+		
+		Parameter
+		---------
+			reset:		True to restart statistics after this call (Default: False)
+		
+		Returns
+		-------
+			stats:		dictionary of
+							received:			time codes received
+							lost:				time codes overwritten before being read by get
+							discontinuities:	time values not following the previous one
+							period:				mean interval in seconds
+							jitter:				standard deviation of intervals in seconds
+							jitter_pp:			largest minus smallest interval in seconds
+							min_interval:		smallest interval in seconds
+							max_interval:		largest interval in seconds
+		"""
+		stats = {'received': self.received, 'lost': self.lost, 'discontinuities': self.discontinuities,
+				'period': self.mean, 'jitter': math.sqrt(self.m2 / self.intervals) if self.intervals else 0.0,
+				'jitter_pp': self.maximum - self.minimum if self.intervals else 0.0,
+				'min_interval': self.minimum, 'max_interval': self.maximum}
+		if reset:
+			self.reset()
+		
+		return stats
+
+class Decoder(object):
+	"""
+	SSDTP2 Decoder
+	Incremental SSDTP2 stream parser. Received bytes are appended to a growable buffer, and complete
+	frames are returned in bulk, fragmented packets being joined.
+	"""
+	def __init__(self, size=65536):
+		"""
+		Create SSDTP2 Decoder
+		
+		Parameter
+		---------
+			size:		initial buffer size in bytes, grown on demand (Default: 65536)
+		"""
+		self.buf = bytearray(size)
+		self.view = memoryview(self.buf)
+		
+		# Unparsed data lies in buf[head:tail]
+		self.head = 0
+		self.tail = 0
+		
+		# Fragments of a packet not yet completed
+		self.fragments = []
+		
+		# ProtocolError met after the frames last returned, raised by the next commit
+		self.error = None
+	
+	def reserve(self, size):
+		"""
+		Return a writable buffer of at least size bytes to receive into, e.g. with socket.recv_into.
+		Call commit with the received length afterwards.
+		
+		Parameter
+		---------
+			size:		bytes to reserve
+		"""
+		if len(self.buf) - self.tail < size:
+			pending = self.tail - self.head
+			if pending + size > len(self.buf):
+				# Grow buffer
+				buf = bytearray(max(2 * len(self.buf), pending + size))
+				buf[:pending] = self.view[self.head:self.tail]
+				self.buf = buf
+				self.view = memoryview(buf)
+			else:
+				# Move unparsed data to the front (through a copy, as the ranges may overlap)
+				self.buf[:pending] = self.buf[self.head:self.tail]
+			self.head = 0
+			self.tail = pending
+		
+		return self.view[self.tail:]
+	
+	def commit(self, size):
+		"""
+		Parse bytes received into the reserved buffer.
+		
+		Parameter
+		---------
+			size:		bytes received
+		
+		Returns
+		-------
+			frames:		list of complete frames as (flag, payload). flag is DataFlag_Complete_EOP or
+						DataFlag_Complete_EEP for packets, or the control flag for control frames.
+		
+		Raises
+		------
+			ProtocolError:	if the next frame has an unknown flag. The stream cannot be parsed any further.
+							Frames completed before it are returned first, error is set, and the next call
+							raises.
+		"""
+		self.tail += size
+		if self.error:
+			raise self.error
+		
+		frames = []
+		buf = self.buf
+		view = self.view
+		head = self.head
+		tail = self.tail
+		unpack_from = Header.unpack_from
+		
+		while tail - head >= 12:
+			(flag, upper, lower) = unpack_from(buf, head)
+			if flag not in Flags:
+				# The length cannot be trusted either. Return frames completed before first.
+				self.error = ProtocolError("unknown SSDTP2 flag 0x%02x." % ord(flag))
+				if frames:
+					break
+				self.head = head
+				self.tail = tail
+				raise self.error
+			
+			end = head + 12 + ((upper << 64) + lower)
+			if end > tail:
+				# Incomplete frame
+				break
+			
+			payload = view[head + 12:end].tobytes()
+			head = end
+			
+			if flag == DataFlag_Fragmented:
+				self.fragments.append(payload)
+			elif flag in (DataFlag_Complete_EOP, DataFlag_Complete_EEP):
+				if self.fragments:
+					self.fragments.append(payload)
+					payload = ''.join(self.fragments)
+					self.fragments = []
+				frames.append((flag, payload))
+			else:
+				frames.append((flag, payload))
+		
+		if head == tail:
+			# Everything parsed. Restart from the front of the buffer.
+			head = tail = 0
+		self.head = head
+		self.tail = tail
+		
+		return frames
+	
+	def feed(self, data):
+		"""
+		Parse received bytes.
+		
+		Parameter
+		---------
+			data:		received bytes
+		
+		Returns
+		-------
+			frames:		list of complete frames as (flag, payload), see commit
+		"""
+		size = len(data)
+		self.reserve(size)[:size] = data
+		
+		return self.commit(size)
+
+class Encoder(object):
+	"""
+	SSDTP2 Encoder
+	Queue of outgoing SSDTP2 frames. Queued frames are joined into batches of limited size, each sent
+	from a cursor advanced by partial sends instead of slicing off what was sent.
+	"""
+	def __init__(self, batch_bytes=65536, batch_packets=256):
+		"""
+		Create SSDTP2 Encoder
+		
+		Parameters
+		----------
+			batch_bytes:	bytes to join into one batch, unless a single frame is larger (Default: 65536)
+			batch_packets:	frames to join into one batch (Default: 256)
+		"""
+		self.batch_bytes = batch_bytes
+		self.batch_packets = batch_packets
+		
+		# Frames not joined yet, and those to join first
+		self.frames = collections.deque()
+		self.urgent = collections.deque()
+		
+		# Batch being sent, bytes of it already sent, and bytes waiting to be sent in total
+		self.batch = ''
+		self.offset = 0
+		self.size = 0
+		
+		# Bytes ever queued. Bytes ever sent are total - size.
+		self.total = 0
+	
+	def __len__(self):
+		"""
+		Return bytes waiting to be sent.
+		"""
+		return self.size
+	
+	def put(self, packet, flag=DataFlag_Complete_EOP, first=False):
+		"""
+		Queue a frame.
+		
+		Parameters
+		----------
+			packet:		payload of the frame
+			flag:		SSDTP2 flag of the frame (Default: DataFlag_Complete_EOP)
+			first:		True to send the frame right after the batch being sent, ahead of frames queued
+						without first. Frames queued with first keep their order. (Default: False)
+		"""
+		data = frame(flag, packet)
+		if first:
+			self.urgent.append(data)
+		else:
+			self.frames.append(data)
+		self.size += len(data)
+		self.total += len(data)
+	
+	def send(self, sock):
+		"""
+		Send from the current batch, joining the next one if it has been sent. Socket errors, including
+		EAGAIN on non-blocking sockets, are not handled within this function.
+		
+		Parameter
+		---------
+			sock:		socket to send to
+		
+		Returns
+		-------
+			sent:		bytes sent
+		"""
+		if self.offset == len(self.batch):
+			frames = self.frames
+			if self.urgent:
+				frames.extendleft(reversed(self.urgent))
+				self.urgent.clear()
+			if not frames:
+				return 0
+			
+			if len(frames) <= self.batch_packets and self.size <= self.batch_bytes:
+				# Everything fits into one batch
+				self.batch = ''.join(frames)
+				frames.clear()
+			else:
+				batch = [ frames.popleft() ]
+				size = len(batch[0])
+				while frames and len(batch) < self.batch_packets and size + len(frames[0]) <= self.batch_bytes:
+					batch.append(frames.popleft())
+					size += len(batch[-1])
+				self.batch = ''.join(batch)
+			self.offset = 0
+		
+		if self.offset:
+			sent = sock.send(buffer(self.batch, self.offset))
+		else:
+			sent = sock.send(self.batch)
+		self.offset += sent
+		self.size -= sent
+		
+		return sent
+	
+	def flush(self, sock):
+		"""
+		Send queued frames until all are sent or the socket would block.
+		
+		Parameter
+		---------
+			sock:		non-blocking socket to send to
+		
+		Returns
+		-------
+			sent:		bytes sent
+		"""
+		total = 0
+		while self.size:
+			try:
+				sent = self.send(sock)
+			except socket.error, (err, string):
+				if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+					break
+				raise
+			if not sent:
+				break
+			total += sent
+		
+		return total
+
+class ProtocolError(IOError):
+	"""
+	SSDTP2 Protocol Error
+	"""
+	pass
+
+def frame(flag, payload):
+	"""
+	Build an SSDTP2 frame.
+	
+	Parameters
+	----------
+		flag:		SSDTP2 flag
+		payload:	payload of the frame
+	"""
+	length = len(payload)
+	return Header.pack(flag, length >> 64 & 0xffff, length & 0xffffffffffffffff) + payload
+
+def unpack_register(payload):
+	"""
+	Unpack a converter register access reply.
+	
+	Returns
+	-------
+		address:	register address
+		value:		register value, or None if the reply carries none
+	"""
+	(address, ) = Register_Address.unpack_from(payload)
+	value = Register_Address.unpack_from(payload, 4)[0] if len(payload) >= Register_Access.size else None
+	
+	return (address, value)
@@ -3,4 +3,4 @@
 # Python SpaceWire Library
 #
 # 2011/05/30	K. Sakai (sakai@astro.isas.jaxa.jp)
-__all__ = [ "SpaceWire", "RMAP" ]
\ No newline at end of file
+__all__ = [ "SpaceWire", "RMAP", "Memory", "Registers", "Emulator", "Capture" ]
\ No newline at end of file
@@ -0,0 +1,77 @@
+#
+# test_capture.py
+# Capture Tests, against an in-process Emulator.Target
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyspw import SpaceWire, RMAP, Capture
+from tests.test_engine import EngineTestCase
+
+class TestCapture(EngineTestCase):
+	def setUp(self):
+		EngineTestCase.setUp(self)
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, 'capture.pswc')
+		
+		# Capture some traffic of an engine
+		writer = Capture.Writer(self.path, interval=0.001)
+		engine = RMAP.Engine(SpaceWire.Interface(self.target.host, self.target.port, capture=writer))
+		engine.start()
+		sock = engine.socket(self.dest, retry=1, format='bytes')
+		sock.write(0x100, '\x01\x02\x03\x04')
+		for i in range(16):
+			sock.read(0x100, 4)
+		engine.stop()
+		engine.spwif.close()
+		writer.close()
+		self.records = writer.records
+	
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+		EngineTestCase.tearDown(self)
+	
+	def test_reader(self):
+		reader = Capture.Reader(self.path)
+		records = list(reader)
+		reader.close()
+		
+		self.assertEqual(len(records), self.records)
+		# Commands, besides control frames sent on opening
+		sent = [ record for record in records if record[1] == Capture.Direction_Sent and record[2] == SpaceWire.DataFlag_Complete_EOP ]
+		received = [ record for record in records if record[1] == Capture.Direction_Received ]
+		self.assertEqual((len(sent), len(received)), (17, 17))
+		self.assertEqual(RMAP.depacketize(received[-1][3], format='bytes')[3], '\x01\x02\x03\x04')
+		
+		# Timestamps never go back
+		times = [ record[0] for record in records ]
+		self.assertEqual(times, sorted(times))
+	
+	def test_truncated(self):
+		size = os.path.getsize(self.path)
+		with open(self.path, 'r+b') as f:
+			f.truncate(size - 1)
+		reader = Capture.Reader(self.path)
+		self.assertEqual(len(list(reader)), self.records - 1)
+		reader.close()
+	
+	def test_decode(self):
+		result = Capture.decode(self.path, repeat=2)
+		self.assertEqual((result['frames'], result['replies'], result['malformed']), (17, 17, 0))
+	
+	def test_replay(self):
+		reader = Capture.Reader(self.path)
+		sent = len([ record for record in reader if record[1] == Capture.Direction_Sent ])
+		reader.close()
+		
+		result = Capture.replay(self.path, self.target.host, self.target.port, idle=2)
+		self.assertEqual((result['frames_sent'], result['replies'], result['expected'], result['malformed']), (sent, 17, 17, 0))
+		
+		result = Capture.replay(self.path, self.target.host, self.target.port, paced=True, speed=10, idle=2)
+		self.assertEqual(result['replies'], 17)
+
+if __name__ == '__main__':
+	unittest.main()
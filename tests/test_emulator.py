@@ -0,0 +1,104 @@
+#
+# test_emulator.py
+# Emulated Link Tests, against an in-process Emulator.Target
+#
+
+import time
+import unittest
+
+from pyspw import SpaceWire, RMAP, Emulator
+from tests.test_engine import EngineTestCase
+
+class TestLink(EngineTestCase):
+	def shape(self, **kwargs):
+		"""
+		Replace the target with one emulating link characteristics.
+		"""
+		self.target.stop()
+		self.target = Emulator.Target(size=0x100000, seed=1, **kwargs)
+		self.target.start()
+	
+	def test_latency(self):
+		self.shape(latency=0.1)
+		sock = self.engine().socket(self.dest, retry=1, format='bytes')
+		stime = time.time()
+		self.assertEqual(sock.read(0, 4), '\x00' * 4)
+		self.assertGreaterEqual(time.time() - stime, 0.1)
+	
+	def test_wire_speed(self):
+		# About 195 kB/s at the Tx clock divider set by the client, 10 bits per byte
+		self.shape(wire_speed=True)
+		engine = RMAP.Engine(SpaceWire.Interface(self.target.host, self.target.port, div=63))
+		engine.start()
+		self.engines.append(engine)
+		sock = engine.socket(self.dest, retry=1, format='bytes')
+		stime = time.time()
+		sock.read(0, 32768)
+		elapsed = time.time() - stime
+		self.assertGreaterEqual(elapsed, 32768 * 10 / (125e6 / 64) * 0.9)
+		self.assertLess(elapsed, 2)
+	
+	def test_drop(self):
+		# Commands and replies lost time out and are resent
+		self.shape(drop=0.3)
+		engine = self.engine(timeout=0.05)
+		sock = engine.socket(self.dest, retry=20, format='bytes')
+		for i in range(16):
+			sock.write(0x100 + i * 4, chr(i) * 4)
+		for i in range(16):
+			self.assertEqual(sock.read(0x100 + i * 4, 4), chr(i) * 4)
+		stats = engine.stats()
+		self.assertGreater(stats['timeouts'], 0)
+		self.assertEqual(stats['tids_in_use'], 0)
+	
+	def test_drop_all(self):
+		self.shape(drop=1)
+		engine = self.engine(timeout=0.02)
+		sock = engine.socket(self.dest, retry=2)
+		self.assertRaises(RMAP.Timeout, sock.read, 0, 4)
+		self.assertEqual(engine.stats()['timeouts'], 3)
+	
+	def test_eep(self):
+		# Replies cut short are not taken, and time out
+		self.shape(eep=1)
+		engine = self.engine(timeout=0.05)
+		sock = engine.socket(self.dest, retry=2)
+		self.assertRaises(RMAP.Timeout, sock.read, 0, 4)
+		self.assertEqual(engine.stats()['eeps'], 3)
+		
+		# Until a retry gets a whole reply
+		self.target.eep = 0.5
+		sock = engine.socket(self.dest, retry=20, format='bytes')
+		for i in range(16):
+			self.assertEqual(sock.read(0, 4), '\x00' * 4)
+	
+	def test_eep_interface(self):
+		self.shape(eep=1)
+		spwif = SpaceWire.Interface(self.target.host, self.target.port, timeout=5)
+		spwif.open()
+		try:
+			# The cut reply fails to depacketize
+			spwif.send(RMAP.packetize(1, self.dest, 0, 4))
+			self.assertRaises(Exception, RMAP.depacketize, spwif.receive(), True)
+		finally:
+			spwif.close()
+	
+	def test_reorder(self):
+		# Replies overtaken by later ones still complete their transactions
+		self.shape(reorder=0.5, reorder_delay=0.05)
+		engine = self.engine(timeout=1)
+		sock = engine.socket(self.dest, retry=1, format='bytes')
+		for transaction in [ sock.write_async(0x200 + i * 4, chr(i) * 4) for i in range(64) ]:
+			transaction.result(5)
+		
+		done = []
+		transactions = [ sock.read_async(0x200 + i * 4, 4) for i in range(64) ]
+		for (i, transaction) in enumerate(transactions):
+			transaction.add_done_callback(lambda transaction, i=i: done.append(i))
+		for (i, transaction) in enumerate(transactions):
+			self.assertEqual(transaction.result(5), chr(i) * 4)
+		self.assertNotEqual(done, sorted(done))
+		self.assertEqual(engine.stats()['timeouts'], 0)
+
+if __name__ == '__main__':
+	unittest.main()
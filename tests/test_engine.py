@@ -0,0 +1,546 @@
+#
+# test_engine.py
+# RMAP Engine Tests, against an in-process Emulator.Target
+#
+
+import os
+import time
+import struct
+import threading
+import logging
+import weakref
+import unittest
+
+from pyspw import SpaceWire, RMAP, Emulator
+
+class Records(logging.Handler):
+	"""
+	Logging handler keeping records.
+	"""
+	def __init__(self):
+		logging.Handler.__init__(self)
+		self.records = []
+	
+	def emit(self, record):
+		self.records.append(record)
+
+def open_fds():
+	"""
+	Return number of file descriptors open in this process.
+	"""
+	return len(os.listdir('/proc/self/fd'))
+
+class EngineTestCase(unittest.TestCase):
+	"""
+	Engine started on an emulated target, with a socket to it.
+	"""
+	def setUp(self):
+		self.target = Emulator.Target(size=0x100000)
+		self.target.start()
+		self.dest = RMAP.Destination(src_address=0xfe, dest_address=0x30, dest_key=0x02, crc=RMAP.CRC_DraftF, word_width=1)
+		self.engines = []
+		
+		# Keep errors logged by engines off the test output
+		self.log = Records()
+		RMAP.log.addHandler(self.log)
+		RMAP.log.propagate = False
+	
+	def tearDown(self):
+		for engine in self.engines:
+			engine.stop()
+			engine.spwif.close()
+		self.target.stop()
+		
+		RMAP.log.removeHandler(self.log)
+		RMAP.log.propagate = True
+	
+	def engine(self, **kwargs):
+		engine = RMAP.Engine(SpaceWire.Interface(self.target.host, self.target.port), **kwargs)
+		engine.start()
+		self.engines.append(engine)
+		
+		return engine
+	
+	def settle(self):
+		"""
+		Wait until the target has closed connections closed by the client.
+		"""
+		deadline = time.time() + 5
+		while self.target.connections and time.time() < deadline:
+			time.sleep(0.01)
+
+class TestEngine(EngineTestCase):
+	def test_read_write(self):
+		sock = self.engine().socket(self.dest, retry=1, format='bytes')
+		sock.write(0x100, '\x01\x02\x03\x04')
+		self.assertEqual(sock.read(0x100, 4), '\x01\x02\x03\x04')
+	
+	def test_formats(self):
+		engine = self.engine()
+		dest = RMAP.Destination(src_address=0xfe, dest_address=0x30, dest_key=0x02, crc=RMAP.CRC_DraftF, word_width=2)
+		sock = engine.socket(dest, retry=1)
+		sock.write(0x100, (0x0201, 0x0403))
+		for format in RMAP.Data_Formats:
+			if format == 'numpy' and not RMAP.numpy:
+				continue
+			data = sock.read(0x100, 2, format=format)
+			if format in ('bytes', 'memoryview'):
+				self.assertEqual(memoryview(data).tobytes(), '\x01\x02\x03\x04')
+			else:
+				self.assertEqual(tuple(data), (0x0201, 0x0403), "format %s" % (format))
+			self.assertEqual(tuple(engine.socket(dest, retry=1, format=format).read_async(0x100, 2).result(5)), tuple(sock.read(0x100, 2, format=format)))
+		
+		# Default format compares with tuples
+		self.assertEqual(sock.read(0x100, 2), (0x0201, 0x0403))
+	
+	@unittest.skipUnless(os.path.isdir('/proc/self/fd'), "requires /proc/self/fd")
+	def test_stop_closes_waker(self):
+		# Warm up, so that lazily opened descriptors are not counted
+		engine = RMAP.Engine(SpaceWire.Interface(self.target.host, self.target.port))
+		engine.start()
+		engine.stop()
+		engine.spwif.close()
+		self.settle()
+		
+		before = open_fds()
+		for i in range(10):
+			engine = RMAP.Engine(SpaceWire.Interface(self.target.host, self.target.port))
+			engine.start()
+			engine.socket(self.dest, retry=1).read(0, 4)
+			engine.stop()
+			engine.spwif.close()
+		self.settle()
+		self.assertEqual(open_fds(), before)
+	
+	def test_adaptive(self):
+		self.target.stop()
+		self.target = Emulator.Target(size=0x100000, latency=0.02)
+		self.target.start()
+		engine = self.engine(timeout=1, adaptive=True, min_timeout=0.001)
+		sock = engine.socket(self.dest, retry=1)
+		for i in range(10):
+			sock.read(0, 4)
+		
+		# Estimated from the replies, and replacing the initial timeout
+		((key, (srtt, rttvar, timeout)), ) = engine.estimates().items()
+		self.assertEqual(key, (0x30, 0xfe, 0))
+		self.assertTrue(0.02 <= srtt < 0.5, srtt)
+		self.assertAlmostEqual(engine.retry_timeout(key, 0), timeout)
+		self.assertLess(timeout, 1)
+	
+	def test_restart(self):
+		engine = self.engine()
+		sock = engine.socket(self.dest, retry=1, format='bytes')
+		sock.write(0x200, '\xaa\xbb')
+		engine.stop()
+		engine.start()
+		self.assertEqual(sock.read(0x200, 2), '\xaa\xbb')
+	
+	def test_raising_callback(self):
+		# Replies take long enough for the callback to be added before
+		self.target.stop()
+		self.target = Emulator.Target(size=0x100000, latency=0.1)
+		self.target.start()
+		engine = self.engine()
+		sock = engine.socket(self.dest, retry=1, format='bytes')
+		
+		def callback(transaction):
+			raise RuntimeError("callback failed")
+		
+		transaction = sock.read_async(0, 4)
+		transaction.add_done_callback(callback)
+		self.assertEqual(transaction.result(5), '\x00' * 4)
+		
+		# The Transceiver survived, and the error was logged
+		self.assertEqual(sock.read(0, 4), '\x00' * 4)
+		self.assertTrue(engine.transceiver.is_alive())
+		self.assertEqual(len(self.log.records), 1)
+	
+	def test_transceiver_failure(self):
+		engine = self.engine(timeout=0.5)
+		sock = engine.socket(self.dest, retry=1, format='bytes')
+		
+		def dispatch(packet):
+			raise RuntimeError("dispatch failed")
+		engine.dispatch = dispatch
+		
+		# Transactions in flight fail instead of waiting forever
+		transaction = sock.read_async(0, 4)
+		self.assertRaises(RMAP.Failed, transaction.result)
+		self.assertIsInstance(transaction.exception.cause, RuntimeError)
+		engine.transceiver.join(5)
+		self.assertFalse(engine.transceiver.is_alive())
+		self.assertEqual(engine.stats()['tids_in_use'], 0)
+		
+		# So do new requests
+		self.assertRaises(RMAP.Failed, sock.read, 0, 4)
+		self.assertRaises(RMAP.Failed, engine.send_timecode, 0)
+		self.assertEqual(engine.stats()['tids_in_use'], 0)
+		
+		# Restarting recovers
+		del engine.dispatch
+		engine.stop()
+		engine.start()
+		self.assertEqual(sock.read(0, 4), '\x00' * 4)
+	
+	def test_resubmit_error(self):
+		self.target.stop()
+		self.target = Emulator.Target(size=0x100000, latency=0.5)
+		self.target.start()
+		engine = self.engine(timeout=0.05)
+		sock = engine.socket(self.dest, retry=1, format='bytes')
+		
+		# Resending after the time-out raises in the Transceiver
+		transaction = sock.read_async(0, 4)
+		def submit(previous=None):
+			raise RuntimeError("submit failed")
+		transaction.submit = submit
+		
+		# The transaction is not left locked, and fails with the engine
+		self.assertRaises(RMAP.Failed, transaction.result, 5)
+		self.assertIsInstance(transaction.exception.cause, RuntimeError)
+		self.assertFalse(transaction.cancel())
+		self.assertEqual(engine.stats()['tids_in_use'], 0)
+	
+	def test_result_timeout(self):
+		self.target.stop()
+		self.target = Emulator.Target(size=0x100000, latency=0.5)
+		self.target.start()
+		sock = self.engine(timeout=None).socket(self.dest, format='bytes')
+		
+		transaction = sock.read_async(0, 4)
+		self.assertRaises(RMAP.Timeout, transaction.result, 0)
+		self.assertRaises(RMAP.Timeout, transaction.result, 0.1)
+		self.assertEqual(transaction.result(5), '\x00' * 4)
+
+class Replies(object):
+	"""
+	Reply queue of a transaction, keeping replies put.
+	"""
+	def __init__(self):
+		self.replies = []
+	
+	def put(self, reply):
+		self.replies.append(reply)
+
+class TestTransactionIds(EngineTestCase):
+	def setUp(self):
+		EngineTestCase.setUp(self)
+		
+		# Transaction ids are taken and returned without running the engine
+		self.ids = RMAP.Engine(SpaceWire.Interface(self.target.host, self.target.port))
+	
+	def test_exhaustion(self):
+		engine = self.ids
+		sids = [ engine.request_sid(Replies()) for i in range(RMAP.Max_SID) ]
+		self.assertEqual(sorted(sids), range(RMAP.Max_SID))
+		self.assertEqual(engine.stats()['tids_in_use'], RMAP.Max_SID)
+		
+		# Blocks until an id is returned
+		taken = []
+		thread = threading.Thread(target=lambda: taken.append(engine.request_sid(Replies())))
+		thread.setDaemon(True)
+		thread.start()
+		time.sleep(0.1)
+		self.assertEqual(taken, [])
+		self.assertEqual(engine.stats()['tids_waiting'], 1)
+		engine.return_sid(1234)
+		thread.join(5)
+		self.assertEqual(taken, [ 1234 ])
+		self.assertEqual(engine.stats()['tids_waiting'], 0)
+		
+		# Returning a timed-out id along never blocks
+		self.assertEqual(engine.request_sid(Replies(), previous=taken[0]), 1234)
+	
+	def test_fifo_reuse(self):
+		engine = self.ids
+		sids = [ engine.request_sid(Replies()) for i in range(RMAP.Max_SID) ]
+		for sid in (7, 3, 65535, 0):
+			engine.return_sid(sid)
+		self.assertEqual([ engine.request_sid(Replies()) for i in range(4) ], [ 7, 3, 65535, 0 ])
+		
+		# Ids returned are reused after all others
+		engine = RMAP.Engine(SpaceWire.Interface(self.target.host, self.target.port))
+		sid = engine.request_sid(Replies())
+		engine.return_sid(sid)
+		self.assertNotIn(sid, [ engine.request_sid(Replies()) for i in range(RMAP.Max_SID - 1) ])
+		self.assertEqual(engine.request_sid(Replies()), sid)
+	
+	def test_late_reply(self):
+		engine = self.ids
+		replies = Replies()
+		sid = engine.request_sid(replies)
+		packet = RMAP.packetize(sid, self.dest, 0, 4)
+		reply = self.target.execute(packet)
+		
+		# Dropped until the command is sent
+		engine.dispatch(reply)
+		engine.sent[sid] = engine.generations[sid]
+		engine.dispatch(reply)
+		self.assertEqual(len(replies.replies), 1)
+		
+		# Dropped once the id is returned, and while its next command is not sent
+		engine.return_sid(sid)
+		engine.dispatch(reply)
+		for i in range(RMAP.Max_SID - 1):
+			engine.return_sid(engine.request_sid(Replies()))
+		reused = Replies()
+		self.assertEqual(engine.request_sid(reused), sid)
+		engine.dispatch(reply)
+		self.assertEqual((len(replies.replies), len(reused.replies)), (1, 0))
+		self.assertEqual(engine.stats()['dropped_replies'], 3)
+	
+	def test_late_replies_dropped(self):
+		# Replies arrive after their commands have timed out
+		self.target.stop()
+		self.target = Emulator.Target(size=0x100000, latency=0.2)
+		self.target.start()
+		engine = self.engine(timeout=0.05)
+		sock = engine.socket(self.dest, retry=1, format='bytes')
+		self.assertRaises(RMAP.Timeout, sock.read, 0x10, 4)
+		time.sleep(0.3)
+		stats = engine.stats()
+		self.assertEqual((stats['dropped_replies'], stats['tids_in_use']), (2, 0))
+		
+		# Not taken for replies of later commands
+		engine.timeout = 1
+		sock.write(0x10, '\x01\x02\x03\x04')
+		self.assertEqual(sock.read(0x10, 4), '\x01\x02\x03\x04')
+		self.assertEqual(engine.stats()['dropped_replies'], 2)
+
+class TestIterRead(EngineTestCase):
+	def test_prefetch_bound(self):
+		engine = self.engine(timeout=10)
+		sock = engine.socket(self.dest, retry=1)
+		
+		# Keep track of transactions alive
+		transactions = []
+		read_async = sock.read_async
+		def track(*args, **kwargs):
+			transaction = read_async(*args, **kwargs)
+			transactions.append(weakref.ref(transaction))
+			return transaction
+		sock.read_async = track
+		
+		prefetch = 2
+		chunks = 0
+		for data in sock.iter_read(0, 64 * 4096, chunk=4096, prefetch=prefetch):
+			self.assertEqual(len(data), 4096)
+			chunks += 1
+			
+			# Chunks in flight, and the one being yielded
+			self.assertLessEqual(len([ ref for ref in transactions if ref() is not None ]), prefetch + 2)
+		self.assertEqual(chunks, 64)
+		self.assertEqual(len(engine.scheduled), 0)
+	
+	def test_deadline_heap_bound(self):
+		engine = self.engine(timeout=10)
+		sock = engine.socket(self.dest, retry=1)
+		for i in range(1000):
+			sock.read(0, 4)
+		self.assertLessEqual(len(engine.deadlines), 2 * len(engine.scheduled) + 65)
+		self.assertEqual(len(engine.scheduled), 0)
+	
+	def test_stats_deadlines(self):
+		self.target.stop()
+		self.target = Emulator.Target(size=0x100000, latency=0.2)
+		self.target.start()
+		engine = self.engine(timeout=10)
+		sock = engine.socket(self.dest, retry=1)
+		
+		transactions = [ sock.read_async(0, 4) for i in range(3) ]
+		self.assertEqual(engine.stats()['deadlines'], 3)
+		for transaction in transactions:
+			transaction.result(5)
+		self.assertEqual(engine.stats()['deadlines'], 0)
+
+class FaultyTarget(Emulator.Target):
+	"""
+	Target answering commands to given addresses with RMAP errors.
+	"""
+	def __init__(self, *args, **kwargs):
+		Emulator.Target.__init__(self, *args, **kwargs)
+		
+		# Status codes to reply with, in turn, by address
+		self.faults = {}
+	
+	def execute(self, packet, eep=False):
+		reply = Emulator.Target.execute(self, packet, eep)
+		address = struct.unpack('>L', packet[8:12])[0]
+		if reply is None or not self.faults.get(address):
+			return reply
+		
+		# Status, and header CRC of write (8 bytes) or read (12 bytes) replies
+		status = self.faults[address].pop(0)
+		header = 8 if ord(reply[2]) & 0x20 else 12
+		faulty = reply[:3] + chr(status) + reply[4:header - 1]
+		return faulty + chr(RMAP.calc_crc(self.crc, faulty)) + reply[header:]
+
+class TestPipeline(EngineTestCase):
+	def setUp(self):
+		EngineTestCase.setUp(self)
+		self.target.stop()
+		self.target = FaultyTarget(size=0x100000)
+		self.target.start()
+		self.sock = self.engine().socket(self.dest, retry=2)
+		self.data = ''.join( chr(i & 0xff) for i in range(16 * 1024) )
+		self.sock.write_region(0, self.data, chunk=1024)
+	
+	def test_transient(self):
+		# Chunks failing transiently are resubmitted on their own
+		self.target.faults = {1024: [ 4, 5 ], 8192: [ 7 ]}
+		commands = self.target.commands
+		self.assertEqual(str(self.sock.read_region(0, len(self.data), chunk=1024)), self.data)
+		self.assertEqual(self.target.commands - commands, 16 + 3)
+		self.assertEqual(self.sock.retries, 3)
+		self.assertEqual(self.engines[0].stats()['timeouts'], 0)
+	
+	def test_retry_count(self):
+		# Up to the retry count of the socket
+		self.target.faults = {2048: [ 6, 6, 6 ]}
+		with self.assertRaises(RMAP.Error) as context:
+			self.sock.read_region(0, len(self.data), chunk=1024)
+		self.assertEqual(context.exception.code, 6)
+	
+	def test_error(self):
+		# Other errors are raised, and the chunks in flight cancelled
+		self.target.faults = {3072: [ 10 ]}
+		with self.assertRaises(RMAP.Error) as context:
+			self.sock.read_region(0, len(self.data), chunk=1024)
+		self.assertEqual(context.exception.code, 10)
+		self.assertEqual(self.sock.retries, 0)
+		
+		# Ids of cancelled chunks are returned
+		engine = self.engines[0]
+		deadline = time.time() + 5
+		while engine.stats()['tids_in_use'] and time.time() < deadline:
+			time.sleep(0.01)
+		self.assertEqual(engine.stats()['tids_in_use'], 0)
+	
+	def test_write(self):
+		self.target.faults = {4096: [ 5 ]}
+		self.sock.write_region(0, self.data[::-1], chunk=1024)
+		self.assertEqual(str(self.target.memory[:len(self.data)]), self.data[::-1])
+		self.assertEqual(self.sock.retries, 1)
+
+class TestStream(EngineTestCase):
+	def test_write(self):
+		sock = self.engine().socket(self.dest, retry=1)
+		stream = sock.stream(max_bytes=4096, max_packets=4, fence_bytes=8192)
+		data = ''.join( chr(i & 0xff) for i in range(1024) )
+		for i in range(64):
+			self.assertTrue(stream.write(i * 1024, data))
+		stream.write(64 * 1024, data, fence=True)
+		stream.flush(5)
+		
+		stats = stream.stats()
+		self.assertEqual((stats['writes'], stats['fences'], stats['queued_writes'], stats['queued_bytes']), (65, 9, 0, 0))
+		self.assertEqual(str(sock.read_region(0, 65 * 1024)), data * 65)
+	
+	def test_failed_write(self):
+		sock = self.engine().socket(self.dest, retry=1)
+		stream = sock.stream(max_packets=2)
+		
+		# Words out of range fail to packetize, and give back their reservation
+		for i in range(4):
+			self.assertRaises(Exception, stream.write, 0, [ 0x100 ], 1)
+		self.assertEqual(stream.stats()['queued_writes'], 0)
+		self.assertTrue(stream.write(0, '\x01\x02', 1))
+		stream.flush(5)
+
+class TestAsyncEngine(EngineTestCase):
+	def setUp(self):
+		EngineTestCase.setUp(self)
+		self.async_engine = RMAP.AsyncEngine(SpaceWire.Interface(self.target.host, self.target.port))
+		self.async_engine.start()
+	
+	def tearDown(self):
+		self.async_engine.stop()
+		self.async_engine.spwif.close()
+		EngineTestCase.tearDown(self)
+	
+	def test_read_write(self):
+		sock = self.async_engine.socket(self.dest, retry=1, format='bytes')
+		self.async_engine.run_until_complete(sock.write(0x300, '\x05\x06\x07\x08'))
+		self.assertEqual(self.async_engine.run_until_complete(sock.read(0x300, 4)), '\x05\x06\x07\x08')
+	
+	def test_pipelined(self):
+		sock = self.async_engine.socket(self.dest, retry=1, format='bytes')
+		writes = [ sock.write(0x400 + i * 4, chr(i) * 4) for i in range(32) ]
+		reads = [ sock.read(0x400 + i * 4, 4) for i in range(32) ]
+		for (i, transaction) in enumerate(reads):
+			self.assertEqual(self.async_engine.run_until_complete(transaction), chr(i) * 4)
+		self.assertTrue(all( transaction.done() for transaction in writes ))
+		self.assertEqual(self.async_engine.stats()['tids_in_use'], 0)
+
+class TestReadCache(EngineTestCase):
+	def test_static(self):
+		engine = self.engine()
+		sock = engine.socket(self.dest, retry=1, format='bytes', cache=True)
+		engine.read_cache(self.dest).mark(0x500, 16, RMAP.Cache_Static)
+		self.target.memory[0x500:0x504] = '\x01\x02\x03\x04'
+		
+		self.assertEqual(sock.read(0x500, 4), '\x01\x02\x03\x04')
+		commands = self.target.commands
+		
+		# Served from the cache, even when the target changed behind it
+		self.target.memory[0x500:0x504] = '\xff' * 4
+		self.assertEqual(sock.read(0x500, 4), '\x01\x02\x03\x04')
+		self.assertEqual(self.target.commands, commands)
+		
+		# Until written through a socket sharing the cache
+		engine.socket(self.dest, retry=1, cache=True).write(0x502, '\x00')
+		self.assertEqual(sock.read(0x500, 4), '\xff\xff\x00\xff')
+		self.assertEqual(engine.read_cache(self.dest).statistics()['hits'], 1)
+	
+	def test_ttl(self):
+		engine = self.engine()
+		sock = engine.socket(self.dest, retry=1, format='bytes', cache=True)
+		engine.read_cache(self.dest).mark(0x600, 4, 0.2)
+		
+		self.assertEqual(sock.read(0x600, 4), '\x00' * 4)
+		self.target.memory[0x600] = 0x11
+		self.assertEqual(sock.read(0x600, 4), '\x00' * 4)
+		time.sleep(0.3)
+		self.assertEqual(sock.read(0x600, 4), '\x11\x00\x00\x00')
+	
+	def test_volatile(self):
+		engine = self.engine()
+		sock = engine.socket(self.dest, retry=1, format='bytes', cache=True)
+		
+		# Ranges not marked take the default time-to-live, not to cache
+		sock.read(0x700, 4)
+		self.target.memory[0x700] = 0x22
+		self.assertEqual(sock.read(0x700, 4), '\x22\x00\x00\x00')
+		self.assertEqual(engine.read_cache(self.dest).statistics()['entries'], 0)
+
+class TestMultiEngine(EngineTestCase):
+	def setUp(self):
+		EngineTestCase.setUp(self)
+		self.spwifs = [ SpaceWire.Interface(self.target.host, self.target.port) for i in range(2) ]
+		self.multi = RMAP.MultiEngine(self.spwifs, RMAP.Policy_LeastOutstanding)
+		self.multi.start()
+	
+	def tearDown(self):
+		self.multi.stop()
+		for spwif in self.spwifs:
+			spwif.close()
+		EngineTestCase.tearDown(self)
+	
+	def test_region(self):
+		sock = self.multi.socket(self.dest, retry=1)
+		data = ''.join( chr(i & 0xff) for i in range(65536) )
+		sock.write_region(0x1000, data, chunk=1024)
+		self.assertEqual(str(sock.read_region(0x1000, len(data), chunk=1000)), data)
+		self.assertEqual(self.multi.stats()['tids_in_use'], 0)
+	
+	def test_register_access(self):
+		self.multi.write_registers([ (0x10, 0x1234) ], self.spwifs[1])
+		self.assertEqual(self.multi.read_registers([ 0x10, 0x14 ], self.spwifs[0]), [ 0x1234, 0 ])
+	
+	def test_unknown_interface(self):
+		self.assertRaises(ValueError, self.multi.read_register_async, 0x10, SpaceWire.Interface('x', 1))
+		self.assertEqual(sum( len(accesses) for accesses in self.multi.register_accesses.values() ), 0)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,121 @@
+#
+# test_memory.py
+# Remote Memory Module Tests
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyspw import Memory
+from tests.test_engine import EngineTestCase
+
+class TestDumpLoad(EngineTestCase):
+	def setUp(self):
+		EngineTestCase.setUp(self)
+		self.directory = tempfile.mkdtemp()
+		self.sock = self.engine().socket(self.dest, retry=1)
+		self.data = os.urandom(0x10000 + 0x123)
+		self.sock.write_region(0x2000, self.data)
+	
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+		EngineTestCase.tearDown(self)
+	
+	def path(self, name):
+		return os.path.join(self.directory, name)
+	
+	def test_dump(self):
+		self.assertEqual(Memory.dump(self.sock, 0x2000, len(self.data), self.path('dump'), chunk=4096, check=True), [])
+		self.assertEqual(open(self.path('dump'), 'rb').read(), self.data)
+		self.assertFalse(os.path.exists(self.path('dump.progress')))
+	
+	def test_dump_resume(self):
+		# Interrupted after the first chunks
+		chunks = []
+		pipeline = self.sock.pipeline
+		def interrupted(chunks_, submit, window):
+			for (index, result) in enumerate(pipeline(chunks_, submit, window)):
+				if index == 5:
+					raise KeyboardInterrupt
+				chunks.append(result)
+				yield result
+		self.sock.pipeline = interrupted
+		self.assertRaises(KeyboardInterrupt, Memory.dump, self.sock, 0x2000, len(self.data), self.path('dump'), chunk=4096, window=1)
+		self.assertTrue(os.path.exists(self.path('dump.progress')))
+		del self.sock.pipeline
+		
+		# Only the missing chunks are read again
+		reads = []
+		read_async = self.sock.read_async
+		def track(address, length, **kwargs):
+			reads.append(address)
+			return read_async(address, length, **kwargs)
+		self.sock.read_async = track
+		Memory.dump(self.sock, 0x2000, len(self.data), self.path('dump'), chunk=4096)
+		self.assertEqual(len(reads), len(range(0, len(self.data), 4096)) - 5)
+		self.assertEqual(open(self.path('dump'), 'rb').read(), self.data)
+	
+	def test_dump_output_lost(self):
+		# A progress file recording every chunk as done, left without its output file
+		record = Memory.Progress(self.path('dump.progress'), 0x2000, len(self.data), 4096)
+		for index in range(record.count):
+			record.mark(index)
+		record.close()
+		
+		# Everything is read again
+		self.assertEqual(Memory.dump(self.sock, 0x2000, len(self.data), self.path('dump'), chunk=4096), [])
+		self.assertEqual(open(self.path('dump'), 'rb').read(), self.data)
+		self.assertFalse(os.path.exists(self.path('dump.progress')))
+		
+		# So it is with an output file of another size
+		record = Memory.Progress(self.path('dump.progress'), 0x2000, len(self.data), 4096)
+		for index in range(record.count):
+			record.mark(index)
+		record.close()
+		with open(self.path('dump'), 'r+b') as f:
+			f.truncate(4096)
+		self.assertEqual(Memory.dump(self.sock, 0x2000, len(self.data), self.path('dump'), chunk=4096), [])
+		self.assertEqual(open(self.path('dump'), 'rb').read(), self.data)
+	
+	def test_load(self):
+		with open(self.path('load'), 'wb') as f:
+			f.write(self.data[::-1])
+		
+		# The RMAP verify flag reaches the writes
+		writes = []
+		write_async = self.sock.write_async
+		def track(address, data, **kwargs):
+			writes.append(kwargs)
+			return write_async(address, data, **kwargs)
+		self.sock.write_async = track
+		
+		self.assertEqual(Memory.load(self.sock, 0x2000, self.path('load'), chunk=4096, check=True, verify=0), [])
+		self.assertTrue(writes)
+		self.assertTrue(all( kwargs.get('verify') == 0 for kwargs in writes ))
+		self.assertEqual(str(self.sock.read_region(0x2000, len(self.data))), self.data[::-1])
+	
+	def test_compare(self):
+		buf = bytearray(self.data)
+		buf[4096 * 3 + 7] ^= 0xff
+		record = Memory.Progress(self.path('progress'), 0x2000, len(buf), 4096)
+		for index in range(record.count):
+			record.mark(index)
+		self.assertEqual(Memory.compare(self.sock, 0x2000, buf, 4096, 8, record), [ (4096 * 3, 4096) ])
+		self.assertEqual(record.missing(), [ 3 ])
+		record.close()
+
+class TestRemoteMemory(EngineTestCase):
+	def test_read_write(self):
+		sock = self.engine().socket(self.dest, retry=1)
+		sock.write_region(0, ''.join( chr(i & 0xff) for i in range(0x4000) ))
+		
+		with Memory.RemoteMemory(sock, 0, 0x4000, page_size=256, pages=8) as memory:
+			self.assertEqual(memory[0x100:0x104], '\x00\x01\x02\x03')
+			memory[0x1000:0x1004] = 'abcd'
+			self.assertEqual(memory[0x0ffe:0x1006], '\xfe\xffabcd\x04\x05')
+		self.assertEqual(sock.read(0x1000, 4, format='bytes'), 'abcd')
+
+if __name__ == '__main__':
+	unittest.main()
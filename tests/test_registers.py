@@ -0,0 +1,80 @@
+#
+# test_registers.py
+# Register Map Tests, against an in-process Emulator.Target
+#
+
+import struct
+import unittest
+
+from pyspw import Registers
+from tests.test_engine import EngineTestCase
+
+class TestRegisterMap(EngineTestCase):
+	def setUp(self):
+		EngineTestCase.setUp(self)
+		self.sock = self.engine().socket(self.dest, retry=1)
+		self.map = Registers.RegisterMap(self.sock, [
+			('control', 0x100, 4, {'enable': (0, 1), 'mode': (4, 3)}),
+			('status', 0x104, 2),
+			('count', 0x108, 4),
+			('far', 0x200, 4),
+		])
+	
+	def test_plan(self):
+		runs = self.map.plan([ 'far', 'count', 'control', 'status' ])
+		self.assertEqual([ (address, size) for (address, size, fmt, registers) in runs ], [ (0x100, 12), (0x200, 4) ])
+		self.assertEqual(runs[0][2].format, '<IH2xI')
+		self.assertEqual([ register.name for register in runs[0][3] ], [ 'control', 'status', 'count' ])
+		
+		# Without gap, registers apart are read separately
+		self.assertEqual(len(self.map.plan([ 'control', 'status', 'count' ], gap=0)), 2)
+	
+	def test_snapshot(self):
+		self.target.memory[0x100:0x10c] = struct.pack('<IH2xI', 0x51, 0xbeef, 7)
+		self.target.memory[0x200:0x204] = struct.pack('<I', 0x12345678)
+		commands = self.target.commands
+		
+		values = self.map.snapshot()
+		self.assertEqual(values, {'control': 0x51, 'control.enable': 1, 'control.mode': 5, 'status': 0xbeef,
+									'count': 7, 'far': 0x12345678})
+		self.assertEqual(self.target.commands - commands, 2)
+		self.assertEqual(self.map.read('far'), 0x12345678)
+	
+	def test_write(self):
+		self.target.memory[0x100:0x104] = struct.pack('<I', 0xff00)
+		
+		# Fields keep the other bits of their register
+		self.map.write({'control.mode': 3, 'control.enable': 1, 'count': 9})
+		self.assertEqual(struct.unpack_from('<I', self.target.memory, 0x100)[0], 0xff31)
+		self.assertEqual(struct.unpack_from('<I', self.target.memory, 0x108)[0], 9)
+		
+		self.map.write({'status': 0x1234})
+		self.assertEqual(self.map.snapshot([ 'control', 'status' ], fields=False), {'control': 0xff31, 'status': 0x1234})
+
+	def test_plans_bound(self):
+		# Name lists built on the fly share plans by their set of names, and the least recently used go
+		self.map.snapshot([ 'status', 'control' ])
+		self.map.snapshot([ 'control', 'status', 'status' ])
+		self.assertEqual(len(self.map.plans), 1)
+		
+		for i in range(Registers.RegisterMap.Max_Plans + 10):
+			self.map.add('r%d' % i, 0x1000 + 4 * i)
+		self.map.snapshot([ 'far' ])
+		for i in range(Registers.RegisterMap.Max_Plans + 10):
+			self.map.snapshot([ 'count', 'r%d' % i ])
+			self.map.snapshot([ 'far' ])
+		self.assertEqual(len(self.map.plans), Registers.RegisterMap.Max_Plans)
+		self.assertIn(frozenset([ 'far' ]), self.map.plans)
+	
+	def test_write_unknown(self):
+		with self.assertRaises(KeyError) as context:
+			self.map.write({'nothing': 1})
+		self.assertIn('nothing', str(context.exception))
+		with self.assertRaises(KeyError) as context:
+			self.map.write({'nothing.field': 1})
+		self.assertIn('nothing', str(context.exception))
+		if __debug__:
+			self.assertRaises(AssertionError, self.map.write, {'control.nothing': 1})
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,190 @@
+#
+# test_rmap.py
+# RMAP Module Tests
+#
+
+import array
+import random
+import unittest
+
+from pyspw import SpaceWire, RMAP, Emulator
+
+class TestPacketize(unittest.TestCase):
+	def test_header_crc(self):
+		generator = random.Random(0)
+		for crc in (RMAP.CRC_DraftE, RMAP.CRC_DraftF):
+			dest = RMAP.Destination(src_address=0xfe, dest_address=0x30, dest_key=0x02, crc=crc, word_width=4)
+			for i in range(200):
+				tid = generator.randrange(RMAP.Max_SID)
+				address = generator.randrange(1 << 32)
+				length = generator.randrange(1 << 22)
+				packet = RMAP.packetize(tid, dest, address, length, extended_address=0x12)
+				self.assertEqual(ord(packet[15]), RMAP.calc_crc(crc, packet[:15]))
+				self.assertEqual(packet[12:15], chr((length * 4) >> 16 & 0xff) + chr((length * 4) >> 8 & 0xff) + chr((length * 4) & 0xff))
+	
+	def test_templates_by_length(self):
+		dest = RMAP.Destination(src_address=0xfe, dest_address=0x31, dest_key=0x02, crc=RMAP.CRC_DraftF, word_width=1)
+		RMAP.packetize(0, dest, 0, 1, '\x00')
+		templates = len(RMAP.Header_Templates)
+		for length in range(1, 2000):
+			packet = RMAP.packetize(length, dest, 0x1000, length, '\xa5' * length)
+			self.assertEqual(ord(packet[15]), RMAP.calc_crc(RMAP.CRC_DraftF, packet[:15]))
+			self.assertEqual(ord(packet[-1]), RMAP.calc_crc(RMAP.CRC_DraftF, '\xa5' * length))
+		self.assertEqual(len(RMAP.Header_Templates), templates)
+
+class TestFormats(unittest.TestCase):
+	def setUp(self):
+		# Executes commands, without serving
+		self.target = Emulator.Target(size=0x1000)
+		self.target.server.close()
+		self.target.memory[0x100:0x108] = '\x01\x02\x03\x04\x05\x06\x07\x08'
+	
+	def reply(self, word_width, length):
+		dest = RMAP.Destination(src_address=0xfe, dest_address=0x30, dest_key=0x02, crc=RMAP.CRC_DraftF, word_width=word_width)
+		return self.target.execute(RMAP.packetize(0x1234, dest, 0x100, length))
+	
+	def test_depacketize(self):
+		for (word_width, words) in ((1, (1, 2, 3, 4, 5, 6, 7, 8)), (2, (0x0201, 0x0403, 0x0605, 0x0807)), (4, (0x04030201, 0x08070605))):
+			reply = self.reply(word_width, len(words))
+			for format in RMAP.Data_Formats:
+				if format == 'numpy' and not RMAP.numpy:
+					continue
+				(tid, dest, status, data, options) = RMAP.depacketize(reply, check_crc=True, format=format)
+				self.assertEqual((tid, status), (0x1234, 0))
+				if format in ('bytes', 'memoryview'):
+					self.assertEqual(memoryview(data).tobytes(), '\x01\x02\x03\x04\x05\x06\x07\x08')
+				else:
+					self.assertEqual(tuple(data), words, "format %s, word width %d" % (format, word_width))
+				
+				# Written back as read
+				if format != 'memoryview':
+					self.assertEqual(RMAP.pack_data(word_width, data), '\x01\x02\x03\x04\x05\x06\x07\x08')
+	
+	def test_default_format(self):
+		# Callers comparing read data with tuples, as of older versions, keep working
+		(tid, dest, status, data, options) = RMAP.depacketize(self.reply(2, 4))
+		self.assertEqual(data, (0x0201, 0x0403, 0x0605, 0x0807))
+		self.assertEqual((0x0201, 0x0403, 0x0605, 0x0807), data)
+		self.assertEqual(data, [ 0x0201, 0x0403, 0x0605, 0x0807 ])
+		self.assertNotEqual(data, (0x0201, 0x0403, 0x0605))
+		self.assertEqual(data[1], 0x0403)
+		self.assertEqual(len(data), 4)
+	
+	@unittest.skipUnless(__debug__, "requires assertions")
+	def test_unknown_format(self):
+		self.assertRaises(AssertionError, RMAP.unpack_data, 1, '\x00', 'list')
+
+class TestEstimator(unittest.TestCase):
+	def test_update(self):
+		estimator = RMAP.Engine.Estimator()
+		
+		# The first sample sets SRTT, and RTTVAR to half of it
+		estimator.update(0.1)
+		self.assertAlmostEqual(estimator.srtt, 0.1)
+		self.assertAlmostEqual(estimator.rttvar, 0.05)
+		self.assertAlmostEqual(estimator.timeout(0.001), 0.1 + 4 * 0.05)
+		
+		# Later ones with gains of 1/8 and 1/4, RTTVAR updated with the previous SRTT
+		estimator.update(0.3)
+		self.assertAlmostEqual(estimator.rttvar, 0.75 * 0.05 + 0.25 * 0.2)
+		self.assertAlmostEqual(estimator.srtt, 0.875 * 0.1 + 0.125 * 0.3)
+		self.assertEqual(estimator.samples, 2)
+		
+		# Converges to a steady round-trip time, the variation term floored by the granularity
+		for i in range(200):
+			estimator.update(0.02)
+		self.assertAlmostEqual(estimator.srtt, 0.02)
+		self.assertAlmostEqual(estimator.timeout(0.001), 0.021)
+	
+	def test_retry_timeout(self):
+		engine = RMAP.Engine(SpaceWire.Interface('127.0.0.1', 1), timeout=0.5, adaptive=True, min_timeout=0.01, max_timeout=2)
+		self.addCleanup(engine.waker.close)
+		key = (0x30, 0xfe, 0)
+		
+		# Timeout until measured, doubled on each retry up to max_timeout
+		self.assertEqual([ engine.retry_timeout(key, retry) for retry in range(4) ], [ 0.5, 1.0, 2, 2 ])
+		
+		engine.measure(key, 0.1)
+		self.assertAlmostEqual(engine.retry_timeout(key, 0), 0.3)
+		self.assertAlmostEqual(engine.retry_timeout(key, 2), 1.2)
+		self.assertEqual(engine.estimates()[key][:2], (0.1, 0.05))
+		self.assertAlmostEqual(engine.estimates()[key][2], 0.3)
+		
+		# Clamped to min_timeout, and to max_timeout in estimates
+		for i in range(200):
+			engine.measure(key, 0.0001)
+		self.assertAlmostEqual(engine.retry_timeout(key, 0), 0.0101, 4)
+		engine.measure((0x30, 0xfe, 1), 10)
+		self.assertEqual(engine.estimates()[(0x30, 0xfe, 1)][2], 2)
+		self.assertEqual(engine.retry_timeout((0x30, 0xfe, 1), 0), 2)
+		
+		# Other size classes are estimated separately
+		self.assertEqual(engine.retry_timeout((0x30, 0xfe, 2), 0), 0.5)
+	
+	def test_fixed_timeout(self):
+		engine = RMAP.Engine(SpaceWire.Interface('127.0.0.1', 1), timeout=0.5)
+		self.addCleanup(engine.waker.close)
+		engine.measure((0x30, 0xfe, 0), 0.1)
+		self.assertEqual([ engine.retry_timeout((0x30, 0xfe, 0), retry) for retry in range(3) ], [ 0.5, 0.5, 0.5 ])
+
+def reference_crc(table, data, init=0x00):
+	"""
+	Return CRC of data calculated byte by byte.
+	"""
+	for byte in bytearray(data):
+		init = table[init ^ byte]
+	return init
+
+class TestCRC(unittest.TestCase):
+	def setUp(self):
+		generator = random.Random(0)
+		self.data = ''.join( chr(generator.randrange(256)) for i in range(3 * RMAP.CRC_NumPy_Threshold) )
+		
+		# Lengths around the word, block and NumPy threshold boundaries
+		self.lengths = range(0, 40) + [ length + delta for length in (RMAP.CRC_Block_Size, 2 * RMAP.CRC_Block_Size,
+						RMAP.CRC_NumPy_Threshold, RMAP.CRC_NumPy_Threshold + RMAP.CRC_Block_Size, 2 * RMAP.CRC_NumPy_Threshold)
+						for delta in (-2, -1, 0, 1, 2) ]
+		
+		# Any table works for the custom CRC
+		self.custom = RMAP.CRCTable_Custom
+		RMAP.CRCTable_Custom = RMAP.CRCTable_DraftE
+		self.tables = {RMAP.CRC_DraftE: RMAP.CRCTable_DraftE, RMAP.CRC_DraftF: RMAP.CRCTable_DraftF,
+						RMAP.CRC_52C: RMAP.CRCTable_DraftF, RMAP.CRC_Custom: RMAP.CRCTable_DraftE}
+	
+	def tearDown(self):
+		RMAP.CRCTable_Custom = self.custom
+	
+	def test_lengths(self):
+		for (crc, table) in self.tables.items():
+			for length in self.lengths:
+				data = self.data[:length]
+				self.assertEqual(RMAP.calc_crc(crc, data), reference_crc(table, data), "CRC %d of %d bytes" % (crc, length))
+	
+	def test_init(self):
+		for (crc, table) in self.tables.items():
+			for length in self.lengths:
+				data = self.data[:length]
+				for split in sorted(set([ 0, 1, length // 3, length // 2, length - 1, length ])):
+					if not 0 <= split <= length:
+						continue
+					self.assertEqual(RMAP.calc_crc(crc, data[split:], RMAP.calc_crc(crc, data[:split])), reference_crc(table, data),
+									"CRC %d of %d bytes split at %d" % (crc, length, split))
+	
+	def test_buffers(self):
+		data = self.data[:RMAP.CRC_NumPy_Threshold + 3]
+		expected = reference_crc(RMAP.CRCTable_DraftF, data)
+		for buf in (bytearray(data), memoryview(data), buffer(data), array.array('B', data)):
+			self.assertEqual(RMAP.calc_crc(RMAP.CRC_DraftF, buf), expected)
+	
+	@unittest.skipUnless(RMAP.numpy, "requires NumPy")
+	def test_numpy_blocks(self):
+		# Blocks right above the threshold, and from a NumPy array
+		for crc in (RMAP.CRC_DraftE, RMAP.CRC_DraftF):
+			data = self.data[:RMAP.CRC_NumPy_Threshold + RMAP.CRC_Block_Size + 1]
+			self.assertEqual(RMAP.calc_crc(crc, RMAP.numpy.frombuffer(data, dtype=RMAP.numpy.uint8)), reference_crc(self.tables[crc], data))
+	
+	def test_unknown_type(self):
+		self.assertEqual(RMAP.calc_crc(7, self.data[:100]), 0x00)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,290 @@
+#
+# test_spacewire.py
+# SpaceWire Module Tests
+#
+
+import errno
+import socket
+import threading
+import time
+import unittest
+
+from pyspw import SpaceWire, RMAP, Emulator
+
+class TestDecoder(unittest.TestCase):
+	def test_frames(self):
+		decoder = SpaceWire.Decoder(16)
+		stream = SpaceWire.frame(SpaceWire.DataFlag_Fragmented, 'ab') + SpaceWire.frame(SpaceWire.DataFlag_Complete_EOP, 'cd') + \
+			SpaceWire.frame(SpaceWire.ControlFlag_GotTimeCode, '\x05\x00')
+		
+		# Fed byte by byte, frames complete at their last byte
+		frames = []
+		for byte in stream:
+			frames += decoder.feed(byte)
+		self.assertEqual(frames, [ (SpaceWire.DataFlag_Complete_EOP, 'abcd'), (SpaceWire.ControlFlag_GotTimeCode, '\x05\x00') ])
+	
+	def test_unknown_flag(self):
+		decoder = SpaceWire.Decoder()
+		self.assertRaises(SpaceWire.ProtocolError, decoder.feed, SpaceWire.frame('\x7f', 'xy'))
+		
+		# The stream stays broken
+		self.assertRaises(SpaceWire.ProtocolError, decoder.feed, SpaceWire.frame(SpaceWire.DataFlag_Complete_EOP, 'ab'))
+	
+	def test_unknown_flag_length(self):
+		# A garbage length does not make the decoder wait for more
+		decoder = SpaceWire.Decoder(64)
+		self.assertRaises(SpaceWire.ProtocolError, decoder.feed, '\x7f\x00\xff\xff' + '\xff' * 8)
+		self.assertEqual(len(decoder.buf), 64)
+	
+	def test_frames_before_unknown_flag(self):
+		decoder = SpaceWire.Decoder()
+		stream = SpaceWire.frame(SpaceWire.DataFlag_Complete_EOP, 'ab') + SpaceWire.frame(SpaceWire.ControlFlag_GotTimeCode, '\x05\x00') + \
+			SpaceWire.frame('\x7f', 'xy')
+		
+		# Frames completed before the bad one are returned, and the next call raises
+		self.assertEqual(decoder.feed(stream), [ (SpaceWire.DataFlag_Complete_EOP, 'ab'), (SpaceWire.ControlFlag_GotTimeCode, '\x05\x00') ])
+		self.assertIsInstance(decoder.error, SpaceWire.ProtocolError)
+		self.assertRaises(SpaceWire.ProtocolError, decoder.feed, '')
+
+class Partial(object):
+	"""
+	Socket taking at most limit bytes per send, and raising EAGAIN once full.
+	"""
+	def __init__(self, limit, capacity=None):
+		self.limit = limit
+		self.capacity = capacity
+		self.sends = []
+	
+	def send(self, data):
+		data = str(data)[:self.limit]
+		if self.capacity is not None:
+			if not self.capacity:
+				raise socket.error(errno.EAGAIN, 'Resource temporarily unavailable')
+			data = data[:self.capacity]
+			self.capacity -= len(data)
+		self.sends.append(data)
+		return len(data)
+	
+	def data(self):
+		return ''.join(self.sends)
+
+class TestEncoder(unittest.TestCase):
+	def frames(self, *payloads):
+		return [ SpaceWire.frame(SpaceWire.DataFlag_Complete_EOP, payload) for payload in payloads ]
+	
+	def test_frame(self):
+		encoder = SpaceWire.Encoder()
+		encoder.put('abc')
+		encoder.put('\x01\x00', SpaceWire.ControlFlag_SendTimeCode)
+		sock = Partial(1000)
+		encoder.flush(sock)
+		self.assertEqual(sock.data(), SpaceWire.frame(SpaceWire.DataFlag_Complete_EOP, 'abc') + SpaceWire.frame(SpaceWire.ControlFlag_SendTimeCode, '\x01\x00'))
+		self.assertEqual(SpaceWire.Decoder().feed(sock.data()), [ (SpaceWire.DataFlag_Complete_EOP, 'abc'), (SpaceWire.ControlFlag_SendTimeCode, '\x01\x00') ])
+	
+	def test_batches(self):
+		# Frames of 16 bytes, two per batch by bytes, and a frame larger than a batch alone
+		encoder = SpaceWire.Encoder(batch_bytes=40, batch_packets=8)
+		frames = self.frames('aaaa', 'bbbb', 'cccc', 'd' * 60, 'eeee')
+		for payload in ('aaaa', 'bbbb', 'cccc', 'd' * 60, 'eeee'):
+			encoder.put(payload)
+		self.assertEqual(len(encoder), sum(map(len, frames)))
+		
+		# Partial sends advance within a batch
+		sock = Partial(5)
+		batches = []
+		while len(encoder):
+			encoder.send(sock)
+			if encoder.offset == len(encoder.batch):
+				batches.append(encoder.batch)
+		self.assertEqual(batches, [ frames[0] + frames[1], frames[2], frames[3], frames[4] ])
+		self.assertEqual(sock.data(), ''.join(frames))
+		self.assertTrue(all( len(data) <= 5 for data in sock.sends ))
+		self.assertEqual(encoder.total, len(sock.data()))
+		self.assertEqual(encoder.send(sock), 0)
+	
+	def test_batch_packets(self):
+		encoder = SpaceWire.Encoder(batch_bytes=65536, batch_packets=2)
+		for payload in 'abcde':
+			encoder.put(payload)
+		sock = Partial(65536)
+		sizes = []
+		while len(encoder):
+			sizes.append(encoder.send(sock))
+		self.assertEqual(sizes, [ 26, 26, 13 ])
+		self.assertEqual(sock.data(), ''.join(self.frames(*'abcde')))
+	
+	def test_first(self):
+		encoder = SpaceWire.Encoder(batch_bytes=65536, batch_packets=1)
+		encoder.put('a')
+		encoder.put('b')
+		sock = Partial(3)
+		encoder.send(sock)
+		
+		# Ahead of frames queued, in their order, but after the batch being sent
+		encoder.put('x', first=True)
+		encoder.put('y', first=True)
+		sock.limit = 65536
+		while len(encoder):
+			encoder.send(sock)
+		self.assertEqual(sock.data(), ''.join(self.frames('a', 'x', 'y', 'b')))
+	
+	def test_flush_would_block(self):
+		encoder = SpaceWire.Encoder()
+		for payload in 'abc':
+			encoder.put(payload)
+		sock = Partial(65536, capacity=20)
+		self.assertEqual(encoder.flush(sock), 20)
+		self.assertEqual(len(encoder), 19)
+		sock.capacity = None
+		self.assertEqual(encoder.flush(sock), 19)
+		self.assertEqual(sock.data(), ''.join(self.frames(*'abc')))
+
+class TestInterface(unittest.TestCase):
+	def setUp(self):
+		self.target = Emulator.Target(size=0x1000, timecode_period=0.005)
+		self.target.start()
+		self.spwif = SpaceWire.Interface(self.target.host, self.target.port, timeout=5)
+		self.spwif.open()
+	
+	def tearDown(self):
+		self.spwif.close()
+		self.target.stop()
+	
+	def test_receive_skips_timecodes(self):
+		timecodes = self.spwif.subscribe()
+		dest = RMAP.Destination(src_address=0xfe, dest_address=0x30, dest_key=0x02, crc=RMAP.CRC_DraftF, word_width=1)
+		for tid in range(5):
+			time.sleep(0.02)
+			self.spwif.send(RMAP.packetize(tid, dest, 0x10, 4))
+			(reply_tid, reply_dest, status, data, options) = RMAP.depacketize(self.spwif.receive(), format='bytes')
+			self.assertEqual((reply_tid, status, data), (tid, 0, '\x00' * 4))
+		
+		# Time codes were delivered to the subscription instead
+		self.assertGreater(len(timecodes.get()), 0)
+	
+	def test_receive_skips_control_frames(self):
+		# A late register reply left by register_replies, ahead of the reply to a command
+		self.spwif.frames.append((SpaceWire.ControlFlag_RegisterAccess_ReadReply, SpaceWire.Register_Access.pack(0x10, 1)))
+		self.spwif.frames.append((SpaceWire.ControlFlag_ChangeTxSpeed, '\x05\x00'))
+		dest = RMAP.Destination(src_address=0xfe, dest_address=0x30, dest_key=0x02, crc=RMAP.CRC_DraftF, word_width=1)
+		self.spwif.send(RMAP.packetize(7, dest, 0x10, 4))
+		(tid, reply_dest, status, data, options) = RMAP.depacketize(self.spwif.receive(), format='bytes')
+		self.assertEqual((tid, status, data), (7, 0, '\x00' * 4))
+	
+	def test_raising_timecode_callback(self):
+		def callback(value, rtime):
+			raise RuntimeError("callback failed")
+		timecodes = self.spwif.subscribe(callback=callback)
+		SpaceWire.log.disabled = True
+		try:
+			self.spwif.fill()
+			self.spwif.fill()
+		finally:
+			SpaceWire.log.disabled = False
+		self.assertGreater(timecodes.stats()['received'], 0)
+
+class TestRegisters(unittest.TestCase):
+	def setUp(self):
+		self.target = Emulator.Target(size=0x1000, registers={0x10: 0xdeadbeef, 0x20: 7})
+		self.target.start()
+		self.spwif = SpaceWire.Interface(self.target.host, self.target.port, timeout=5)
+		self.spwif.open()
+		self.dest = RMAP.Destination(src_address=0xfe, dest_address=0x30, dest_key=0x02, crc=RMAP.CRC_DraftF, word_width=1)
+	
+	def tearDown(self):
+		self.spwif.close()
+		self.target.stop()
+	
+	def test_read_write(self):
+		self.assertEqual(self.spwif.read_registers([ 0x10, 0x20, 0x30 ]), [ 0xdeadbeef, 7, 0 ])
+		self.spwif.write_registers([ (0x30, 1), (0x34, 2) ])
+		self.spwif.write_register(0x20, 0x12345678)
+		self.assertEqual(self.target.registers[0x30], 1)
+		self.assertEqual(self.spwif.read_register(0x20), 0x12345678)
+		
+		# Replies to the same address answer the commands in order
+		self.assertEqual(self.spwif.read_registers([ 0x34, 0x10, 0x34 ]), [ 2, 0xdeadbeef, 2 ])
+	
+	def test_packets_kept(self):
+		# Replies received while waiting for register replies are kept for receive
+		self.spwif.send(RMAP.packetize(1, self.dest, 0, 4))
+		self.assertEqual(self.spwif.read_registers([ 0x10 ]), [ 0xdeadbeef ])
+		(tid, dest, status, data, options) = RMAP.depacketize(self.spwif.receive(), format='bytes')
+		self.assertEqual((tid, status), (1, 0))
+	
+	def test_late_replies(self):
+		# Register replies nobody waits for are not returned by receive
+		self.spwif.send_control(SpaceWire.ControlFlag_RegisterAccess_ReadCommand, [ SpaceWire.Register_Address.pack(0x10) ])
+		self.assertEqual(self.spwif.read_registers([ 0x20 ]), [ 7 ])
+		self.spwif.send(RMAP.packetize(2, self.dest, 0, 4))
+		(tid, dest, status, data, options) = RMAP.depacketize(self.spwif.receive(), format='bytes')
+		self.assertEqual((tid, status), (2, 0))
+
+class TestProtocolError(unittest.TestCase):
+	def setUp(self):
+		self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.server.bind(('127.0.0.1', 0))
+		self.server.listen(1)
+		self.connections = []
+		
+		# Executes commands, without serving
+		self.target = Emulator.Target(size=0x1000)
+		self.target.server.close()
+		self.replies = 0
+		
+		# Answer the first commands, and follow the replies with a frame of unknown flag
+		def serve():
+			(conn, address) = self.server.accept()
+			self.connections.append(conn)
+			decoder = SpaceWire.Decoder()
+			commands = []
+			while len(commands) <= self.replies:
+				commands += [ payload for (flag, payload) in decoder.feed(conn.recv(65536)) if flag == SpaceWire.DataFlag_Complete_EOP ]
+			stream = ''.join( SpaceWire.frame(SpaceWire.DataFlag_Complete_EOP, self.target.execute(command)) for command in commands[:self.replies] )
+			conn.sendall(stream + SpaceWire.frame('\x7f', 'xy'))
+		
+		self.thread = threading.Thread(target=serve)
+		self.thread.setDaemon(True)
+		self.thread.start()
+	
+	def tearDown(self):
+		for conn in self.connections:
+			conn.close()
+		self.server.close()
+	
+	def test_engine_fails(self):
+		(host, port) = self.server.getsockname()
+		engine = RMAP.Engine(SpaceWire.Interface(host, port))
+		engine.start()
+		RMAP.log.disabled = True
+		try:
+			dest = RMAP.Destination(src_address=0xfe, dest_address=0x30, dest_key=0x02, crc=RMAP.CRC_DraftF, word_width=1)
+			transaction = engine.socket(dest).read_async(0, 4)
+			self.assertRaises(RMAP.Failed, transaction.result, 5)
+			self.assertIsInstance(transaction.exception.cause, SpaceWire.ProtocolError)
+		finally:
+			RMAP.log.disabled = False
+			engine.stop()
+			engine.spwif.close()
+	
+	def test_replies_before_error(self):
+		self.replies = 1
+		(host, port) = self.server.getsockname()
+		engine = RMAP.Engine(SpaceWire.Interface(host, port))
+		engine.start()
+		RMAP.log.disabled = True
+		try:
+			# The reply received along with the bad frame completes its transaction, the other one fails
+			dest = RMAP.Destination(src_address=0xfe, dest_address=0x30, dest_key=0x02, crc=RMAP.CRC_DraftF, word_width=1)
+			sock = engine.socket(dest, format='bytes')
+			transactions = [ sock.read_async(0, 4), sock.read_async(4, 4) ]
+			self.assertEqual(transactions[0].result(5), '\x00' * 4)
+			self.assertRaises(RMAP.Failed, transactions[1].result, 5)
+			self.assertIsInstance(transactions[1].exception.cause, SpaceWire.ProtocolError)
+		finally:
+			RMAP.log.disabled = False
+			engine.stop()
+			engine.spwif.close()
+
+if __name__ == '__main__':
+	unittest.main()